@@ -0,0 +1,87 @@
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.utils.translation import gettext_lazy as _
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import (
+    APIException,
+    AuthenticationFailed,
+    NotAuthenticated,
+)
+
+from chat.api import reads
+from chat.api.reads import render
+from chat.views import ConversationViewSet, MessageViewSet
+
+"""
+    Async routes for the two hottest reads, GET /api/conversations/ and GET /api/messages/
+    (see chat.api.reads). They run on the event loop instead of holding a worker thread for the
+    whole request, the thread pool stays free for the websocket consumers.
+    Any other method goes to the DRF view.
+"""
+
+
+class AsyncTokenAuthentication(TokenAuthentication):
+    """
+    TokenAuthentication's header parsing, with the token looked up through the async ORM.
+    """
+
+    def authenticate_credentials(self, key):
+        return key
+
+    async def aauthenticate(self, request):
+        key = self.authenticate(request)
+        if key is None:
+            return None
+        try:
+            token = await Token.objects.select_related("user").aget(key=key)
+        except Token.DoesNotExist:
+            raise AuthenticationFailed(_("Invalid token."))
+        if not token.user.is_active:
+            raise AuthenticationFailed(_("User inactive or deleted."))
+        return token.user
+
+
+_authentication = AsyncTokenAuthentication()
+
+
+def async_read_view(sync_view):
+    """
+    Serve GET / HEAD with the decorated coroutine, authenticated like the DRF views and with
+    DRF shaped error responses. Every other method is handed to `sync_view`.
+    """
+
+    def decorator(view):
+        @csrf_exempt
+        @wraps(view)
+        async def wrapper(request):
+            if request.method not in ("GET", "HEAD"):
+                return await sync_to_async(sync_view)(request)
+            try:
+                user = await _authentication.aauthenticate(request)
+                if user is None:
+                    raise NotAuthenticated()
+                request.user = user
+                return await view(request)
+            except APIException as exc:
+                data = exc.detail
+                if not isinstance(data, (list, dict)):
+                    data = {"detail": data}
+                response = render(data, exc.status_code)
+                if isinstance(exc, (NotAuthenticated, AuthenticationFailed)):
+                    response["WWW-Authenticate"] = _authentication.authenticate_header(request)
+                return response
+
+        return wrapper
+
+    return decorator
+
+
+conversation_list = async_read_view(sync_view=ConversationViewSet.as_view({"get": "list"}))(
+    reads.conversation_list
+)
+message_list = async_read_view(sync_view=MessageViewSet.as_view({"get": "list"}))(
+    reads.message_list
+)
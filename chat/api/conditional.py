@@ -0,0 +1,33 @@
+import hashlib
+
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+
+"""
+    Conditional GET helpers. Views compute cheap validators (one small query on the
+    conversation summary) and answer 304 before doing any real query or serialization.
+"""
+
+
+def make_etag(*parts):
+    return quote_etag(hashlib.md5(":".join(str(part) for part in parts).encode()).hexdigest())
+
+
+def not_modified(request, etag, last_modified=None):
+    """
+    Returns a 304 response if the client's If-None-Match / If-Modified-Since still match, else None.
+    """
+    timestamp = int(last_modified.timestamp()) if last_modified else None
+    response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+    if response is not None:
+        set_validators(response, etag, last_modified)
+    return response
+
+
+def set_validators(response, etag, last_modified=None):
+    response["ETag"] = etag
+    if last_modified:
+        response["Last-Modified"] = http_date(last_modified.timestamp())
+    # per user data, and always revalidate so the 304 path is actually used
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
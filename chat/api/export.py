@@ -0,0 +1,133 @@
+import csv
+import json
+import zlib
+
+from rest_framework.fields import DateTimeField
+
+from chat.api.serializers import MESSAGE_FIELDS, message_row_data
+from chat.models import Message
+
+"""
+    Streaming export of a conversation's history.
+    Rows are read with .values_list() + .iterator() so the queryset cache is never filled
+    (on postgres this uses a server-side cursor), memory stays the same for 10 or 10 million messages.
+
+    Every format comes as a plain generator and as an async one. Under ASGI (daphne) a
+    StreamingHttpResponse built on a plain generator is read whole with sync_to_async(list)
+    before the first byte goes out, so the view hands it the async one there. That one reads
+    CHUNK_SIZE rows per query, keyed on the (time ordered) primary key through the
+    chat_msg_conv_id_idx index: .aiterator() would run a values_list query on the event loop.
+"""
+
+CHUNK_SIZE = 2000
+
+CSV_HEADER = ("id", "conversation", "from_user", "to_user", "content", "timestamp", "read")
+
+_timestamp_field = DateTimeField()
+
+
+def _message_rows(conversation):
+    return (
+        Message.objects.filter(conversation=conversation)
+        .order_by("id")
+        .values_list(*MESSAGE_FIELDS)
+    )
+
+
+def _ndjson_line(row):
+    return json.dumps(message_row_data(row)) + "\n"
+
+
+def ndjson_lines(conversation):
+    """
+    One json object per line, same shape as MessageSerializer.
+    """
+    for row in _message_rows(conversation).iterator(chunk_size=CHUNK_SIZE):
+        yield _ndjson_line(row)
+
+
+async def _amessage_rows(conversation):
+    rows = _message_rows(conversation)
+    chunk = [row async for row in rows[:CHUNK_SIZE]]
+    while chunk:
+        for row in chunk:
+            yield row
+        if len(chunk) < CHUNK_SIZE:
+            return
+        chunk = [row async for row in rows.filter(id__gt=chunk[-1][0])[:CHUNK_SIZE]]
+
+
+async def andjson_lines(conversation):
+    async for row in _amessage_rows(conversation):
+        yield _ndjson_line(row)
+
+
+class _Echo:
+    """
+    csv.writer wants a file, this one just hands the line back so we can yield it.
+    """
+
+    def write(self, value):
+        return value
+
+
+def _csv_line(writer, row):
+    pk, conversation_id, from_user, to_user, content, timestamp, read = row
+    return writer.writerow(
+        (
+            pk,
+            conversation_id,
+            from_user,
+            to_user,
+            content,
+            _timestamp_field.to_representation(timestamp),
+            read,
+        )
+    )
+
+
+def csv_lines(conversation):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(CSV_HEADER)
+    for row in _message_rows(conversation).iterator(chunk_size=CHUNK_SIZE):
+        yield _csv_line(writer, row)
+
+
+async def acsv_lines(conversation):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(CSV_HEADER)
+    async for row in _amessage_rows(conversation):
+        yield _csv_line(writer, row)
+
+
+def _gzip_compressor():
+    # wbits 16 + MAX_WBITS makes zlib write a gzip header/trailer
+    return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+def gzip_stream(lines):
+    """
+    Compress on the fly.
+    """
+    compressor = _gzip_compressor()
+    for line in lines:
+        data = compressor.compress(line.encode())
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+async def agzip_stream(lines):
+    compressor = _gzip_compressor()
+    async for line in lines:
+        data = compressor.compress(line.encode())
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+# output -> (lines, async lines, content type)
+EXPORT_FORMATS = {
+    "ndjson": (ndjson_lines, andjson_lines, "application/x-ndjson"),
+    "csv": (csv_lines, acsv_lines, "text/csv"),
+}
@@ -1,7 +1,15 @@
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.pagination import CursorPagination, PageNumberPagination
 
 
 class MessagePagination(PageNumberPagination):
     page_size = 10
     page_size_query_param = "page_size"
-    max_page_size = 100
\ No newline at end of file
+    max_page_size = 100
+
+
+class UserDirectoryPagination(CursorPagination):
+    page_size = 50
+    page_size_query_param = "page_size"
+    max_page_size = 200
+    # username is unique (and indexed) so it is a stable cursor by itself
+    ordering = "username"
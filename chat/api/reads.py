@@ -0,0 +1,166 @@
+from uuid import UUID
+
+from django.contrib.auth import get_user_model
+from django.core.paginator import InvalidPage
+from django.db.models import Count, Max
+from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+
+from chat import response_cache
+from chat.api.conditional import make_etag, not_modified, set_validators
+from chat.api.pagination import MessagePagination
+from chat.api.serializers import MESSAGE_FIELDS, conversation_data, message_rows_data
+from chat.models import Conversation, Message
+
+"""
+    The two hottest reads, GET /api/conversations/ and GET /api/messages/, written once against
+    the async ORM. chat.api.async_views awaits them on the event loop, ConversationViewSet.list
+    and MessageViewSet.list run them with async_to_sync, both answer the same bytes and share
+    the response cache entries.
+    `request` is the Django request, with request.user already authenticated. Bad query
+    parameters raise DRF exceptions, each caller renders them its own way.
+"""
+
+User = get_user_model()
+
+ALLOWED_METHODS = "GET, HEAD, OPTIONS"
+
+
+def render(data, status=200):
+    response = HttpResponse(
+        JSONRenderer().render(data), content_type="application/json", status=status
+    )
+    response["Allow"] = ALLOWED_METHODS
+    patch_vary_headers(response, ["Accept"])
+    return response
+
+
+async def paginated(request, queryset):
+    """
+    MessagePagination's page of `queryset` (values_list rows) as its response dict.
+    """
+    pagination = MessagePagination()
+    drf_request = Request(request)
+    page_size = pagination.get_page_size(drf_request)
+    # the count comes from one query, the paginator only does the page arithmetic
+    paginator = pagination.django_paginator_class(range(await queryset.acount()), page_size)
+    page_number = pagination.get_page_number(drf_request, paginator)
+    try:
+        page = paginator.page(page_number)
+    except InvalidPage as exc:
+        raise NotFound(
+            pagination.invalid_page_message.format(page_number=page_number, message=str(exc))
+        )
+    pagination.request, pagination.page = drf_request, page
+
+    offset = (page.number - 1) * paginator.per_page
+    rows = [row async for row in queryset[offset : offset + paginator.per_page]]
+    return {
+        "count": paginator.count,
+        "next": pagination.get_next_link(),
+        "previous": pagination.get_previous_link(),
+        "results": message_rows_data(rows),
+    }
+
+
+async def conversation_list(request):
+    """
+    GET /api/conversations/: the user's conversations, without the ones whose other
+    participant no longer exists.
+    """
+    username = request.user.username
+    queryset = Conversation.objects.involving(username)
+
+    validators = await queryset.aaggregate(count=Count("id"), latest=Max("updated_at"))
+    etag = make_etag("conversations", request.user.pk, validators["count"], validators["latest"])
+    last_modified = validators["latest"]
+    response = not_modified(request, etag, last_modified)
+    if response is not None:
+        return response
+
+    async def build():
+        conversations = [
+            conversation
+            async for conversation in queryset.select_related(
+                "last_message__from_user", "last_message__to_user"
+            )
+        ]
+        other_usernames = {
+            name
+            for conversation in conversations
+            for name in conversation.name.split("__")
+            if name != username
+        }
+        existing_usernames = {
+            name
+            async for name in User.objects.filter(username__in=other_usernames).values_list(
+                "username", flat=True
+            )
+        }
+        data = [
+            conversation_data(conversation, username, existing_usernames)
+            for conversation in conversations
+        ]
+        return [conversation for conversation in data if conversation["other_user"] is not None]
+
+    key = response_cache.response_key("conversations", request.user, etag)
+    data = await response_cache.aget_or_build(key, build)
+    return set_validators(render(data), etag, last_modified)
+
+
+async def message_list(request):
+    """
+    GET /api/messages/?conversation=<name>: one page of its history, newest first (ids are time
+    ordered), ?before=<message id> for the messages older than a given one.
+    Only the first page is cached, that's the one every chat screen opens with.
+    """
+    username = request.user.username
+    conversation_name = request.GET.get("conversation")
+
+    def messages():
+        queryset = (
+            Message.objects.filter(conversation__name__contains=username)
+            .filter(conversation__name=conversation_name)
+            .order_by("-id")
+        )
+        before = request.GET.get("before")
+        if before:
+            try:
+                queryset = queryset.filter(id__lt=UUID(before))
+            except ValueError:
+                raise ValidationError({"before": "Must be a message id."})
+        return queryset.values_list(*MESSAGE_FIELDS)
+
+    validators = (
+        await Conversation.objects.filter(name=conversation_name, name__contains=username)
+        .values("id", "updated_at")
+        .afirst()
+    )
+    if validators is None:
+        return render(await paginated(request, messages()))
+
+    etag = make_etag(
+        "messages",
+        request.user.pk,
+        validators["id"],
+        validators["updated_at"],
+        request.GET.urlencode(),
+    )
+    response = not_modified(request, etag, validators["updated_at"])
+    if response is not None:
+        return response
+
+    is_first_page = request.GET.get("page", "1") == "1" and "before" not in request.GET
+    if not is_first_page:
+        data = await paginated(request, messages())
+        return set_validators(render(data), etag, validators["updated_at"])
+
+    async def build():
+        return await paginated(request, messages())
+
+    key = response_cache.response_key("messages", request.user, etag)
+    data = await response_cache.aget_or_build(key, build)
+    return set_validators(render(data), etag, validators["updated_at"])
@@ -28,7 +28,89 @@ class MessageSerializer(serializers.ModelSerializer):
         )
 
     def get_conversation(self, obj):
-        return str(obj.conversation.id)
+        return str(obj.conversation_id)
+
+
+"""
+    Fast path for the hot reads and broadcasts: the same dicts MessageSerializer produces, built
+    by hand from .values_list() rows (or an already loaded message) without any DRF field objects.
+    Keep it in step with MessageSerializer, SerializerParityTests compares the two.
+"""
+
+MESSAGE_FIELDS = (
+    "id",
+    "conversation_id",
+    "from_user__username",
+    "to_user__username",
+    "content",
+    "timestamp",
+    "read",
+)
+
+_timestamp_field = serializers.DateTimeField()
+
+
+def _message_dict(pk, conversation_id, from_user, to_user, content, timestamp, read):
+    return {
+        "id": str(pk),
+        "conversation": str(conversation_id),
+        "from_user": {"username": from_user},
+        "to_user": {"username": to_user},
+        "content": content,
+        "timestamp": _timestamp_field.to_representation(timestamp),
+        "read": read,
+    }
+
+
+def message_row_data(row):
+    """
+    One row of queryset.values_list(*MESSAGE_FIELDS).
+    """
+    return _message_dict(*row)
+
+
+def message_rows_data(rows):
+    """
+    MessageSerializer(..., many=True).data for rows of queryset.values_list(*MESSAGE_FIELDS).
+    """
+    return [_message_dict(*row) for row in rows]
+
+
+def message_data(message):
+    """
+    MessageSerializer(message).data, from_user / to_user should already be loaded.
+    """
+    return _message_dict(
+        message.pk,
+        message.conversation_id,
+        message.from_user.username,
+        message.to_user.username,
+        message.content,
+        message.timestamp,
+        message.read,
+    )
+
+
+def conversation_data(conversation, username, existing_usernames):
+    """
+    ConversationSerializer(conversation, context={"existing_usernames": ...}).data as seen by
+    `username`, with last_message (and its users) already loaded.
+    """
+    other_username = next(
+        (name for name in conversation.name.split("__") if name != username), None
+    )
+    last = conversation.last_message
+    return {
+        "id": str(conversation.pk),
+        "name": conversation.name,
+        "other_user": (
+            {"username": other_username} if other_username in existing_usernames else None
+        ),
+        "last_message": message_data(last) if last is not None else None,
+        "last_message_preview": conversation.last_message_preview,
+        "last_message_at": _timestamp_field.to_representation(conversation.last_message_at),
+        "message_count": conversation.message_count,
+    }
 
 
 class ConversationSerializer(serializers.ModelSerializer):
@@ -37,7 +119,15 @@ class ConversationSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Conversation
-        fields = ("id", "name", "other_user", "last_message")
+        fields = (
+            "id",
+            "name",
+            "other_user",
+            "last_message",
+            "last_message_preview",
+            "last_message_at",
+            "message_count",
+        )
 
     def get_other_user(self, obj):
         # ✅ CRITICAL: Get request from context
@@ -57,6 +147,13 @@ class ConversationSerializer(serializers.ModelSerializer):
 
         other_username = other_usernames[0]
 
+        # list views look all the other users up at once, see chat.api.reads.conversation_list
+        existing_usernames = self.context.get("existing_usernames")
+        if existing_usernames is not None:
+            if other_username not in existing_usernames:
+                return None
+            return {"username": other_username}
+
         try:
             other_user = User.objects.get(username=other_username)
             return UserSerializer(other_user).data
@@ -66,10 +163,10 @@ class ConversationSerializer(serializers.ModelSerializer):
     def get_last_message(self, obj):
         last = getattr(obj, "last_message", None)
         if last is not None:
-            return MessageSerializer(last).data
+            return message_data(last)
         # Fallback to querying if field doesn't exist
-        last_msg = obj.messages.order_by("-timestamp").first()
-        return MessageSerializer(last_msg).data if last_msg else None
+        last_msg = obj.messages.order_by("-id").first()
+        return message_data(last_msg) if last_msg else None
 
 
 # from rest_framework import serializers
@@ -0,0 +1,151 @@
+import gzip
+import hashlib
+import hmac
+import json
+import os
+import re
+import time
+import uuid
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+"""
+    Opt-in recording of websocket sessions, replayed by `manage.py replay_traffic`.
+
+    With CHAT_CAPTURE_PATH set, TokenAuthMiddleware records every websocket session and writes it,
+    when the session ends, to <CHAT_CAPTURE_PATH>/<start>-<session>.ndjson.gz:
+
+        {"session": ..., "path": "/chats/u1f2e3d4c__u9a8b7c6d/", "user": "u1f2e3d4c", "started_at": ...}
+        [0.0, "connect"]
+        [3.1, "accept"]
+        [250.4, "in", {"type": "typing", "typing": true}]
+        [251.0, "out", "typing", 58]
+        [9000.2, "disconnect", 1001]
+
+    Offsets are ms since the session started. Usernames are replaced by stable pseudonyms (an hmac of
+    the name, so the same user keeps the same pseudonym across sessions), the token is dropped,
+    client frames keep their shape but not their text, and only the type and size of server frames
+    are kept.
+"""
+
+CAPTURE_PATH = getattr(settings, "CHAT_CAPTURE_PATH", None)
+# a very long session stops recording after this many events
+MAX_EVENTS = 20000
+
+PSEUDONYM_RE = re.compile(r"u[0-9a-f]{8}")
+_UUID_RE = re.compile(r"^[0-9a-fA-F]{8}-?([0-9a-fA-F]{4}-?){3}[0-9a-fA-F]{12}$")
+_CHAT_PATH_RE = re.compile(r"^/chats/([^/]+)/$")
+
+
+def pseudonym(username):
+    digest = hmac.new(settings.SECRET_KEY.encode(), username.encode(), hashlib.sha256)
+    return "u" + digest.hexdigest()[:8]
+
+
+def anonymize_path(path):
+    match = _CHAT_PATH_RE.match(path)
+    if match is None:
+        return path
+    participants = match.group(1).split("__")
+    return f"/chats/{'__'.join(pseudonym(name) for name in participants)}/"
+
+
+def _anonymize_value(value):
+    if isinstance(value, dict):
+        return {
+            key: item if key == "type" else _anonymize_value(item) for key, item in value.items()
+        }
+    if isinstance(value, list):
+        return [_anonymize_value(item) for item in value]
+    if isinstance(value, str) and not _UUID_RE.match(value):
+        # same length, so replayed frames weigh the same
+        return "x" * len(value)
+    return value
+
+
+def anonymize_frame(text):
+    try:
+        return _anonymize_value(json.loads(text))
+    except ValueError:
+        return None
+
+
+def _frame_type(text):
+    try:
+        return json.loads(text).get("type")
+    except (ValueError, AttributeError):
+        return None
+
+
+class SessionRecorder:
+    """
+    Wraps the ASGI receive / send of one websocket session and keeps its events in memory
+    until save().
+    """
+
+    def __init__(self, scope):
+        user = scope.get("user")
+        username = getattr(user, "username", "")
+        self.started = time.monotonic()
+        self.header = {
+            "session": uuid.uuid4().hex,
+            "path": anonymize_path(scope.get("path", "")),
+            "user": pseudonym(username) if username else None,
+            "started_at": time.time(),
+        }
+        self.events = []
+
+    def record(self, kind, *data):
+        if len(self.events) < MAX_EVENTS:
+            offset = round((time.monotonic() - self.started) * 1000, 1)
+            self.events.append([offset, kind, *data])
+
+    def wrap(self, receive, send):
+        async def recording_receive():
+            message = await receive()
+            if message["type"] == "websocket.connect":
+                self.record("connect")
+            elif message["type"] == "websocket.receive" and message.get("text") is not None:
+                self.record("in", anonymize_frame(message["text"]))
+            elif message["type"] == "websocket.disconnect":
+                self.record("disconnect", message.get("code"))
+            return message
+
+        async def recording_send(message):
+            if message["type"] == "websocket.accept":
+                self.record("accept")
+            elif message["type"] == "websocket.send":
+                text = message.get("text")
+                if text is not None:
+                    self.record("out", _frame_type(text), len(text.encode()))
+                else:
+                    self.record("out", None, len(message.get("bytes") or b""))
+            elif message["type"] == "websocket.close":
+                self.record("close", message.get("code"))
+            await send(message)
+
+        return recording_receive, recording_send
+
+    def write(self):
+        os.makedirs(CAPTURE_PATH, exist_ok=True)
+        started = time.strftime("%Y%m%d-%H%M%S", time.gmtime(self.header["started_at"]))
+        path = os.path.join(CAPTURE_PATH, f"{started}-{self.header['session']}.ndjson.gz")
+        with gzip.open(path, "wt") as capture:
+            capture.write(json.dumps(self.header) + "\n")
+            for event in self.events:
+                capture.write(json.dumps(event) + "\n")
+        return path
+
+    async def save(self):
+        await sync_to_async(self.write, thread_sensitive=False)()
+
+
+def read_session(path):
+    """
+    (header, events) of a capture file.
+    """
+    with gzip.open(path, "rt") as capture:
+        header = json.loads(capture.readline())
+        events = [json.loads(line) for line in capture if line.strip()]
+    return header, events
@@ -0,0 +1,369 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import socket
+import threading
+import time
+from datetime import datetime, timezone
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from chat import tracing
+
+"""
+    Registry of the websocket consumers connected to this process (by channel name).
+    Consumers register on connect and unregister on disconnect. For each one it keeps the user,
+    the groups it joined and its traffic, see TrackedConsumer.
+
+    Every process also listens on the REGISTRY_GROUP group of the channel layer and answers
+    report requests with its snapshot, so collect_reports() sees the connections of all workers.
+    The serve command uses the registry to drain the process before it exits.
+
+    Heartbeats: dead peers are left to the websocket protocol's own pings, which daphne sends
+    and times out (the serve command sets them to HEARTBEAT_INTERVAL / HEARTBEAT_TIMEOUT).
+    Every HEARTBEAT_INTERVAL seconds the process' reaper also sends each of its sockets an
+    advisory {"type": "ping"} frame. Clients may answer {"type": "pong"} (it only updates
+    last_seen), nothing is closed for not answering. Pongs are swallowed by TrackedConsumer
+    (they never reach the consumer) and neither frame counts as traffic. A chat socket without
+    traffic for IDLE_TIMEOUT seconds is closed and cleaned up like a normal disconnect.
+    Sockets that only wait for notifications (close_when_idle = False) are never closed for being
+    idle, after IDLE_MODE_AFTER quiet seconds they are sent a "server_idle" event instead.
+"""
+
+logger = logging.getLogger(__name__)
+
+REGISTRY_GROUP = "chat_registry"
+# how long collect_reports waits for the workers to answer
+REPORT_TIMEOUT = 0.5
+# group memberships expire in the channel layer (a day by default), rejoin well before that
+REJOIN_INTERVAL = 3600
+
+KICK_CLOSE_CODE = 4008
+IDLE_CLOSE_CODE = 4009
+
+HEARTBEAT_INTERVAL = getattr(settings, "CHAT_HEARTBEAT_INTERVAL", 25)
+HEARTBEAT_TIMEOUT = getattr(settings, "CHAT_HEARTBEAT_TIMEOUT", 30)
+IDLE_TIMEOUT = getattr(settings, "CHAT_IDLE_TIMEOUT", None)
+IDLE_MODE_AFTER = getattr(settings, "CHAT_IDLE_MODE_AFTER", 120)
+
+PING = json.dumps({"type": "ping"})
+
+WORKER = f"{socket.gethostname()}:{os.getpid()}"
+
+_lock = threading.Lock()
+_channels = {}
+# channel name -> (the socket's ASGI send, close_when_idle), for the reaper
+_sockets = {}
+_listener = None
+_reaper = None
+
+
+def register(consumer):
+    user = consumer.scope.get("user")
+    now = time.time()
+    with _lock:
+        _channels[consumer.channel_name] = {
+            "consumer": type(consumer).__name__,
+            "user": getattr(user, "username", None),
+            "path": consumer.scope.get("path"),
+            "groups": set(),
+            "connected_at": now,
+            "last_activity": now,
+            "last_seen": now,
+            "idle": False,
+            "messages_in": 0,
+            "messages_out": 0,
+            "bytes_in": 0,
+            "bytes_out": 0,
+        }
+        _sockets[consumer.channel_name] = (consumer.raw_send, consumer.close_when_idle)
+
+
+def unregister(consumer):
+    channel_name = getattr(consumer, "channel_name", None)
+    with _lock:
+        _channels.pop(channel_name, None)
+        _sockets.pop(channel_name, None)
+
+
+def joined(consumer, group):
+    with _lock:
+        connection = _channels.get(consumer.channel_name)
+        if connection is not None:
+            connection["groups"].add(group)
+
+
+def channel_names():
+    with _lock:
+        return list(_channels)
+
+
+def _record(channel_name, direction, size):
+    with _lock:
+        connection = _channels.get(channel_name)
+        if connection is not None:
+            connection[f"messages_{direction}"] += 1
+            connection[f"bytes_{direction}"] += size
+            connection["last_activity"] = time.time()
+            if direction == "in":
+                connection["last_seen"] = connection["last_activity"]
+
+
+def _seen(channel_name):
+    with _lock:
+        connection = _channels.get(channel_name)
+        if connection is not None:
+            connection["last_seen"] = time.time()
+
+
+def _is_pong(text_data):
+    return (
+        text_data is not None
+        and len(text_data) < 32
+        and text_data.replace(" ", "") == '{"type":"pong"}'
+    )
+
+
+def _frame_size(text_data=None, bytes_data=None):
+    if text_data is not None:
+        return len(text_data.encode())
+    return len(bytes_data or b"")
+
+
+def _backlog(channel_layer, channel_name):
+    """
+    Events waiting for this consumer in the layer's local queues (in memory layer: all of them,
+    redis layer: the ones already pulled from redis).
+    """
+    for attribute in ("channels", "receive_buffer"):
+        queues = getattr(channel_layer, attribute, None)
+        if isinstance(queues, dict) and channel_name in queues:
+            return getattr(queues[channel_name], "qsize", lambda: 0)()
+    return 0
+
+
+def _isoformat(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat()
+
+
+def snapshot(traces=False):
+    """
+    The connections of this process (biggest backlog first) and its delivery latency histogram,
+    plus the recent traces if asked.
+    """
+    channel_layer = get_channel_layer()
+    with _lock:
+        connections = [
+            {
+                "channel_name": channel_name,
+                **connection,
+                "groups": sorted(connection["groups"]),
+                "connected_at": _isoformat(connection["connected_at"]),
+                "last_activity": _isoformat(connection["last_activity"]),
+                "last_seen": _isoformat(connection["last_seen"]),
+            }
+            for channel_name, connection in _channels.items()
+        ]
+    for connection in connections:
+        connection["backlog"] = _backlog(channel_layer, connection["channel_name"])
+    connections.sort(key=lambda connection: -connection["backlog"])
+    report = {"worker": WORKER, "connections": connections, "latency": tracing.histogram()}
+    if traces:
+        report["traces"] = tracing.recent()
+    return report
+
+
+def ensure_listener():
+    """
+    Start this process' registry listener, called from the event loop when a consumer starts.
+    """
+    global _listener
+    loop = asyncio.get_running_loop()
+    if _listener is None or _listener.done() or _listener.get_loop() is not loop:
+        _listener = loop.create_task(_listen())
+
+
+async def _listen():
+    channel_layer = get_channel_layer()
+    channel_name = await channel_layer.new_channel("registry.")
+    await channel_layer.group_add(REGISTRY_GROUP, channel_name)
+    while True:
+        try:
+            message = await asyncio.wait_for(channel_layer.receive(channel_name), REJOIN_INTERVAL)
+        except asyncio.TimeoutError:
+            await channel_layer.group_add(REGISTRY_GROUP, channel_name)
+            continue
+        if message.get("type") == "registry.report":
+            await channel_layer.send(
+                message["reply_to"],
+                {"type": "registry.snapshot", **snapshot(traces=message.get("traces", False))},
+            )
+
+
+def ensure_reaper():
+    """
+    Start this process' heartbeat task (see the module docstring), unless heartbeats are off.
+    """
+    global _reaper
+    if not HEARTBEAT_INTERVAL:
+        return
+    loop = asyncio.get_running_loop()
+    if _reaper is None or _reaper.done() or _reaper.get_loop() is not loop:
+        _reaper = loop.create_task(_reap_forever())
+
+
+async def _reap_forever():
+    while True:
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+        await reap()
+
+
+async def reap():
+    """
+    One heartbeat round over the sockets of this process: close the idle ones, send the quiet
+    notification sockets to idle mode and ping everything else.
+    A socket that fails (closed under us, channel layer error) is logged and skipped.
+    """
+    channel_layer = get_channel_layer()
+    now = time.time()
+    with _lock:
+        sockets = [
+            (channel_name, send, close_when_idle, dict(_channels[channel_name]))
+            for channel_name, (send, close_when_idle) in _sockets.items()
+            if channel_name in _channels
+        ]
+
+    for channel_name, send, close_when_idle, connection in sockets:
+        try:
+            await _reap_socket(channel_layer, now, channel_name, send, close_when_idle, connection)
+        except Exception:
+            logger.exception("Heartbeat failed for %s", channel_name)
+
+
+async def _reap_socket(channel_layer, now, channel_name, send, close_when_idle, connection):
+    quiet = now - connection["last_activity"]
+    if close_when_idle and IDLE_TIMEOUT and quiet > IDLE_TIMEOUT:
+        await channel_layer.send(channel_name, {"type": "server_reap", "code": IDLE_CLOSE_CODE})
+        return
+    if not close_when_idle and not connection["idle"] and quiet > IDLE_MODE_AFTER:
+        with _lock:
+            if channel_name in _channels:
+                _channels[channel_name]["idle"] = True
+        await channel_layer.send(channel_name, {"type": "server_idle"})
+    # straight to the socket, the consumer isn't woken up for it
+    await send({"type": "websocket.send", "text": PING})
+
+
+async def collect_reports(timeout=REPORT_TIMEOUT, traces=False):
+    """
+    Ask every worker for its snapshot. Workers are not counted anywhere,
+    so this simply gathers the answers that arrive within `timeout` seconds.
+    """
+    channel_layer = get_channel_layer()
+    reply_to = await channel_layer.new_channel("registry-reply.")
+    await channel_layer.group_send(
+        REGISTRY_GROUP, {"type": "registry.report", "reply_to": reply_to, "traces": traces}
+    )
+
+    reports = []
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while (remaining := deadline - loop.time()) > 0:
+        try:
+            message = await asyncio.wait_for(channel_layer.receive(reply_to), remaining)
+        except asyncio.TimeoutError:
+            break
+        message.pop("type", None)
+        reports.append(message)
+    return sorted(reports, key=lambda report: report["worker"])
+
+
+async def kick(channels):
+    """
+    Close the given connections right away, wherever they are.
+    """
+    channel_layer = get_channel_layer()
+    for channel_name in channels:
+        await channel_layer.send(channel_name, {"type": "server_kick"})
+
+
+async def drain(window, channels=None):
+    """
+    Close every connection (or just `channels`) at a random moment within `window` seconds.
+    Each one is told to wait a random `retry_after` before reconnecting, so a restart
+    doesn't bring the whole user base back in the same second.
+    """
+    channel_layer = get_channel_layer()
+    channels = list(channels if channels is not None else channel_names())
+    random.shuffle(channels)
+    delays = sorted(random.uniform(0, window) for _ in channels)
+
+    elapsed = 0
+    for channel_name, delay in zip(channels, delays):
+        await asyncio.sleep(delay - elapsed)
+        elapsed = delay
+        await channel_layer.send(
+            channel_name,
+            {"type": "server_drain", "retry_after": round(random.uniform(1, max(window, 1)), 1)},
+        )
+
+
+class TrackedConsumer:
+    """
+    Mixin for the websocket consumers: counts the frames / bytes going through the socket,
+    answers for the heartbeats and handles kicks and reaping.
+    The consumer still calls register / unregister / joined itself.
+    """
+
+    # False: never closed for being idle, goes to idle mode instead (see server_idle)
+    close_when_idle = True
+
+    async def __call__(self, scope, receive, send):
+        ensure_listener()
+        ensure_reaper()
+        self.raw_send = send
+
+        async def tracked_receive():
+            while True:
+                message = await receive()
+                if message["type"] != "websocket.receive":
+                    return message
+                if _is_pong(message.get("text")):
+                    _seen(self.channel_name)
+                    continue
+                size = _frame_size(message.get("text"), message.get("bytes"))
+                _record(self.channel_name, "in", size)
+                return message
+
+        async def tracked_send(message):
+            if message["type"] == "websocket.send":
+                size = _frame_size(message.get("text"), message.get("bytes"))
+                _record(self.channel_name, "out", size)
+            await send(message)
+
+        return await super().__call__(scope, tracked_receive, tracked_send)
+
+    def server_kick(self, event):
+        self.send_json({"type": "kicked"})
+        self.close(code=KICK_CLOSE_CODE)
+
+    def server_reap(self, event):
+        """
+        Idle: close, and clean up right away rather than wait for a disconnect
+        that a half-open connection may never deliver.
+        """
+        self.close(code=event["code"])
+        self.websocket_disconnect({"type": "websocket.disconnect", "code": event["code"]})
+
+
+class AsyncTrackedConsumer(TrackedConsumer):
+    async def server_kick(self, event):
+        await self.send_json({"type": "kicked"})
+        await self.close(code=KICK_CLOSE_CODE)
+
+    async def server_reap(self, event):
+        await self.close(code=event["code"])
+        await self.websocket_disconnect({"type": "websocket.disconnect", "code": event["code"]})
@@ -1,9 +1,16 @@
-from channels.generic.websocket import AsyncWebsocketConsumer, JsonWebsocketConsumer
-from asgiref.sync import async_to_sync
-from chat.models import Conversation, Message
+from channels.generic.websocket import AsyncJsonWebsocketConsumer, JsonWebsocketConsumer
+from channels.db import database_sync_to_async
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F
+from rest_framework.fields import DateTimeField
+from chat.models import PREVIEW_LENGTH, Conversation, Message
 from django.contrib.auth import get_user_model
 from chat.middleware import get_user
-from chat.api.serializers import MessageSerializer
+from chat.api.serializers import MESSAGE_FIELDS, message_data, message_rows_data
+from chat import connections, outbox, response_cache, tracing
 
 """
     Group add , group_send is a async function so if we want to use it for jsonwebsconsumer we have to use asynctosync (wraps the function you want to call).
@@ -11,10 +18,34 @@ from chat.api.serializers import MessageSerializer
 
 User = get_user_model()
 
+# seconds new-message notifications for one user are collected into a single digest
+NOTIFICATION_WINDOW = getattr(settings, "CHAT_NOTIFICATION_WINDOW", 1.0)
+# conversations listed in a digest
+DIGEST_CONVERSATIONS = 20
+# seconds the ack of a client message id is remembered, resends within it skip the database
+CLIENT_ID_TTL = getattr(settings, "CHAT_CLIENT_ID_TTL", 300)
+# messages per load_history page: the default and the most a client may ask for
+HISTORY_PAGE_SIZE = 50
+MAX_HISTORY_PAGE_SIZE = 100
+# load_history pages a chat socket keeps, until the conversation changes
+HISTORY_CACHE_PAGES = 20
+
+import asyncio
 import json
+import math
+from collections import OrderedDict
+from urllib.parse import parse_qs
 from uuid import UUID
 
 
+def notification_gate_key(username):
+    """
+    Set while a notification window of `username` is open, so only its first message is sent
+    on to NotificationConsumer.
+    """
+    return f"chat:notify:{username}"
+
+
 class UUIDEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, UUID):
@@ -23,7 +54,7 @@ class UUIDEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
-class chatConsumer(JsonWebsocketConsumer):
+class chatConsumer(connections.TrackedConsumer, JsonWebsocketConsumer):
 
     def connect(self):
         user = self.scope["user"]
@@ -47,14 +78,19 @@ class chatConsumer(JsonWebsocketConsumer):
         self.conversation = conversation
         self.conversation_name = normalized_name
         self.user = user
+        # load_history pages of this socket, for one version of the conversation
+        self.history_cache = OrderedDict()
+        self.history_version = None
 
         self.accept()
+        connections.register(self)
 
         # Add user to the conversation's channel group
         async_to_sync(self.channel_layer.group_add)(
             normalized_name,
             self.channel_name,
         )
+        connections.joined(self, normalized_name)
 
         self.send_json(
             {
@@ -78,12 +114,12 @@ class chatConsumer(JsonWebsocketConsumer):
         self.send_json({"type": "welcome_message", "message": "You are connected."})
 
         # Send message history
-        messages = self.conversation.messages.all().order_by("-timestamp")[0:50]
+        messages = self.conversation.messages.order_by("-id").values_list(*MESSAGE_FIELDS)[0:50]
         message_count = self.conversation.messages.count()
         self.send_json(
             {
                 "type": "last_50_messages",
-                "messages": MessageSerializer(messages, many=True).data,
+                "messages": message_rows_data(messages),
                 "has_more": message_count > 50,
             }
         )
@@ -102,6 +138,7 @@ class chatConsumer(JsonWebsocketConsumer):
 
     def disconnect(self, code):
         # This method is called automatically when the websocket closes
+        connections.unregister(self)
         if hasattr(self, "user") and self.user.is_authenticated:
             # Notify other users in the conversation
             async_to_sync(self.channel_layer.group_send)(
@@ -128,7 +165,7 @@ class chatConsumer(JsonWebsocketConsumer):
         """
         message_type = content.get("type")
         user = self.scope["user"]
-        conversation_name = self.scope["url_route"]["kwargs"]["conversation_name"]
+        conversation_name = self.conversation_name
 
         if message_type == "typing":
             async_to_sync(self.channel_layer.group_send)(
@@ -141,9 +178,8 @@ class chatConsumer(JsonWebsocketConsumer):
             )
 
         if message_type == "chat_message":
-            conversation, created = Conversation.objects.get_or_create(
-                name=conversation_name
-            )
+            trace = tracing.start()
+            conversation = self.conversation
 
             # Find the receiver
             usernames = conversation_name.split("__")
@@ -152,40 +188,91 @@ class chatConsumer(JsonWebsocketConsumer):
             )
             receiver = User.objects.get(username=receiver_username)
 
+            # A client may tag the message with its own id and send the next one without
+            # waiting for the echo, a resend of the same id is acked again but not stored twice.
+            client_id = content.get("client_id")
+            if client_id is not None:
+                client_id = str(client_id)[:64]
+                seen_key = f"chat:client-id:{user.pk}:{client_id}"
+                ack = cache.get(seen_key)
+                if ack is not None:
+                    self.send_json({**ack, "duplicate": True})
+                    return
+
             # Create the message
-            message = Message.objects.create(
-                from_user=user,
-                to_user=receiver,
-                content=content["message"],
-                conversation=conversation,
-            )
-            conversation.last_message = message
-            conversation.save()
+            try:
+                with transaction.atomic():
+                    message = Message.objects.create(
+                        from_user=user,
+                        to_user=receiver,
+                        content=content["message"],
+                        conversation=conversation,
+                        client_id=client_id,
+                    )
+            except IntegrityError:
+                if client_id is None:
+                    raise
+                # stored before, but the seen-set has forgotten it
+                message = Message.objects.get(from_user=user, client_id=client_id)
+                self.send_json({**self.message_ack(message), "duplicate": True})
+                return
+            tracing.mark(trace, "db_write")
+
+            if client_id is not None:
+                ack = self.message_ack(message)
+                cache.set(seen_key, ack, CLIENT_ID_TTL)
+                self.send_json({**ack, "duplicate": False})
+
+            serialized_message = message_data(message)
             # Broadcast the new message to the channel group
+            tracing.mark(trace, "publish")
             async_to_sync(self.channel_layer.group_send)(
                 conversation_name,
                 {
                     "type": "chat_message_echo",
                     "name": user.username,
-                    "message": MessageSerializer(message).data,
+                    "message": serialized_message,
+                    "trace": trace,
                 },
             )
             print(f"Broadcasting message to conversation: {conversation_name}")
 
-            # Send notification to receiver
+            # Notify the receiver, unless they have this chat open (they got the echo),
+            # and at most once per window: NotificationConsumer turns it into one digest
+            # that covers every message of the window.
+            receiver_is_here = conversation.online.filter(pk=receiver.pk).exists()
             notification_group_name = receiver.username + "__notifications"
-            async_to_sync(self.channel_layer.group_send)(
-                notification_group_name,
-                {
-                    "type": "new_message_notification",
-                    "name": user.username,
-                    "message": MessageSerializer(message).data,
-                },
-            )
+            if not receiver_is_here:
+                # kept until the receiver's client acks it, even if no socket of theirs is open
+                outbox.append(
+                    receiver.username,
+                    {
+                        "type": "new_message",
+                        "conversation": conversation_name,
+                        "from_user": user.username,
+                        "message_id": str(message.id),
+                        "preview": message.content[:PREVIEW_LENGTH],
+                        "timestamp": serialized_message["timestamp"],
+                    },
+                )
+                # whole seconds for the backends that want them, the flush deletes it anyway
+                if cache.add(
+                    notification_gate_key(receiver.username), True, math.ceil(NOTIFICATION_WINDOW)
+                ):
+                    async_to_sync(self.channel_layer.group_send)(
+                        notification_group_name,
+                        {
+                            "type": "new_message_notification",
+                            "name": user.username,
+                            "conversation": conversation_name,
+                        },
+                    )
+
+        if message_type == "load_history":
+            self.send_json(self.history_page(content.get("before"), content.get("page_size")))
 
         if message_type == "read_messages":
-            messages_to_me = self.conversation.messages.filter(to_user=self.user)
-            messages_to_me.update(read=True)
+            self.conversation.mark_read(self.user)
 
             # Update the unread message count
             unread_count = Message.objects.filter(to_user=self.user, read=False).count()
@@ -197,11 +284,71 @@ class chatConsumer(JsonWebsocketConsumer):
                 },
             )
 
+    def history_page(self, before=None, page_size=None):
+        """
+        The `page_size` messages before the message id `before` (newest first), or the newest
+        ones without it: the socket's answer to {"type": "load_history", ...}.
+        Pages are kept per socket and dropped as soon as the conversation changes (a new,
+        read or deleted message bumps its version, see chat.response_cache).
+        """
+        try:
+            page_size = min(max(int(page_size or HISTORY_PAGE_SIZE), 1), MAX_HISTORY_PAGE_SIZE)
+        except (TypeError, ValueError):
+            page_size = HISTORY_PAGE_SIZE
+        try:
+            before = str(UUID(str(before))) if before else None
+        except ValueError:
+            return {
+                "type": "load_history_error",
+                "before": before,
+                "detail": "Must be a message id.",
+            }
+
+        version = response_cache.conversation_version(self.conversation.pk)
+        if version != self.history_version:
+            self.history_cache.clear()
+            self.history_version = version
+        key = (before, page_size)
+        if key in self.history_cache:
+            self.history_cache.move_to_end(key)
+            return self.history_cache[key]
+
+        messages = self.conversation.messages.order_by("-id")
+        if before:
+            messages = messages.filter(id__lt=before)
+        # one more row than asked tells whether there is a page after this one
+        rows = list(messages.values_list(*MESSAGE_FIELDS)[: page_size + 1])
+        page = {
+            "type": "history_page",
+            "before": before,
+            "messages": message_rows_data(rows[:page_size]),
+            "has_more": len(rows) > page_size,
+        }
+        self.history_cache[key] = page
+        if len(self.history_cache) > HISTORY_CACHE_PAGES:
+            self.history_cache.popitem(last=False)
+        return page
+
+    def message_ack(self, message):
+        """
+        The small frame that tells the sender its message is stored, before the full echo.
+        """
+        return {
+            "type": "chat_message_ack",
+            "client_id": message.client_id,
+            "id": str(message.id),
+            "timestamp": DateTimeField().to_representation(message.timestamp),
+        }
+
     def chat_message_echo(self, event):
         """
         Handler for messages broadcast to the group. Sends the message to the client.
         """
+        trace = event.pop("trace", None)
+        tracing.mark(trace, "dispatch")
         self.send_json(event)
+        tracing.mark(trace, "send")
+        tracing.finish(trace, self.channel_name)
 
     @classmethod
     def encode_json(cls, content):
@@ -232,45 +379,149 @@ class chatConsumer(JsonWebsocketConsumer):
     def typing(self, event):
         self.send_json(event)
 
+    def server_drain(self, event):
+        """
+        Sent by connections.drain when this worker is shutting down.
+        4012 = our "service restart" (daphne only allows 1000 or 3000-4999),
+        retry_after tells the client how long to wait before reconnecting.
+        """
+        self.send_json({"type": "server_restart", "retry_after": event["retry_after"]})
+        self.close(code=4012)
+
+
+class NotificationConsumer(connections.AsyncTrackedConsumer, AsyncJsonWebsocketConsumer):
+    """
+    Async so it can batch: new_message_notification events are not forwarded one by one,
+    they start a short window (CHAT_NOTIFICATION_WINDOW) after which a single
+    new_message_digest frame with the fresh unread counts is sent.
+    """
+
+    # waiting for notifications is what these sockets are for, see server_idle
+    close_when_idle = False
 
-class NotificationConsumer(JsonWebsocketConsumer):
     def __init__(self, *args, **kwargs):
-        super().__init__(args, kwargs)
+        super().__init__(*args, **kwargs)
         self.user = None
         self.notification_group_name = None
+        self.flush_task = None
 
-    def connect(self):
+    async def connect(self):
         self.user = self.scope["user"]
         if not self.user.is_authenticated:
             return
 
-        self.accept()
+        await self.accept()
+        connections.register(self)
 
         # Private notification group
         self.notification_group_name = self.user.username + "__notifications"
-        async_to_sync(self.channel_layer.group_add)(
+        await self.channel_layer.group_add(
             self.notification_group_name,
             self.channel_name,
         )
+        connections.joined(self, self.notification_group_name)
 
         # Send count of unread messages
-        unread_count = Message.objects.filter(to_user=self.user, read=False).count()
-        self.send_json(
+        unread_count = await database_sync_to_async(self.get_unread_count)()
+        await self.send_json(
             {
                 "type": "unread_count",
                 "unread_count": unread_count,
             }
         )
 
-    def disconnect(self, code):
-        async_to_sync(self.channel_layer.group_discard)(
-            self.notification_group_name,
-            self.channel_name,
-        )
-        return super().disconnect(code)
+        # What arrived in the outbox since the client's last cursor (all of it without one)
+        cursor = parse_qs(self.scope["query_string"].decode()).get("cursor", [None])[0]
+        if not outbox.valid_cursor(cursor):
+            cursor = None
+        missed = await sync_to_async(outbox.read)(self.user.username, cursor)
+        if missed:
+            await self.send_json(
+                {
+                    "type": "missed_notifications",
+                    "cursor": missed[-1][0],
+                    "events": [{"cursor": cursor, **event} for cursor, event in missed],
+                }
+            )
 
-    def new_message_notification(self, event):
-        self.send_json(event)
+    async def receive_json(self, content, **kwargs):
+        # {"type": "ack", "cursor": ...}: the client has everything up to that cursor
+        if content.get("type") == "ack" and outbox.valid_cursor(content.get("cursor")):
+            await sync_to_async(outbox.trim)(self.user.username, content["cursor"])
+
+    async def disconnect(self, code):
+        connections.unregister(self)
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+        if self.notification_group_name:
+            await self.channel_layer.group_discard(
+                self.notification_group_name,
+                self.channel_name,
+            )
 
-    def unread_count(self, event):
-        self.send_json(event)
+    def get_unread_count(self):
+        return Message.objects.filter(to_user=self.user, read=False).count()
+
+    def get_digest(self):
+        """
+        Unread count per conversation (most recent first) plus the summary of each one.
+        """
+        unread = (
+            Message.objects.filter(to_user=self.user, read=False)
+            .values("conversation")
+            .annotate(unread_count=Count("id"))
+        )
+        unread_by_conversation = {row["conversation"]: row["unread_count"] for row in unread}
+        conversations = Conversation.objects.filter(
+            pk__in=unread_by_conversation
+        ).order_by(F("last_message_at").desc(nulls_last=True))[:DIGEST_CONVERSATIONS]
+        timestamp_field = DateTimeField()
+        return {
+            "type": "new_message_digest",
+            "unread_count": sum(unread_by_conversation.values()),
+            # ack it to drop the notifications this digest covers from the outbox
+            "cursor": outbox.last_cursor(self.user.username),
+            "conversations": [
+                {
+                    "name": conversation.name,
+                    "unread_count": unread_by_conversation[conversation.pk],
+                    "last_message_preview": conversation.last_message_preview,
+                    "last_message_at": timestamp_field.to_representation(
+                        conversation.last_message_at
+                    ),
+                }
+                for conversation in conversations
+            ],
+        }
+
+    async def new_message_notification(self, event):
+        # the first notification opens the window, the ones after it are folded into the same digest
+        if self.flush_task is None:
+            self.flush_task = asyncio.ensure_future(self.flush_digest())
+
+    async def flush_digest(self):
+        await asyncio.sleep(NOTIFICATION_WINDOW)
+        self.flush_task = None
+        # reopen the gate: the next message after this point starts a new window
+        await cache.adelete(notification_gate_key(self.user.username))
+        digest = await database_sync_to_async(self.get_digest)()
+        await self.send_json(digest)
+
+    async def unread_count(self, event):
+        await self.send_json(event)
+
+    async def server_drain(self, event):
+        await self.send_json({"type": "server_restart", "retry_after": event["retry_after"]})
+        await self.close(code=4012)
+
+    async def server_idle(self, event):
+        """
+        Sent by the reaper once the socket has been quiet for CHAT_IDLE_MODE_AFTER seconds:
+        drop what only the handshake needed, the consumer runs on self.user and its group.
+        """
+        headers = self.scope.get("headers")
+        if isinstance(headers, list):
+            # the routers above share the list, clearing it frees it for all of them
+            headers.clear()
+        for key in ("headers", "cookies", "session", "query_string"):
+            self.scope.pop(key, None)
@@ -0,0 +1,196 @@
+import asyncio
+import random
+import string
+import time
+from collections import deque
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+"""
+    In-process channel layer for single node installs (one worker process), a faster stand-in for
+    channels' InMemoryChannelLayer:
+
+        CHANNEL_LAYERS = {"default": {"BACKEND": "chat.layers.LocalChannelLayer"}}
+
+    - a receiver that is already waiting gets the message handed to it directly, nothing is queued
+    - group_send delivers straight into every member's channel, with a plain dict / list copy per
+      member instead of a deepcopy (messages are msgpack-able data, there is nothing else to copy)
+    - each channel holds at most `capacity` messages (ChannelFull, group_send skips full ones),
+      a message waiting longer than `expiry` seconds is dropped and its channel leaves its groups
+    - expiry is checked on the channel being used, plus one sweep over everything every `expiry`
+      seconds, instead of a scan of all channels on every receive
+
+    All of it lives in this process and on one event loop: other processes (a second worker,
+    a management command) can't reach these channels, use RedisChannelLayer for those.
+"""
+
+
+def _copy(value):
+    if isinstance(value, dict):
+        return {key: _copy(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_copy(item) for item in value]
+    if isinstance(value, tuple):
+        return tuple(_copy(item) for item in value)
+    return value
+
+
+class _Channel:
+    __slots__ = ("messages", "waiters")
+
+    def __init__(self):
+        # (expires_at, message), oldest first
+        self.messages = deque()
+        self.waiters = deque()
+
+    def qsize(self):
+        return len(self.messages)
+
+
+class LocalChannelLayer(BaseChannelLayer):
+    extensions = ["groups", "flush"]
+
+    def __init__(
+        self, expiry=60, group_expiry=86400, capacity=100, channel_capacity=None, **kwargs
+    ):
+        super().__init__(
+            expiry=expiry, capacity=capacity, channel_capacity=channel_capacity, **kwargs
+        )
+        self.group_expiry = group_expiry
+        self.channels = {}
+        self.groups = {}
+        self.next_sweep = time.time() + expiry
+
+    async def new_channel(self, prefix="specific."):
+        return "%s.local!%s" % (
+            prefix,
+            "".join(random.choice(string.ascii_letters) for _ in range(12)),
+        )
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        self.require_valid_channel_name(channel)
+        assert "__asgi_channel__" not in message
+        now = time.time()
+        self._sweep(now)
+        self._deliver(channel, _copy(message), now)
+
+    async def receive(self, channel):
+        self.require_valid_channel_name(channel)
+        now = time.time()
+        self._sweep(now)
+        queue = self.channels.get(channel)
+        if queue is None:
+            queue = self.channels[channel] = _Channel()
+        self._expire(channel, queue, now)
+        if queue.messages:
+            message = queue.messages.popleft()[1]
+            self._forget_if_unused(channel, queue)
+            return message
+
+        waiter = asyncio.get_running_loop().create_future()
+        queue.waiters.append(waiter)
+        try:
+            return await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # handed over just before the cancel, keep it for the next receive
+                queue.messages.appendleft((time.time() + self.expiry, waiter.result()))
+            else:
+                try:
+                    queue.waiters.remove(waiter)
+                except ValueError:
+                    pass
+            raise
+        finally:
+            self._forget_if_unused(channel, queue)
+
+    def _deliver(self, channel, message, now):
+        queue = self.channels.get(channel)
+        if queue is None:
+            queue = self.channels[channel] = _Channel()
+        while queue.waiters:
+            waiter = queue.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(message)
+                return
+        self._expire(channel, queue, now)
+        if len(queue.messages) >= self.get_capacity(channel):
+            raise ChannelFull(channel)
+        queue.messages.append((now + self.expiry, message))
+
+    def _forget_if_unused(self, channel, queue):
+        if not queue.messages and not queue.waiters and self.channels.get(channel) is queue:
+            del self.channels[channel]
+
+    # Expiry
+
+    def _expire(self, channel, queue, now):
+        expired = False
+        while queue.messages and queue.messages[0][0] < now:
+            queue.messages.popleft()
+            expired = True
+        if expired:
+            # nobody reads this channel any more
+            for members in self.groups.values():
+                members.pop(channel, None)
+
+    def _sweep(self, now):
+        if now < self.next_sweep:
+            return
+        self.next_sweep = now + self.expiry
+        for channel, queue in list(self.channels.items()):
+            self._expire(channel, queue, now)
+            self._forget_if_unused(channel, queue)
+        joined_before = now - self.group_expiry
+        for group, members in list(self.groups.items()):
+            for channel, joined_at in list(members.items()):
+                if joined_at < joined_before:
+                    del members[channel]
+            if not members:
+                del self.groups[group]
+
+    # Groups extension
+
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        self.groups.setdefault(group, {})[channel] = time.time()
+
+    async def group_discard(self, group, channel):
+        self.require_valid_channel_name(channel)
+        self.require_valid_group_name(group)
+        members = self.groups.get(group)
+        if members:
+            members.pop(channel, None)
+            if not members:
+                del self.groups[group]
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "message is not a dict"
+        self.require_valid_group_name(group)
+        members = self.groups.get(group)
+        if not members:
+            return
+        now = time.time()
+        self._sweep(now)
+        for channel in list(members):
+            try:
+                self._deliver(channel, _copy(message), now)
+            except ChannelFull:
+                pass
+
+    # Flush extension
+
+    async def flush(self):
+        # receivers already waiting keep waiting
+        self.channels = {
+            channel: queue for channel, queue in self.channels.items() if queue.waiters
+        }
+        for queue in self.channels.values():
+            queue.messages.clear()
+        self.groups = {}
+
+    async def close(self):
+        pass
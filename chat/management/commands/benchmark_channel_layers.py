@@ -0,0 +1,165 @@
+import asyncio
+import time
+
+from asgiref.sync import async_to_sync
+from django.core.management.base import BaseCommand
+from django.utils.module_loading import import_string
+
+from chat.management.commands.replay_traffic import percentiles
+
+BACKENDS = {
+    "local": "chat.layers.LocalChannelLayer",
+    "in-memory": "channels.layers.InMemoryChannelLayer",
+    "redis": "channels_redis.core.RedisChannelLayer",
+}
+
+# seconds a backend gets for each of the two runs
+TIMEOUT = 60
+
+# an echo as chatConsumer broadcasts it
+MESSAGE = {
+    "type": "chat_message_echo",
+    "name": "alice",
+    "message": {
+        "id": "01a15437-c2e6-724b-a2ba-bfbf3f7d2927",
+        "conversation": "01a15437-c2c8-7345-b2c7-e1383375b391",
+        "from_user": {"username": "alice"},
+        "to_user": {"username": "bob"},
+        "content": "benchmark message",
+        "timestamp": "2026-01-01T00:00:00.000000Z",
+        "read": False,
+    },
+    "trace": None,
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Time channel layer backends on the two patterns the consumers use: send / receive "
+        "between two channels (round trips) and group_send to every socket of a conversation "
+        "(fan-out, until the last member has it). Redis is skipped when channels_redis is not "
+        "installed or the server does not answer."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--backends", nargs="+", choices=list(BACKENDS), default=list(BACKENDS)
+        )
+        parser.add_argument("--messages", type=int, default=5000)
+        parser.add_argument("--groups", type=int, default=100)
+        parser.add_argument("--group-size", type=int, default=2)
+        parser.add_argument("--redis-host", default="127.0.0.1:6379")
+
+    def handle(self, *args, **options):
+        for name in options["backends"]:
+            try:
+                layer_class = import_string(BACKENDS[name])
+            except ImportError as exc:
+                self.stdout.write(f"{name}: skipped ({exc})")
+                continue
+            config = {"capacity": options["messages"] + 1}
+            if name == "redis":
+                host, port = options["redis_host"].rsplit(":", 1)
+                config["hosts"] = [(host, int(port))]
+            try:
+                async_to_sync(self.run)(name, layer_class(**config), options)
+            except asyncio.TimeoutError:
+                # before OSError, TimeoutError is one
+                self.stdout.write(f"{name}: did not finish within {TIMEOUT}s")
+            except OSError as exc:
+                self.stdout.write(f"{name}: skipped ({exc})")
+
+    async def run(self, name, layer, options):
+        try:
+            round_trips = await asyncio.wait_for(
+                self.round_trips(layer, options["messages"]), TIMEOUT
+            )
+            fan_out = await asyncio.wait_for(
+                self.fan_out(layer, options["messages"], options["groups"], options["group_size"]),
+                TIMEOUT,
+            )
+        finally:
+            await layer.flush()
+            await layer.close()
+
+        elapsed, latencies = round_trips
+        self.stdout.write(name)
+        self.stdout.write(
+            f"  send/receive  {len(latencies) / elapsed:,.0f} msg/s, {percentiles(latencies)}"
+        )
+        elapsed, deliveries, latencies = fan_out
+        self.stdout.write(
+            f"  group_send    {deliveries / elapsed:,.0f} deliveries/s, {percentiles(latencies)}"
+        )
+
+    async def round_trips(self, layer, messages):
+        """
+        One message at a time from one channel to another, timed from send to receive.
+        """
+        channel = await layer.new_channel()
+        latencies = []
+        started = time.perf_counter()
+        for _ in range(messages):
+            sent = time.perf_counter()
+            await layer.send(channel, MESSAGE)
+            await layer.receive(channel)
+            latencies.append(time.perf_counter() - sent)
+        return time.perf_counter() - started, latencies
+
+    async def fan_out(self, layer, messages, groups, group_size):
+        """
+        group_sends spread over `groups` groups whose members all receive in their own task,
+        like consumers. Throughput: `messages` sent back to back until the last delivery.
+        Latency: one group_send at a time, until its last member has it.
+        """
+        members = {}
+        for group in range(groups):
+            members[group] = [await layer.new_channel() for _ in range(group_size)]
+            for channel in members[group]:
+                await layer.group_add(f"benchmark{group}", channel)
+
+        loop = asyncio.get_running_loop()
+        # sequence -> [sent at, members still waiting for it, future done on the last delivery]
+        pending = {}
+        latencies = []
+
+        async def receive(channel):
+            while True:
+                message = await layer.receive(channel)
+                entry = pending[message["sequence"]]
+                entry[1] -= 1
+                if not entry[1]:
+                    latencies.append(time.perf_counter() - entry[0])
+                    del pending[message["sequence"]]
+                    entry[2].set_result(None)
+
+        async def group_send(sequence):
+            delivered = loop.create_future()
+            pending[sequence] = [time.perf_counter(), group_size, delivered]
+            await layer.group_send(
+                f"benchmark{sequence % groups}", {**MESSAGE, "sequence": sequence}
+            )
+            return delivered
+
+        receivers = [
+            asyncio.ensure_future(receive(channel))
+            for channels in members.values()
+            for channel in channels
+        ]
+        try:
+            await asyncio.sleep(0.1)
+            started = time.perf_counter()
+            delivered = [await group_send(sequence) for sequence in range(messages)]
+            await asyncio.gather(*delivered)
+            elapsed = time.perf_counter() - started
+
+            latencies.clear()
+            for sequence in range(messages, messages + min(messages, 1000)):
+                await (await group_send(sequence))
+        finally:
+            for receiver in receivers:
+                receiver.cancel()
+            for group, channels in members.items():
+                for channel in channels:
+                    await layer.group_discard(f"benchmark{group}", channel)
+        return elapsed, messages * group_size, latencies
@@ -0,0 +1,184 @@
+import asyncio
+import json
+import uuid
+
+from asgiref.sync import async_to_sync
+from channels.testing import HttpCommunicator, WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+from rest_framework.authtoken.models import Token
+
+from chat.api import async_views
+from chat.management.commands.replay_traffic import (
+    IN_MEMORY_CHANNEL_LAYERS,
+    asgi_application,
+    percentiles,
+)
+from chat.models import Conversation
+from root import urls as root_urls
+
+User = get_user_model()
+
+READER = "benchmark-reader"
+WRITER = "benchmark-writer-{}"
+HOST = "benchmark"
+
+# root.urls without the async routes: GET /api/conversations/ and GET /api/messages/ go to the
+# router's DRF viewsets, which run the same chat.api.reads coroutines from a worker thread
+# (async_to_sync). Used as ROOT_URLCONF for the "threaded" runs: what the event loop saves
+# against a thread per request, not a comparison with an older implementation.
+urlpatterns = [
+    pattern
+    for pattern in root_urls.urlpatterns
+    if getattr(pattern, "callback", None)
+    not in (async_views.conversation_list, async_views.message_list)
+]
+
+URLCONFS = {"async": "root.urls", "threaded": __name__}
+
+
+class Command(BaseCommand):
+    help = (
+        "Run HTTP readers (conversation list and message history) next to websocket writers "
+        "against root.asgi.application, in this process, once with the async read routes and "
+        "once through the DRF viewsets (the same reads, run from a thread), and report the HTTP "
+        "throughput and latency and the chat message ack latency of each. The benchmark users "
+        "and their messages are deleted at the end."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--http-clients", type=int, default=10)
+        parser.add_argument("--ws-clients", type=int, default=5)
+        parser.add_argument("--duration", type=float, default=10.0, help="Seconds per mode.")
+        parser.add_argument(
+            "--message-interval",
+            type=float,
+            default=0.2,
+            help="Seconds between two messages of a websocket writer.",
+        )
+        parser.add_argument(
+            "--modes", nargs="+", choices=sorted(URLCONFS), default=["threaded", "async"]
+        )
+        parser.add_argument(
+            "--in-memory-layer",
+            action="store_true",
+            help="Use an in memory channel layer instead of CHANNEL_LAYERS.",
+        )
+
+    def handle(self, *args, **options):
+        if options["http_clients"] < 1 or options["ws_clients"] < 1:
+            raise CommandError("--http-clients and --ws-clients must be at least 1.")
+        if User.objects.filter(username=READER).exists():
+            raise CommandError(f"A user named {READER} exists, is another benchmark running?")
+
+        tokens = self.create_users(options["ws_clients"])
+        try:
+            for mode in options["modes"]:
+                settings = {"ROOT_URLCONF": URLCONFS[mode], "ALLOWED_HOSTS": [HOST]}
+                if options["in_memory_layer"]:
+                    settings["CHANNEL_LAYERS"] = IN_MEMORY_CHANNEL_LAYERS
+                with override_settings(**settings):
+                    stats = async_to_sync(self.run)(tokens, options)
+                self.report(mode, stats, options["duration"])
+        finally:
+            self.delete_users(tokens)
+
+    def create_users(self, writers):
+        reader = User.objects.create(username=READER)
+        tokens = {READER: Token.objects.create(user=reader).key}
+        for i in range(writers):
+            writer = User.objects.create(username=WRITER.format(i))
+            tokens[writer.username] = Token.objects.create(user=writer).key
+        return tokens
+
+    def delete_users(self, tokens):
+        # messages and tokens go with them
+        Conversation.objects.involving(READER).delete()
+        User.objects.filter(username__in=tokens).delete()
+
+    async def run(self, tokens, options):
+        stats = {"http": [], "http_errors": 0, "ack": [], "sent": 0}
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + options["duration"]
+        writers = [name for name in tokens if name != READER]
+
+        await asyncio.gather(
+            *(
+                self.write(name, tokens[name], options["message_interval"], deadline, stats)
+                for name in writers
+            ),
+            *(
+                self.read(i, tokens[READER], writers, deadline, stats)
+                for i in range(options["http_clients"])
+            ),
+        )
+        return stats
+
+    async def write(self, username, token, interval, deadline, stats):
+        loop = asyncio.get_running_loop()
+        communicator = WebsocketCommunicator(
+            asgi_application(), f"/chats/{READER}__{username}/?token={token}"
+        )
+        connected, _ = await communicator.connect(timeout=30)
+        if not connected:
+            raise CommandError(f"{username} could not connect.")
+        sent = {}
+        reader = asyncio.ensure_future(self.acks(communicator, sent, stats))
+        try:
+            while loop.time() < deadline:
+                client_id = uuid.uuid4().hex
+                sent[client_id] = loop.time()
+                await communicator.send_json_to(
+                    {"type": "chat_message", "message": "benchmark", "client_id": client_id}
+                )
+                stats["sent"] += 1
+                await asyncio.sleep(interval)
+            while sent and loop.time() < deadline + 5:
+                await asyncio.sleep(0.01)
+        finally:
+            reader.cancel()
+            await communicator.disconnect()
+
+    async def acks(self, communicator, sent, stats):
+        loop = asyncio.get_running_loop()
+        while True:
+            output = await communicator.receive_output(timeout=3600)
+            if output["type"] != "websocket.send" or output.get("text") is None:
+                continue
+            frame = json.loads(output["text"])
+            if frame.get("type") == "chat_message_ack" and frame.get("client_id") in sent:
+                stats["ack"].append(loop.time() - sent.pop(frame["client_id"]))
+
+    async def read(self, client, token, writers, deadline, stats):
+        loop = asyncio.get_running_loop()
+        headers = [(b"host", HOST.encode()), (b"authorization", f"Token {token}".encode())]
+        request = client
+        while loop.time() < deadline:
+            # every other request is the conversation list, the rest walk the histories
+            if request % 2:
+                path = "/api/conversations/"
+            else:
+                writer = writers[request // 2 % len(writers)]
+                path = f"/api/messages/?conversation={READER}__{writer}"
+            request += 1
+            started = loop.time()
+            communicator = HttpCommunicator(asgi_application(), "GET", path, headers=headers)
+            response = await communicator.get_response(timeout=30)
+            await communicator.wait()
+            if response["status"] == 200:
+                stats["http"].append(loop.time() - started)
+            else:
+                stats["http_errors"] += 1
+
+    def report(self, mode, stats, duration):
+        self.stdout.write(f"{mode} reads")
+        self.stdout.write(
+            f"  http          {len(stats['http']) / duration:.1f} req/s "
+            f"({stats['http_errors']} errors), {percentiles(stats['http'])}"
+        )
+        self.stdout.write(
+            f"  message ack   {len(stats['ack'])}/{stats['sent']} acked, "
+            f"{percentiles(stats['ack'])}"
+        )
+
@@ -0,0 +1,71 @@
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from chat.api.serializers import MESSAGE_FIELDS, MessageSerializer, message_rows_data
+from chat.models import Conversation, Message
+
+User = get_user_model()
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Time MessageSerializer against the fast values_list() serializer on N messages "
+        "(query + serialization). The sample data is created in a transaction that is rolled back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", type=int, nargs="+", default=[50, 1000])
+        parser.add_argument("--repeat", type=int, default=20)
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.run(options["sizes"], options["repeat"])
+                raise Rollback
+        except Rollback:
+            pass
+
+    def run(self, sizes, repeat):
+        sender = User.objects.create(username="benchmark__sender")
+        receiver = User.objects.create(username="benchmark__receiver")
+        conversation = Conversation.objects.create(name="benchmark__receiver__benchmark__sender")
+        Message.objects.bulk_create(
+            Message(
+                from_user=sender,
+                to_user=receiver,
+                content=f"benchmark message {i}",
+                conversation=conversation,
+            )
+            for i in range(max(sizes))
+        )
+        queryset = conversation.messages.order_by("-id")
+
+        self.stdout.write(f"{'messages':>10} {'drf ms':>10} {'fast ms':>10} {'speedup':>10}")
+        for size in sizes:
+            drf = self.best_of(
+                repeat,
+                lambda: MessageSerializer(
+                    queryset.select_related("from_user", "to_user")[:size], many=True
+                ).data,
+            )
+            fast = self.best_of(
+                repeat, lambda: message_rows_data(queryset.values_list(*MESSAGE_FIELDS)[:size])
+            )
+            self.stdout.write(
+                f"{size:>10} {drf * 1000:>10.2f} {fast * 1000:>10.2f} {drf / fast:>9.1f}x"
+            )
+
+    def best_of(self, repeat, run):
+        best = float("inf")
+        for _ in range(repeat):
+            started = time.perf_counter()
+            run()
+            best = min(best, time.perf_counter() - started)
+        return best
@@ -0,0 +1,135 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Subquery
+from django.utils import timezone
+
+from chat.models import Conversation, Message, uuid7_floor
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete messages older than --days and/or beyond the newest --max-per-conversation of "
+        "each conversation. Deletes in chunks of --chunk-size rows, one transaction each, and "
+        "recomputes the summary of every affected conversation once at the end."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days",
+            type=float,
+            default=getattr(settings, "CHAT_RETENTION_DAYS", None),
+            help="Delete messages older than this many days (default CHAT_RETENTION_DAYS).",
+        )
+        parser.add_argument(
+            "--max-per-conversation",
+            type=int,
+            default=getattr(settings, "CHAT_RETENTION_MAX_PER_CONVERSATION", None),
+            help="Keep only this many newest messages per conversation "
+            "(default CHAT_RETENTION_MAX_PER_CONVERSATION).",
+        )
+        parser.add_argument("--chunk-size", type=int, default=1000)
+        parser.add_argument(
+            "--pause",
+            type=float,
+            default=0,
+            help="Seconds to sleep between chunks, leaves room for the live traffic.",
+        )
+        parser.add_argument(
+            "--dry-run", action="store_true", help="Only count what would be deleted."
+        )
+
+    def handle(self, *args, **options):
+        days = options["days"]
+        cap = options["max_per_conversation"]
+        if days is None and cap is None:
+            raise CommandError("No retention policy: pass --days and/or --max-per-conversation.")
+        if cap is not None and cap < 1:
+            raise CommandError("--max-per-conversation must be at least 1.")
+        if options["chunk_size"] < 1:
+            raise CommandError("--chunk-size must be at least 1.")
+
+        self.options = options
+        self.deleted = 0
+        self.started = time.monotonic()
+        self.conversation_ids = set()
+
+        try:
+            self.apply_policy(days, cap)
+        finally:
+            # also after an interrupted run, so the summaries match what was deleted so far
+            self.refresh_summaries()
+
+        if options["dry_run"]:
+            self.stdout.write(f"Would delete {self.deleted} messages")
+            return
+
+        elapsed = time.monotonic() - self.started
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Deleted {self.deleted} messages from {len(self.conversation_ids)} conversations "
+                f"in {elapsed:.1f}s"
+            )
+        )
+
+    def apply_policy(self, days, cap):
+        messages = Message.objects.all()
+        if days is not None:
+            cutoff = timezone.now() - timedelta(days=days)
+            # ids are time ordered, comparing them uses the primary key index instead of a scan
+            bound = uuid7_floor(int(cutoff.timestamp() * 1000))
+            self.stdout.write(f"Messages older than {cutoff.isoformat()}")
+            self.purge(messages.filter(id__lt=bound))
+            # gone already, but a dry run still has them: don't count them twice
+            messages = messages.filter(id__gte=bound)
+
+        if cap is not None:
+            self.stdout.write(f"Messages beyond the newest {cap} of each conversation")
+            over_cap = Conversation.objects.filter(message_count__gt=cap).values_list(
+                "pk", flat=True
+            )
+            for conversation_id in over_cap.iterator():
+                in_conversation = messages.filter(conversation_id=conversation_id)
+                oldest_kept = in_conversation.order_by("-id").values("id")[cap - 1 : cap]
+                self.purge(in_conversation.filter(id__lt=Subquery(oldest_kept)))
+
+    def refresh_summaries(self):
+        conversation_ids = sorted(self.conversation_ids)
+        chunk_size = self.options["chunk_size"]
+        for start in range(0, len(conversation_ids), chunk_size):
+            Conversation.objects.filter(
+                pk__in=conversation_ids[start : start + chunk_size]
+            ).refresh_summary()
+
+    def purge(self, queryset):
+        """
+        Delete `queryset` oldest first, chunk by chunk. Each chunk is a short transaction on a
+        bounded set of primary keys, so locks are held briefly and the job can be stopped anytime.
+        """
+        if self.options["dry_run"]:
+            self.deleted += queryset.count()
+            return
+
+        chunk_size = self.options["chunk_size"]
+        while True:
+            rows = list(queryset.order_by("id").values_list("pk", "conversation_id")[:chunk_size])
+            if not rows:
+                return
+            with transaction.atomic():
+                Message.objects.filter(pk__in=[pk for pk, _ in rows]).delete(
+                    refresh_summary=False
+                )
+            self.conversation_ids.update(conversation_id for _, conversation_id in rows)
+            self.deleted += len(rows)
+
+            elapsed = time.monotonic() - self.started
+            self.stdout.write(
+                f"  deleted {self.deleted} messages ({self.deleted / elapsed:.0f}/s)"
+            )
+            if len(rows) < chunk_size:
+                return
+            if self.options["pause"]:
+                time.sleep(self.options["pause"])
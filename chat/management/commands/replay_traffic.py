@@ -0,0 +1,211 @@
+import asyncio
+import json
+import os
+import uuid
+
+from asgiref.sync import async_to_sync
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+from rest_framework.authtoken.models import Token
+
+from chat import capture, tracing
+
+User = get_user_model()
+
+IN_MEMORY_CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+# seconds a session waits for its missing acks before disconnecting
+ACK_WAIT = 5
+
+
+def percentiles(values):
+    if not values:
+        return "-"
+    values = sorted(values)
+
+    def pick(q):
+        return values[min(len(values) - 1, int(q * len(values)))] * 1000
+
+    return (
+        f"p50 {pick(0.5):.1f}  p95 {pick(0.95):.1f}  p99 {pick(0.99):.1f}  "
+        f"max {values[-1] * 1000:.1f} ms"
+    )
+
+
+class Command(BaseCommand):
+    help = (
+        "Replay sessions recorded with CHAT_CAPTURE_PATH against root.asgi.application, in this "
+        "process, at --speed times the recorded pace. The pseudonymous users are created as "
+        "replay-<pseudonym> (with tokens) and the replayed messages are stored: use a scratch "
+        "database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("paths", nargs="+", help="Capture files or directories of them.")
+        parser.add_argument("--speed", type=float, default=1.0, help="1 to 50.")
+        parser.add_argument(
+            "--trace-rate",
+            type=float,
+            default=1.0,
+            help="Share of replayed chat messages traced stage by stage (see chat.tracing).",
+        )
+        parser.add_argument(
+            "--in-memory-layer",
+            action="store_true",
+            help="Use an in memory channel layer instead of CHANNEL_LAYERS.",
+        )
+
+    def handle(self, *args, **options):
+        speed = options["speed"]
+        if not 1 <= speed <= 50:
+            raise CommandError("--speed must be between 1 and 50.")
+
+        sessions = [capture.read_session(path) for path in self.capture_files(options["paths"])]
+        if not sessions:
+            raise CommandError("No capture files found.")
+        tokens = self.replay_tokens(sessions)
+
+        tracing.SAMPLE_RATE = options["trace_rate"]
+        # don't record the replay itself
+        capture.CAPTURE_PATH = None
+        self.stats = {
+            "connect": [],
+            "ack": [],
+            "rejected": 0,
+            "frames_in": 0,
+            "frames_out": 0,
+            "bytes_out": 0,
+            "chat_messages": 0,
+        }
+        self.stdout.write(f"Replaying {len(sessions)} sessions at {speed:g}x")
+
+        if options["in_memory_layer"]:
+            with override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS):
+                elapsed = async_to_sync(self.replay)(sessions, tokens, speed)
+        else:
+            elapsed = async_to_sync(self.replay)(sessions, tokens, speed)
+        self.report(elapsed)
+
+    def capture_files(self, paths):
+        for path in paths:
+            if os.path.isdir(path):
+                for name in sorted(os.listdir(path)):
+                    if name.endswith(".ndjson.gz"):
+                        yield os.path.join(path, name)
+            else:
+                yield path
+
+    def replay_tokens(self, sessions):
+        """
+        A user and token for every pseudonym found in the sessions.
+        """
+        pseudonyms = set()
+        for header, _ in sessions:
+            pseudonyms.update(capture.PSEUDONYM_RE.findall(header["path"]))
+            if header["user"]:
+                pseudonyms.add(header["user"])
+        tokens = {}
+        for name in sorted(pseudonyms):
+            user, _ = User.objects.get_or_create(username=f"replay-{name}")
+            tokens[name] = Token.objects.get_or_create(user=user)[0].key
+        return tokens
+
+    async def replay(self, sessions, tokens, speed):
+        loop = asyncio.get_running_loop()
+        first = min(header["started_at"] for header, _ in sessions)
+        started = loop.time()
+        await asyncio.gather(
+            *(
+                self.replay_session(
+                    header, events, tokens, speed, started + (header["started_at"] - first) / speed
+                )
+                for header, events in sessions
+            )
+        )
+        return loop.time() - started
+
+    async def replay_session(self, header, events, tokens, speed, start_at):
+        loop = asyncio.get_running_loop()
+        await asyncio.sleep(max(0, start_at - loop.time()))
+
+        path = capture.PSEUDONYM_RE.sub(lambda match: f"replay-{match.group()}", header["path"])
+        token = tokens.get(header["user"], "anonymous")
+        communicator = WebsocketCommunicator(asgi_application(), f"{path}?token={token}")
+        opened = loop.time()
+        connected, _ = await communicator.connect(timeout=30)
+        if not connected:
+            self.stats["rejected"] += 1
+            return
+        self.stats["connect"].append(loop.time() - opened)
+
+        sent = {}
+        reader = asyncio.ensure_future(self.read(communicator, sent))
+        try:
+            for offset, kind, *data in events:
+                await asyncio.sleep(max(0, opened + offset / 1000 / speed - loop.time()))
+                if reader.done():
+                    # closed by the server
+                    break
+                if kind == "in" and data[0] is not None:
+                    frame = data[0]
+                    if frame.get("type") == "chat_message":
+                        # a fresh id per replayed message so acks can be matched and timed
+                        frame = {**frame, "client_id": uuid.uuid4().hex}
+                        sent[frame["client_id"]] = loop.time()
+                        self.stats["chat_messages"] += 1
+                    await communicator.send_json_to(frame)
+                    self.stats["frames_in"] += 1
+                elif kind == "disconnect":
+                    break
+            # sped up, the recorded disconnect can come before the server caught up
+            deadline = loop.time() + ACK_WAIT
+            while sent and not reader.done() and loop.time() < deadline:
+                await asyncio.sleep(0.01)
+        finally:
+            reader.cancel()
+            await communicator.disconnect()
+
+    async def read(self, communicator, sent):
+        loop = asyncio.get_running_loop()
+        while True:
+            output = await communicator.receive_output(timeout=3600)
+            if output["type"] == "websocket.close":
+                return
+            if output["type"] != "websocket.send" or output.get("text") is None:
+                continue
+            self.stats["frames_out"] += 1
+            self.stats["bytes_out"] += len(output["text"].encode())
+            frame = json.loads(output["text"])
+            if frame.get("type") == "chat_message_ack" and frame.get("client_id") in sent:
+                self.stats["ack"].append(loop.time() - sent.pop(frame["client_id"]))
+
+    def report(self, elapsed):
+        stats = self.stats
+        self.stdout.write(f"Replayed in {elapsed:.1f}s")
+        self.stdout.write(
+            f"  connections   {len(stats['connect'])} ({stats['rejected']} rejected), "
+            f"connect {percentiles(stats['connect'])}"
+        )
+        self.stdout.write(
+            f"  throughput    {stats['frames_in'] / elapsed:.1f} frames/s in, "
+            f"{stats['frames_out'] / elapsed:.1f} frames/s out "
+            f"({stats['bytes_out'] / elapsed / 1024:.1f} KiB/s), "
+            f"{stats['chat_messages'] / elapsed:.1f} messages/s"
+        )
+        self.stdout.write(f"  message ack   {percentiles(stats['ack'])}")
+        for stage, data in tracing.histogram().items():
+            if data["count"]:
+                self.stdout.write(
+                    f"  {stage:<13} mean {data['mean_ms']:.2f} ms over {data['count']} deliveries"
+                )
+
+
+def asgi_application():
+    """
+    root.asgi.application for the commands that drive it in process (replay, benchmarks).
+    Imported late so settings overrides (channel layer) are in place.
+    """
+    from root.asgi import application
+
+    return application
@@ -0,0 +1,209 @@
+import asyncio
+import os
+import signal
+import socket
+import sys
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management.base import BaseCommand, CommandError
+
+from chat import connections, outbox
+
+# channel layers whose groups and channels only exist inside one process
+PROCESS_LOCAL_LAYERS = ("chat.layers.LocalChannelLayer", "channels.layers.InMemoryChannelLayer")
+
+
+class Command(BaseCommand):
+    help = (
+        "Serve root.asgi.application with several daphne worker processes sharing one socket. "
+        "On SIGTERM workers stop accepting and close their sockets over --drain-window seconds."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="0.0.0.0")
+        parser.add_argument("--port", type=int, default=8000)
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="Worker processes. More than one needs the shared cache and outbox (redis).",
+        )
+        parser.add_argument(
+            "--drain-window",
+            type=float,
+            default=30,
+            help="Seconds over which open websockets are closed on shutdown.",
+        )
+        parser.add_argument(
+            "--grace",
+            type=float,
+            default=5,
+            help="Seconds to wait for drained sockets to close before a worker exits anyway.",
+        )
+
+    def handle(self, *args, **options):
+        if options["workers"] > 1:
+            self.check_shared_state()
+
+        # Preload: settings, url conf, consumers, serializers ... are imported once here
+        # and shared copy-on-write by every worker.
+        from root.asgi import application
+
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((options["host"], options["port"]))
+        listener.listen(1024)
+        listener.set_inheritable(True)
+
+        self.stdout.write(
+            f"Listening on {options['host']}:{options['port']} with {options['workers']} workers"
+        )
+
+        workers = {}
+        stopping = False
+
+        def spawn(index):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    self.run_worker(application, listener, options)
+                finally:
+                    os._exit(0)
+            workers[pid] = (index, time.monotonic())
+
+        def stop(signum, frame):
+            nonlocal stopping
+            stopping = True
+            for pid in workers:
+                os.kill(pid, signal.SIGTERM)
+
+        for index in range(options["workers"]):
+            spawn(index)
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        while workers:
+            pid, status = os.wait()
+            worker = workers.pop(pid, None)
+            if worker is None:
+                continue
+            index, started = worker
+            if not stopping:
+                self.stderr.write(f"Worker {pid} died (status {status}), restarting")
+                # don't spin if it dies right away (port in use, broken settings ...)
+                if time.monotonic() - started < 1:
+                    time.sleep(1)
+                spawn(index)
+
+        listener.close()
+        self.stdout.write("All workers stopped")
+
+    def check_shared_state(self):
+        """
+        State the workers have to see the same way lives outside them.
+        """
+        backend = settings.CHANNEL_LAYERS.get("default", {}).get("BACKEND")
+        if backend in PROCESS_LOCAL_LAYERS:
+            raise CommandError(
+                f"Several workers need a channel layer they share (RedisChannelLayer): with "
+                f"{backend} chat messages, notifications, kicks and drains never leave the "
+                f"worker they were sent from."
+            )
+        if isinstance(caches["default"], LocMemCache):
+            raise CommandError(
+                "Several workers need a cache they share (set REDIS_CACHE_URL): with the "
+                "per-process LocMemCache one worker's writes never reach the others' socket "
+                "history pages, notification digests and client message ids."
+            )
+        if not outbox.REDIS_URL:
+            raise CommandError(
+                "Several workers need a shared notification outbox (set REDIS_OUTBOX_URL): "
+                "the in-memory one only replays what was appended in the same worker."
+            )
+
+    def install_fresh_reactor(self):
+        """
+        daphne installs the asyncio twisted reactor when the app registry loads, i.e. in the parent.
+        Its event loop (epoll fd and self-pipe) must not be shared between workers, so each worker
+        replaces it with a reactor on a new loop before serving.
+        """
+        import twisted.internet
+        from twisted.internet import asyncioreactor
+
+        old_reactor = sys.modules.pop("twisted.internet.reactor")
+        del twisted.internet.reactor
+        old_reactor._asyncioEventloop.close()
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        asyncioreactor.install(loop)
+        from twisted.internet import reactor
+
+        # daphne.server (and friends) did `from twisted.internet import reactor` at import time
+        for module in list(sys.modules.values()):
+            if getattr(module, "reactor", None) is old_reactor:
+                module.reactor = reactor
+        return reactor
+
+    def run_worker(self, application, listener, options):
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        reactor = self.install_fresh_reactor()
+        from daphne.server import Server
+
+        class WorkerServer(Server):
+            def listen_success(self, port):
+                self.ports = getattr(self, "ports", []) + [port]
+                super().listen_success(port)
+
+        # dead peers: websocket protocol pings, see chat.connections
+        keepalive = {}
+        if connections.HEARTBEAT_INTERVAL:
+            keepalive = {
+                "ping_interval": connections.HEARTBEAT_INTERVAL,
+                "ping_timeout": connections.HEARTBEAT_TIMEOUT,
+            }
+        server = WorkerServer(
+            application=application,
+            endpoints=[f"fd:fileno={listener.fileno()}"],
+            signal_handlers=False,
+            verbosity=0,
+            **keepalive,
+        )
+
+        def start_drain():
+            # stop accepting here, the other workers (or the next generation) keep accepting
+            for port in getattr(server, "ports", []):
+                port.stopListening()
+            asyncio.ensure_future(self.drain_and_stop(reactor.stop, options))
+
+        def on_sigterm(signum, frame):
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+            reactor.callFromThread(start_drain)
+
+        signal.signal(signal.SIGTERM, on_sigterm)
+        self.stdout.write(f"Worker {os.getpid()} started")
+        sys.stdout.flush()
+        server.run()
+
+    async def drain_and_stop(self, stop, options):
+        """
+        Close this worker's sockets over the drain window, then `stop` it whatever happened:
+        a drain that fails (channel layer down ...) must not leave the worker running.
+        """
+        try:
+            await connections.drain(options["drain_window"])
+            # give the last sockets a moment to finish closing
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + options["grace"]
+            while connections.channel_names() and loop.time() < deadline:
+                await asyncio.sleep(0.1)
+        except Exception as exc:
+            self.stderr.write(f"Worker {os.getpid()} could not drain its connections: {exc!r}")
+        finally:
+            stop()
@@ -5,6 +5,7 @@ from rest_framework.exceptions import AuthenticationFailed
 User = get_user_model()
 from urllib.parse import parse_qs
 from channels.db import database_sync_to_async
+from chat import capture
 
 
 class TokenAuthentication:
@@ -93,4 +94,12 @@ class TokenAuthMiddleware:
         token = query_params["token"][0]
         scope["token"] = token
         scope["user"] = await get_user(scope)
-        return await self.app(scope, receive, send)
+        if not capture.CAPTURE_PATH:
+            return await self.app(scope, receive, send)
+
+        # opt-in traffic capture, see chat/capture.py
+        recorder = capture.SessionRecorder(scope)
+        try:
+            return await self.app(scope, *recorder.wrap(receive, send))
+        finally:
+            await recorder.save()
@@ -0,0 +1,59 @@
+# Generated by Django 6.0 on 2026-10-19 12:11
+
+import chat.models
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def rewrite_message_ids(apps, schema_editor):
+    """
+    Existing messages got random uuid4 ids. Give every one of them a uuid7 built from its
+    own timestamp (oldest first) so ordering by primary key matches ordering by time,
+    then point last_message at the rewritten rows.
+    This is one UPDATE per message, run it in a maintenance window on big tables.
+    Conversation ids are left alone: nothing is ordered by them.
+    """
+    Message = apps.get_model("chat", "Message")
+    Conversation = apps.get_model("chat", "Conversation")
+
+    old_rows = Message.objects.order_by("timestamp", "id").values_list("id", "timestamp")
+    for old_id, timestamp in old_rows.iterator(chunk_size=2000):
+        new_id = chat.models.uuid7(timestamp_ms=int(timestamp.timestamp() * 1000))
+        Message.objects.filter(id=old_id).update(id=new_id)
+
+    Conversation.objects.update(
+        last_message=Subquery(
+            Message.objects.filter(conversation=OuterRef("pk"))
+            .order_by("-id")
+            .values("pk")[:1]
+        )
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_alter_conversation_last_message'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='conversation',
+            name='id',
+            field=models.UUIDField(default=chat.models.uuid7, editable=False, primary_key=True, serialize=False),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='id',
+            field=models.UUIDField(default=chat.models.uuid7, editable=False, primary_key=True, serialize=False),
+        ),
+        # before the backfill: on postgres its row by row pk updates leave deferred FK trigger
+        # events pending until commit, and no index can be created on the table after them
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['conversation', '-id'], name='chat_msg_conv_id_idx'),
+        ),
+        migrations.RunPython(rewrite_message_ids, migrations.RunPython.noop),
+    ]
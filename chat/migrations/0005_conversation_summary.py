@@ -0,0 +1,50 @@
+# Generated by Django 6.0 on 2026-10-19 12:12
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce, Substr
+
+
+def backfill_summary(apps, schema_editor):
+    # same as ConversationQuerySet.refresh_summary, custom querysets aren't available here
+    Message = apps.get_model("chat", "Message")
+    Conversation = apps.get_model("chat", "Conversation")
+
+    messages = Message.objects.filter(conversation=OuterRef("pk"))
+    latest = messages.order_by("-id")
+    counts = messages.order_by().values("conversation").annotate(count=Count("pk")).values("count")
+    Conversation.objects.update(
+        last_message=Subquery(latest.values("pk")[:1]),
+        last_message_preview=Coalesce(
+            Subquery(latest.annotate(preview=Substr("content", 1, 100)).values("preview")[:1]),
+            Value(""),
+        ),
+        last_message_at=Subquery(latest.values("timestamp")[:1]),
+        message_count=Coalesce(Subquery(counts), 0),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_time_ordered_ids'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='last_message_preview',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='message_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_summary, migrations.RunPython.noop),
+    ]
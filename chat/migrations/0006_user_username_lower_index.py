@@ -0,0 +1,37 @@
+# Generated by Django 6.0 on 2026-10-19 12:14
+
+from django.conf import settings
+from django.db import migrations
+
+INDEX_NAME = "chat_user_username_lower_idx"
+
+
+def create_index(apps, schema_editor):
+    """
+    The user table belongs to auth, so the functional index for the directory's
+    lower(username) prefix search is created by hand.
+    On postgres text_pattern_ops lets LIKE 'prefix%' use the index whatever the collation.
+    """
+    User = apps.get_model(settings.AUTH_USER_MODEL)
+    table = schema_editor.quote_name(User._meta.db_table)
+    column = schema_editor.quote_name(User._meta.get_field("username").column)
+    opclass = " text_pattern_ops" if schema_editor.connection.vendor == "postgresql" else ""
+    schema_editor.execute(
+        f"CREATE INDEX IF NOT EXISTS {INDEX_NAME} ON {table} (LOWER({column}){opclass})"
+    )
+
+
+def drop_index(apps, schema_editor):
+    schema_editor.execute(f"DROP INDEX IF EXISTS {INDEX_NAME}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_conversation_summary'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
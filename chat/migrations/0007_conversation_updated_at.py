@@ -0,0 +1,18 @@
+# Generated by Django 6.0 on 2026-10-19 12:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_user_username_lower_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
@@ -1,18 +1,150 @@
+import os
+import threading
+import time
 import uuid
 
 from django.contrib.auth import get_user_model
 from django.db import models
-from django.db.models.signals import post_save, post_delete
+from django.db.models import Case, Count, F, OuterRef, Q, Subquery, Value, When
+from django.db.models.functions import Coalesce, Now, Substr
+from django.db.models.signals import post_delete
 from django.dispatch import receiver
 
+from chat import response_cache
+
 User = get_user_model()
 
+_uuid7_lock = threading.Lock()
+_uuid7_last_ms = 0
+_uuid7_counter = 0
+
+
+def uuid7(timestamp_ms=None):
+    """
+    Time ordered uuid (version 7): 48 bit unix time in ms, 12 bit counter, 62 random bits.
+    New rows land at the right edge of the primary key index and ids sort in creation order,
+    so history can be ordered and paged by the primary key alone.
+    The counter keeps ids created in the same millisecond (in this process) in order too.
+    An explicit `timestamp_ms` (backfills) is used as given, with a random counter: it must not
+    be pushed forward to the last id this process handed out.
+    """
+    global _uuid7_last_ms, _uuid7_counter
+
+    if timestamp_ms is not None:
+        return _uuid7_from(timestamp_ms, int.from_bytes(os.urandom(2), "big") & 0xFFF)
+
+    timestamp_ms = time.time_ns() // 1_000_000
+    with _uuid7_lock:
+        if timestamp_ms > _uuid7_last_ms:
+            _uuid7_last_ms = timestamp_ms
+            # start low so there is room to count up inside the same millisecond
+            _uuid7_counter = int.from_bytes(os.urandom(2), "big") & 0x7FF
+        else:
+            _uuid7_counter += 1
+            if _uuid7_counter > 0xFFF:
+                _uuid7_last_ms += 1
+                _uuid7_counter = 0
+        timestamp_ms, counter = _uuid7_last_ms, _uuid7_counter
+    return _uuid7_from(timestamp_ms, counter)
+
+
+def _uuid7_from(timestamp_ms, counter):
+    rand = int.from_bytes(os.urandom(8), "big") & ((1 << 62) - 1)
+    value = (timestamp_ms & ((1 << 48) - 1)) << 80
+    value |= 0x7 << 76
+    value |= counter << 64
+    value |= 0b10 << 62
+    value |= rand
+    return uuid.UUID(int=value)
+
+
+def uuid7_floor(timestamp_ms):
+    """
+    The smallest uuid7 of a millisecond: `id__lt=uuid7_floor(ms)` selects by creation time
+    through the primary key index.
+    """
+    value = (timestamp_ms & ((1 << 48) - 1)) << 80
+    value |= 0x7 << 76
+    return uuid.UUID(int=value)
+
+
+PREVIEW_LENGTH = 100
+
+
+class ConversationQuerySet(models.QuerySet):
+    def involving(self, username):
+        """
+        Conversations `username` takes part in, without their self-conversation ("root__root").
+        """
+        return self.filter(
+            Q(name__startswith=f"{username}__") | Q(name__endswith=f"__{username}")
+        ).exclude(name=f"{username}__{username}")
+
+    def record_message(self, message):
+        """
+        Fold a newly created message into the conversation summary with one UPDATE.
+        The count always goes up, the last_message_* columns only move forward
+        (ids are time ordered) so an older message saved late can't overwrite a newer one.
+        """
+        newer = Q(last_message__isnull=True) | Q(last_message__lt=message.pk)
+        response_cache.invalidate_conversation(message.conversation_id)
+        return self.filter(pk=message.conversation_id).update(
+            updated_at=Now(),
+            message_count=F("message_count") + 1,
+            last_message_preview=Case(
+                When(newer, then=Value(message.content[:PREVIEW_LENGTH])),
+                default=F("last_message_preview"),
+            ),
+            last_message_at=Case(
+                When(newer, then=Value(message.timestamp)),
+                default=F("last_message_at"),
+            ),
+            # last, MySQL evaluates SET left to right with the already updated values
+            last_message=Case(
+                When(newer, then=Value(message.pk, output_field=models.UUIDField())),
+                default=F("last_message"),
+            ),
+        )
+
+    def refresh_summary(self):
+        """
+        Recompute the summary of every conversation in this queryset from its messages.
+        One UPDATE with correlated subqueries however many rows were deleted, used after deletes.
+        """
+        for pk in self.values_list("pk", flat=True):
+            response_cache.invalidate_conversation(pk)
+
+        messages = Message.objects.filter(conversation=OuterRef("pk"))
+        latest = messages.order_by("-id")
+        counts = (
+            messages.order_by()
+            .values("conversation")
+            .annotate(count=Count("pk"))
+            .values("count")
+        )
+        return self.update(
+            updated_at=Now(),
+            last_message=Subquery(latest.values("pk")[:1]),
+            last_message_preview=Coalesce(
+                Subquery(
+                    latest.annotate(
+                        preview=Substr("content", 1, PREVIEW_LENGTH)
+                    ).values("preview")[:1]
+                ),
+                Value(""),
+            ),
+            last_message_at=Subquery(latest.values("timestamp")[:1]),
+            message_count=Coalesce(Subquery(counts), 0),
+        )
+
 
 class Conversation(models.Model):
-    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    id = models.UUIDField(primary_key=True, default=uuid7, editable=False)
     name = models.CharField(max_length=128)
     online = models.ManyToManyField(to=User, blank=True)
 
+    # Summary of the conversation, enough to render the inbox without touching Message.
+    # Kept up to date by Message.save / message deletes, see ConversationQuerySet.
     last_message = models.ForeignKey(
         "Message",
         null=True,
@@ -20,16 +152,51 @@ class Conversation(models.Model):
         on_delete=models.SET_NULL,
         related_name="+",
     )
+    last_message_preview = models.CharField(max_length=PREVIEW_LENGTH, blank=True, default="")
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    message_count = models.PositiveIntegerField(default=0)
+    # bumped on every change to the messages (new, read, deleted), used as the http validator
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = ConversationQuerySet.as_manager()
 
     def get_online_count(self):
         return self.online.count()
 
+    def mark_read(self, user):
+        """
+        Mark every message sent to `user` as read. Returns the number of messages updated.
+        """
+        updated = self.messages.filter(to_user=user, read=False).update(read=True)
+        if updated:
+            Conversation.objects.filter(pk=self.pk).update(updated_at=Now())
+            response_cache.invalidate_conversation(self.pk)
+        return updated
+
     def __str__(self):
         return f"{self.name} ({self.get_online_count()})"
 
 
+class MessageQuerySet(models.QuerySet):
+    def delete(self, refresh_summary=True):
+        """
+        Bulk delete, then recompute the summary once per affected conversation
+        (instead of once per deleted row).
+        Batch jobs deleting chunk after chunk pass refresh_summary=False and refresh
+        the conversations they touched once at the end, see the purge_messages command.
+        """
+        if not refresh_summary:
+            return super().delete()
+        conversation_ids = list(
+            self.order_by().values_list("conversation_id", flat=True).distinct()
+        )
+        deleted = super().delete()
+        Conversation.objects.filter(pk__in=conversation_ids).refresh_summary()
+        return deleted
+
+
 class Message(models.Model):
-    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    id = models.UUIDField(primary_key=True, default=uuid7, editable=False)
     conversation = models.ForeignKey(
         Conversation, on_delete=models.CASCADE, related_name="messages"
     )
@@ -42,23 +209,43 @@ class Message(models.Model):
     content = models.CharField(max_length=512)
     timestamp = models.DateTimeField(auto_now_add=True)
     read = models.BooleanField(default=False)
+    # id generated by the sending client, a resent frame with the same one is not stored twice
+    client_id = models.CharField(max_length=64, null=True, blank=True)
 
-    def __str__(self):
-        return f"From {self.from_user.username} to {self.to_user.username}: {self.content} [{self.timestamp}]"
+    objects = MessageQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # history of one conversation, newest first (ids are time ordered)
+            models.Index(fields=["conversation", "-id"], name="chat_msg_conv_id_idx"),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=["from_user", "client_id"],
+                condition=models.Q(client_id__isnull=False),
+                name="chat_msg_unique_client_id",
+            ),
+        ]
 
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        super().save(*args, **kwargs)
+        if adding:
+            Conversation.objects.record_message(self)
 
-# Keep last_message in sync
-@receiver(post_save, sender=Message)
-def _set_last_message_on_save(sender, instance, created, **kwargs):
-    conv = instance.conversation
-    if conv.last_message is None or instance.timestamp >= conv.last_message.timestamp:
-        conv.last_message = instance
-        conv.save(update_fields=["last_message"])
+    def delete(self, *args, **kwargs):
+        deleted = super().delete(*args, **kwargs)
+        Conversation.objects.filter(pk=self.conversation_id).refresh_summary()
+        return deleted
+
+    def __str__(self):
+        return f"From {self.from_user.username} to {self.to_user.username}: {self.content} [{self.timestamp}]"
 
 
-@receiver(post_delete, sender=Message)
-def _update_last_message_on_delete(sender, instance, **kwargs):
-    conv = instance.conversation
-    if conv.last_message_id == instance.id:
-        conv.last_message = conv.messages.order_by("-timestamp").first()
-        conv.save(update_fields=["last_message"])
+# Deleting a user cascades to their messages without going through MessageQuerySet.delete
+@receiver(post_delete, sender=User)
+def _refresh_summaries_on_user_delete(sender, instance, **kwargs):
+    username = instance.username
+    Conversation.objects.filter(
+        Q(name__startswith=f"{username}__") | Q(name__endswith=f"__{username}")
+    ).refresh_summary()
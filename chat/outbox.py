@@ -0,0 +1,141 @@
+import json
+import re
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+
+"""
+    Per user outbox of new-message notifications.
+
+    A group_send to <user>__notifications is lost when the user has no notification socket open,
+    so every notification is also appended here. NotificationConsumer replays what came after the
+    client's ?cursor= when it connects, and drops everything up to a cursor once the client acks it:
+    a client that keeps its last cursor never has to poll the conversation list to catch up.
+
+    Backed by a redis stream per user (CHAT_OUTBOX_REDIS_URL) or, without redis, by memory of this
+    process (fine for runserver / a single worker). Both keep the newest CHAT_OUTBOX_SIZE entries,
+    a redis outbox nobody touches for CHAT_OUTBOX_TTL seconds expires.
+    Cursors are redis stream ids ("<ms>-<seq>") with either backend.
+"""
+
+REDIS_URL = getattr(settings, "CHAT_OUTBOX_REDIS_URL", None)
+SIZE = getattr(settings, "CHAT_OUTBOX_SIZE", 500)
+TTL = getattr(settings, "CHAT_OUTBOX_TTL", 7 * 24 * 3600)
+
+CURSOR_RE = re.compile(r"^\d+-\d+$")
+
+
+def _parse(cursor):
+    ms, seq = cursor.split("-")
+    return int(ms), int(seq)
+
+
+def valid_cursor(cursor):
+    return isinstance(cursor, str) and CURSOR_RE.match(cursor) is not None
+
+
+class LocalOutbox:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.last = (0, 0)
+
+    def _next_cursor(self):
+        ms = time.time_ns() // 1_000_000
+        self.last = (ms, 0) if ms > self.last[0] else (self.last[0], self.last[1] + 1)
+        return f"{self.last[0]}-{self.last[1]}"
+
+    def append(self, username, event):
+        with self.lock:
+            cursor = self._next_cursor()
+            self.entries.setdefault(username, deque(maxlen=SIZE)).append((cursor, event))
+            return cursor
+
+    def read(self, username, after=None):
+        after = _parse(after) if after else (-1, -1)
+        with self.lock:
+            return [
+                (cursor, event)
+                for cursor, event in self.entries.get(username, ())
+                if _parse(cursor) > after
+            ]
+
+    def trim(self, username, cursor):
+        upto = _parse(cursor)
+        with self.lock:
+            entries = self.entries.get(username)
+            while entries and _parse(entries[0][0]) <= upto:
+                entries.popleft()
+
+    def last_cursor(self, username):
+        with self.lock:
+            entries = self.entries.get(username)
+            return entries[-1][0] if entries else None
+
+
+class RedisOutbox:
+    def __init__(self, url):
+        import redis
+
+        self.redis = redis.Redis.from_url(url, decode_responses=True)
+
+    def key(self, username):
+        return f"chat:outbox:{username}"
+
+    def append(self, username, event):
+        key = self.key(username)
+        pipeline = self.redis.pipeline()
+        pipeline.xadd(key, {"event": json.dumps(event)}, maxlen=SIZE, approximate=True)
+        pipeline.expire(key, TTL)
+        cursor, _ = pipeline.execute()
+        return cursor
+
+    def read(self, username, after=None):
+        # "(" makes the start exclusive
+        entries = self.redis.xrange(self.key(username), min=f"({after}" if after else "-")
+        return [(cursor, json.loads(fields["event"])) for cursor, fields in entries]
+
+    def trim(self, username, cursor):
+        # MINID keeps the entries from the given id on, so start right after the acked one
+        ms, seq = _parse(cursor)
+        self.redis.xtrim(self.key(username), minid=f"{ms}-{seq + 1}", approximate=False)
+
+    def last_cursor(self, username):
+        entries = self.redis.xrevrange(self.key(username), count=1)
+        return entries[0][0] if entries else None
+
+
+_outbox = None
+_outbox_lock = threading.Lock()
+
+
+def get_outbox():
+    global _outbox
+    with _outbox_lock:
+        if _outbox is None:
+            _outbox = RedisOutbox(REDIS_URL) if REDIS_URL else LocalOutbox()
+        return _outbox
+
+
+def append(username, event):
+    return get_outbox().append(username, event)
+
+
+def read(username, after=None):
+    """
+    [(cursor, event)] oldest first, the ones after `after` (a cursor), or all of them.
+    """
+    return get_outbox().read(username, after)
+
+
+def trim(username, cursor):
+    """
+    Drop the entries up to and including `cursor`, called when the client acks it.
+    """
+    get_outbox().trim(username, cursor)
+
+
+def last_cursor(username):
+    return get_outbox().last_cursor(username)
@@ -0,0 +1,145 @@
+import asyncio
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+"""
+    Per user cache for the REST reads (conversation list / inbox / retrieve, first page of messages).
+
+    An entry is keyed on the same database values as the response's ETag (count and latest
+    updated_at of the conversations, or one conversation's updated_at), read before the body
+    is built. Any change the ETag sees (a new conversation, message, read or delete, from this
+    process or another one) is a different key, old entries simply age out.
+
+    Every conversation also has a version number in the cache, bumped after commit whenever its
+    messages change. The chat socket's history pages are keyed on it (see chat.consumers), with
+    several workers that needs a cache they all share.
+"""
+
+# how long a single response stays cached
+TTL = getattr(settings, "CHAT_RESPONSE_CACHE_TTL", 300)
+# how long other requests wait for the one that is already building a missing entry
+STAMPEDE_WAIT = 0.5
+LOCK_TIMEOUT = 5
+
+_stats_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "stampede_waits": 0, "invalidations": 0}
+
+
+def _count(name, amount=1):
+    with _stats_lock:
+        _stats[name] += amount
+
+
+def stats():
+    """
+    Hit / miss counters of this process.
+    """
+    with _stats_lock:
+        data = dict(_stats)
+    lookups = data["hits"] + data["misses"]
+    data["hit_rate"] = data["hits"] / lookups if lookups else 0.0
+    return data
+
+
+def _conversation_version_key(conversation_id):
+    return f"chat:version:conversation:{conversation_id}"
+
+
+def conversation_version(conversation_id):
+    key = _conversation_version_key(conversation_id)
+    version = cache.get(key)
+    if version is None:
+        # start from the clock, not 1, so an evicted counter can never come back to an old value
+        cache.add(key, time.time_ns(), None)
+        version = cache.get(key)
+    return version
+
+
+def invalidate_conversation(conversation_id):
+    """
+    Called from the model layer whenever messages of a conversation change.
+    Runs after commit so a concurrent read can't cache the pre-commit state under the new version.
+    """
+
+    def bump():
+        key = _conversation_version_key(conversation_id)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, time.time_ns(), None)
+        _count("invalidations")
+
+    transaction.on_commit(bump)
+
+
+def response_key(kind, user, etag):
+    """
+    The response's ETag covers everything its body depends on (validators, query string).
+    The validators are read before the body is built, a write committed in between can only
+    put a newer body under the older key, never the reverse.
+    """
+    return f"chat:response:{kind}:{user.pk}:{etag}"
+
+
+def get_or_build(key, build, timeout=TTL):
+    """
+    Cached value for `key`, or build() it and store it.
+    Only one request builds a missing hot key, the others wait a little for its result.
+    """
+    value = cache.get(key)
+    if value is not None:
+        _count("hits")
+        return value
+    _count("misses")
+
+    lock_key = f"{key}:lock"
+    if cache.add(lock_key, 1, LOCK_TIMEOUT):
+        try:
+            value = build()
+            cache.set(key, value, timeout)
+        finally:
+            cache.delete(lock_key)
+        return value
+
+    deadline = time.monotonic() + STAMPEDE_WAIT
+    while time.monotonic() < deadline:
+        time.sleep(0.02)
+        value = cache.get(key)
+        if value is not None:
+            _count("stampede_waits")
+            return value
+    # the builder is slow or died, don't keep the client waiting any longer
+    return build()
+
+
+async def aget_or_build(key, build, timeout=TTL):
+    """
+    get_or_build for the async views, `build` is a coroutine function.
+    """
+    value = await cache.aget(key)
+    if value is not None:
+        _count("hits")
+        return value
+    _count("misses")
+
+    lock_key = f"{key}:lock"
+    if await cache.aadd(lock_key, 1, LOCK_TIMEOUT):
+        try:
+            value = await build()
+            await cache.aset(key, value, timeout)
+        finally:
+            await cache.adelete(lock_key)
+        return value
+
+    deadline = time.monotonic() + STAMPEDE_WAIT
+    while time.monotonic() < deadline:
+        await asyncio.sleep(0.02)
+        value = await cache.aget(key)
+        if value is not None:
+            _count("stampede_waits")
+            return value
+    return await build()
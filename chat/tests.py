@@ -1,3 +1,1828 @@
-from django.test import TestCase
+import asyncio
+import collections
+import csv
+import gzip
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import types
+from unittest import mock, skipUnless
+from urllib.parse import urlencode
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.exceptions import ChannelFull
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection, transaction
+from django.test import AsyncRequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.authtoken.models import Token
+from rest_framework.response import Response
+from rest_framework.test import APIClient, APIRequestFactory
+
+from chat import capture, connections, outbox, tracing
+from chat.api.export import CSV_HEADER
+from chat.api.serializers import (
+    MESSAGE_FIELDS,
+    ConversationSerializer,
+    MessageSerializer,
+    conversation_data,
+    message_data,
+    message_rows_data,
+)
+from chat.layers import LocalChannelLayer
+from chat.management.commands import serve
+from chat.models import PREVIEW_LENGTH, Conversation, Message, uuid7, uuid7_floor
+from chat.views import ConversationViewSet, MessageViewSet
+from root.asgi import application
+
+User = get_user_model()
+
+
+class ChatTestCase(TestCase):
+    """
+    Two users (alice, bob) with a conversation and a few messages, and an api client logged in as alice.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user(username="alice", password="pass")
+        cls.bob = User.objects.create_user(username="bob", password="pass")
+        cls.conversation = Conversation.objects.create(name="alice__bob")
+        for i in range(3):
+            Message.objects.create(
+                from_user=cls.bob,
+                to_user=cls.alice,
+                content=f"message {i}",
+                conversation=cls.conversation,
+            )
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.token = Token.objects.create(user=self.alice)
+        self.client.credentials(HTTP_AUTHORIZATION=f"Token {self.token.key}")
+
+
+class Uuid7Tests(TestCase):
+    def test_ordered(self):
+        ids = [uuid7() for _ in range(1000)]
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual({pk.version for pk in ids}, {7})
+
+    def test_explicit_timestamp(self):
+        # after a newer id from this process, the given millisecond is still the one used
+        uuid7()
+        timestamp_ms = 1_600_000_000_000
+        pk = uuid7(timestamp_ms=timestamp_ms)
+        self.assertEqual(pk.int >> 80, timestamp_ms)
+        self.assertTrue(uuid7_floor(timestamp_ms) <= pk < uuid7_floor(timestamp_ms + 1))
+
+
+class ConversationSummaryTests(ChatTestCase):
+    """
+    last_message / last_message_preview / last_message_at / message_count kept in step with
+    the messages by Message.save, the delete paths and user deletes.
+    """
+
+    def assertSummary(self, conversation, count):
+        conversation.refresh_from_db()
+        latest = conversation.messages.order_by("-id").first()
+        self.assertEqual(conversation.message_count, count)
+        self.assertEqual(conversation.last_message, latest)
+        self.assertEqual(conversation.last_message_preview, latest.content if latest else "")
+        self.assertEqual(conversation.last_message_at, latest.timestamp if latest else None)
+
+    def test_new_message(self):
+        message = Message.objects.create(
+            from_user=self.alice, to_user=self.bob, content="x" * 300, conversation=self.conversation
+        )
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.last_message, message)
+        self.assertEqual(self.conversation.last_message_preview, "x" * PREVIEW_LENGTH)
+        self.assertEqual(self.conversation.message_count, 4)
+
+    def test_older_message_saved_late(self):
+        latest = self.conversation.messages.order_by("-id").first()
+        Message.objects.create(
+            id=uuid7(timestamp_ms=1_600_000_000_000),
+            from_user=self.alice,
+            to_user=self.bob,
+            content="from the past",
+            conversation=self.conversation,
+        )
+        self.conversation.refresh_from_db()
+        # counted, but the newer message stays the last one
+        self.assertEqual(self.conversation.message_count, 4)
+        self.assertEqual(self.conversation.last_message, latest)
+        self.assertEqual(self.conversation.last_message_preview, latest.content)
+
+    def test_bulk_delete(self):
+        other = Conversation.objects.create(name="alice__carol")
+        carol = User.objects.create_user(username="carol")
+        Message.objects.create(from_user=carol, to_user=self.alice, content="hi", conversation=other)
+        Message.objects.filter(content__in=["message 2", "hi"]).delete()
+        self.assertSummary(self.conversation, 2)
+        self.assertSummary(other, 0)
+
+    def test_single_delete(self):
+        self.conversation.messages.order_by("-id").first().delete()
+        self.assertSummary(self.conversation, 2)
+
+    def test_user_delete(self):
+        carol = User.objects.create_user(username="carol")
+        with_alice = Conversation.objects.create(name="alice__carol")
+        with_bob = Conversation.objects.create(name="bob__carol")
+        Message.objects.create(from_user=carol, to_user=self.bob, content="hi", conversation=with_bob)
+        Message.objects.create(
+            from_user=self.alice, to_user=carol, content="hi", conversation=with_alice
+        )
+        # the cascade skips MessageQuerySet.delete, the post_delete receiver refreshes
+        carol.delete()
+        self.assertSummary(with_alice, 0)
+        self.assertSummary(with_bob, 0)
+        self.assertSummary(self.conversation, 3)
+
+    def test_inbox_order(self):
+        carol = User.objects.create_user(username="carol")
+        dave = User.objects.create_user(username="dave")
+        Conversation.objects.create(name="alice__dave")
+        recent = Conversation.objects.create(name="alice__carol")
+        Message.objects.create(from_user=carol, to_user=self.alice, content="hi", conversation=recent)
+
+        response = self.client.get("/api/conversations/inbox/")
+        self.assertEqual(response.status_code, 200)
+        # most recent first, never used last
+        self.assertEqual(
+            [row["name"] for row in response.json()], ["alice__carol", "alice__bob", "alice__dave"]
+        )
+        self.assertEqual(response.json()[0]["last_message_preview"], "hi")
+        self.assertEqual(response.json()[0]["message_count"], 1)
+        self.assertEqual(response.json()[1]["message_count"], 3)
+
+
+class UserDirectoryTests(ChatTestCase):
+    URL = "/api/users/directory/"
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        for username in ("Carol", "carla", "dave", "alicia"):
+            User.objects.create_user(username=username, password="pass")
+
+    def usernames(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return [user["username"] for user in response.json()["results"]]
+
+    def test_prefix(self):
+        self.assertEqual(self.usernames(f"{self.URL}?q=da"), ["dave"])
+        self.assertEqual(self.usernames(f"{self.URL}?q=ave"), [])
+
+    def test_case_insensitive(self):
+        self.assertCountEqual(self.usernames(f"{self.URL}?q=CAR"), ["Carol", "carla"])
+
+    def test_excludes_caller(self):
+        self.assertEqual(self.usernames(f"{self.URL}?q=ali"), ["alicia"])
+        self.assertNotIn("alice", self.usernames(self.URL))
+
+    def test_pages(self):
+        usernames = []
+        url = f"{self.URL}?page_size=2"
+        while url:
+            response = self.client.get(url)
+            usernames += [user["username"] for user in response.json()["results"]]
+            url = response.json()["next"]
+        others = User.objects.exclude(pk=self.alice.pk).order_by("username")
+        self.assertEqual(usernames, list(others.values_list("username", flat=True)))
+        self.assertEqual(len(usernames), 5)
+
+    @override_settings(CHAT_USER_DIRECTORY_CACHE_TTL=30)
+    def test_first_page_cached(self):
+        self.assertEqual(self.usernames(f"{self.URL}?q=e"), [])
+        User.objects.create_user(username="erin", password="pass")
+        # cached until the TTL runs out, other searches are not
+        self.assertEqual(self.usernames(f"{self.URL}?q=e"), [])
+        self.assertEqual(self.usernames(f"{self.URL}?q=er"), ["erin"])
+        cache.clear()
+        self.assertEqual(self.usernames(f"{self.URL}?q=e"), ["erin"])
+
+    @override_settings(CHAT_USER_DIRECTORY_CACHE_TTL=30)
+    def test_cache_key(self):
+        query = "x" * 5000 + " \n{}"
+        with mock.patch("chat.views.cache") as cached:
+            cached.get.return_value = None
+            self.usernames(f"{self.URL}?{urlencode({'q': query})}")
+        (key,), _ = cached.get.call_args
+        self.assertLess(len(key), 100)
+        self.assertNotIn("xxx", key)
+
+
+class ConditionalGetTests(ChatTestCase):
+    CONVERSATIONS = "chat.api.reads.conversation_data"
+    CONVERSATION = "chat.api.serializers.ConversationSerializer.to_representation"
+    MESSAGES = "chat.api.reads.message_rows_data"
+
+    def get_twice(self, url, render):
+        """
+        GET `url`, then again with its ETag: 304 and `render` (what builds the body) never called.
+        """
+        first = self.client.get(url)
+        self.assertEqual(first.status_code, 200)
+        self.assertIn("ETag", first)
+
+        with mock.patch(render, autospec=True) as rendered:
+            second = self.client.get(url, HTTP_IF_NONE_MATCH=first["ETag"])
+        self.assertEqual(second.status_code, 304)
+        rendered.assert_not_called()
+        return first
+
+    def test_conversation_list_not_modified(self):
+        self.get_twice("/api/conversations/", self.CONVERSATIONS)
+
+    def test_conversation_retrieve_not_modified(self):
+        self.get_twice("/api/conversations/bob__alice/", self.CONVERSATION)
+
+    def test_message_list_not_modified(self):
+        self.get_twice("/api/messages/?conversation=alice__bob", self.MESSAGES)
+
+    def test_new_message_changes_etag(self):
+        url = "/api/messages/?conversation=alice__bob"
+        first = self.get_twice(url, self.MESSAGES)
+        Message.objects.create(
+            from_user=self.alice, to_user=self.bob, content="new", conversation=self.conversation
+        )
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=first["ETag"])
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], first["ETag"])
+
+    def test_read_changes_etag(self):
+        url = "/api/conversations/"
+        first = self.get_twice(url, self.CONVERSATIONS)
+        self.conversation.mark_read(self.alice)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=first["ETag"])
+        self.assertEqual(response.status_code, 200)
+
+    def test_delete_changes_etag(self):
+        url = "/api/messages/?conversation=alice__bob"
+        first = self.get_twice(url, self.MESSAGES)
+        Message.objects.filter(content="message 0").delete()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=first["ETag"])
+        self.assertEqual(response.status_code, 200)
+
+
+class ResponseCacheTests(ChatTestCase):
+    """
+    Cached REST bodies follow their ETag. TestCase never commits, so the version bumps after
+    commit never run here: exactly what a write made by another worker looks like.
+    """
+
+    def assertFresh(self, url, build):
+        first = self.client.get(url)
+        build()
+        second = self.client.get(url, HTTP_IF_NONE_MATCH=first["ETag"])
+        self.assertEqual(second.status_code, 200)
+        self.assertNotEqual(second.json(), first.json())
+        # and the new body is the one revalidated from now on
+        third = self.client.get(url, HTTP_IF_NONE_MATCH=second["ETag"])
+        self.assertEqual(third.status_code, 304)
+        self.assertEqual(self.client.get(url).json(), second.json())
+        return second.json()
+
+    def new_message(self):
+        Message.objects.create(
+            from_user=self.bob, to_user=self.alice, content="new", conversation=self.conversation
+        )
+
+    def test_new_conversation(self):
+        User.objects.create_user(username="carol")
+
+        def connect():
+            # what chatConsumer.connect does, no message involved
+            Conversation.objects.get_or_create(name="alice__carol")
+
+        data = self.assertFresh("/api/conversations/", connect)
+        self.assertIn("alice__carol", [conversation["name"] for conversation in data])
+
+    def test_new_message(self):
+        for url in (
+            "/api/conversations/",
+            "/api/conversations/inbox/",
+            "/api/conversations/alice__bob/",
+            "/api/messages/?conversation=alice__bob",
+        ):
+            with self.subTest(url=url):
+                self.assertFresh(url, self.new_message)
+
+    def test_read(self):
+        data = self.assertFresh(
+            "/api/messages/?conversation=alice__bob", lambda: self.conversation.mark_read(self.alice)
+        )
+        self.assertTrue(all(message["read"] for message in data["results"]))
+
+
+class SerializerParityTests(ChatTestCase):
+    """
+    The fast message serializers must render exactly what MessageSerializer renders.
+    """
+
+    def setUp(self):
+        super().setUp()
+        Message.objects.create(
+            from_user=self.alice,
+            to_user=self.bob,
+            content='ünïcödé "quotes" \\ and emoji 🙂',
+            conversation=self.conversation,
+        )
+        self.conversation.mark_read(self.alice)
+
+    def assertSameJson(self, fast, drf):
+        self.assertEqual(json.dumps(fast).encode(), json.dumps(drf).encode())
+
+    def test_rows(self):
+        queryset = self.conversation.messages.order_by("-id")
+        self.assertSameJson(
+            message_rows_data(queryset.values_list(*MESSAGE_FIELDS)),
+            MessageSerializer(queryset.select_related("from_user", "to_user"), many=True).data,
+        )
+
+    def test_instance(self):
+        for message in self.conversation.messages.select_related("from_user", "to_user"):
+            with self.subTest(message=message.content):
+                self.assertSameJson(message_data(message), MessageSerializer(message).data)
+
+    def test_new_instance(self):
+        # straight from create(): timestamp still has microseconds, nothing reloaded
+        message = Message.objects.create(
+            from_user=self.bob, to_user=self.alice, content="fresh", conversation=self.conversation
+        )
+        self.assertSameJson(message_data(message), MessageSerializer(message).data)
+
+
+class AsyncReadParityTests(ChatTestCase):
+    """
+    The async routes and the DRF viewsets run the same chat.api.reads coroutines, but each
+    authenticates and renders errors its own way: they must still answer byte for byte the same.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        for i in range(12):
+            Message.objects.create(
+                from_user=cls.alice,
+                to_user=cls.bob,
+                content=f"reply {i}",
+                conversation=cls.conversation,
+            )
+        # left out of the list: a deleted participant and a self-conversation
+        Conversation.objects.create(name="alice__ghost")
+        Conversation.objects.create(name="alice__alice")
+
+    def assertSameResponse(self, url, sync_view, **headers):
+        asynchronous = self.client.get(url, **headers)
+        cache.clear()
+        request = APIRequestFactory().get(url, **headers)
+        synchronous = sync_view(request)
+        if isinstance(synchronous, Response):
+            synchronous.render()
+        self.assertEqual(asynchronous.status_code, synchronous.status_code)
+        self.assertEqual(asynchronous.content, synchronous.content)
+        # (the factory skips the middleware, so no Vary: origin on the sync side)
+        for header in ("Content-Type", "ETag", "Last-Modified", "Allow"):
+            self.assertEqual(asynchronous.get(header), synchronous.get(header), header)
+
+    def test_conversation_list(self):
+        self.assertSameResponse(
+            "/api/conversations/",
+            ConversationViewSet.as_view({"get": "list"}),
+            HTTP_AUTHORIZATION=f"Token {self.token.key}",
+        )
+
+    def test_message_list(self):
+        newest = self.conversation.messages.order_by("-id")[0]
+        for query in (
+            "conversation=alice__bob",
+            "conversation=alice__bob&page=2",
+            "conversation=alice__bob&page_size=4&page=3",
+            f"conversation=alice__bob&before={newest.pk}",
+            "conversation=alice__bob&before=nope",
+            "conversation=alice__bob&page=9",
+            "conversation=alice__nobody",
+        ):
+            with self.subTest(query=query):
+                self.assertSameResponse(
+                    f"/api/messages/?{query}",
+                    MessageViewSet.as_view({"get": "list"}),
+                    HTTP_AUTHORIZATION=f"Token {self.token.key}",
+                )
+
+    def test_unauthenticated(self):
+        for headers in ({}, {"HTTP_AUTHORIZATION": "Token nope"}):
+            with self.subTest(headers=headers):
+                self.client.credentials(**headers)
+                self.assertSameResponse(
+                    "/api/messages/?conversation=alice__bob",
+                    MessageViewSet.as_view({"get": "list"}),
+                    **headers,
+                )
+
+    def test_conversation_data(self):
+        conversations = Conversation.objects.involving("alice").select_related(
+            "last_message__from_user", "last_message__to_user"
+        )
+        request = APIRequestFactory().get("/api/conversations/")
+        request.user = self.alice
+        context = {"request": request, "existing_usernames": {"bob"}}
+        self.assertEqual(
+            json.dumps([conversation_data(c, "alice", {"bob"}) for c in conversations]),
+            json.dumps(ConversationSerializer(conversations, many=True, context=context).data),
+        )
+
+
+IN_MEMORY_CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class QueryBudgetTests(ChatTestCase):
+    """
+    Every websocket event and api route has to run the same number of queries whatever the
+    amount of data. Each check runs a path against growing fixtures and, if the count moves,
+    fails with the SQL of the biggest run so the N+1 is easy to spot.
+    """
+
+    SIZES = (1, 5, 25)
+
+    def assertConstantQueries(self, run, grow):
+        runs = []
+        for size in self.SIZES:
+            grow(size)
+            cache.clear()
+            with CaptureQueriesContext(connection) as queries:
+                run()
+            runs.append((size, queries.captured_queries))
+
+        counts = {size: len(queries) for size, queries in runs}
+        if len(set(counts.values())) > 1:
+            size, queries = runs[-1]
+            sql = "\n".join(f"{i}. {query['sql']}" for i, query in enumerate(queries, 1))
+            self.fail(f"Query count grows with fixture size {counts}\nQueries at size {size}:\n{sql}")
+
+    # fixtures
+
+    def grow_messages(self, size):
+        while self.conversation.messages.count() < size:
+            Message.objects.create(
+                from_user=self.bob,
+                to_user=self.alice,
+                content="hello",
+                conversation=self.conversation,
+            )
+
+    def grow_conversations(self, size):
+        for i in range(size):
+            other, _ = User.objects.get_or_create(username=f"user{i}")
+            conversation, created = Conversation.objects.get_or_create(
+                name="__".join(sorted(["alice", other.username]))
+            )
+            if created:
+                Message.objects.create(
+                    from_user=other, to_user=self.alice, content="hi", conversation=conversation
+                )
+
+    # websocket paths
+
+    def run_socket(self, path, events=(), expect=()):
+        """
+        Connect to `path` as alice, wait for the `expect` frame types, send `events`, disconnect.
+        """
+
+        async def session():
+            communicator = WebsocketCommunicator(application, f"{path}?token={self.token.key}")
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            for content in events:
+                await communicator.send_json_to(content)
+            pending = list(expect)
+            while pending:
+                frame = await communicator.receive_json_from()
+                if frame["type"] in pending:
+                    pending.remove(frame["type"])
+            await communicator.disconnect()
+
+        async_to_sync(session)()
+
+    def test_chat_connect(self):
+        self.assertConstantQueries(
+            lambda: self.run_socket("/chats/alice__bob/", expect=["last_50_messages"]),
+            self.grow_messages,
+        )
+
+    def test_chat_typing(self):
+        self.assertConstantQueries(
+            lambda: self.run_socket(
+                "/chats/alice__bob/",
+                events=[{"type": "typing", "typing": True}],
+                expect=["last_50_messages", "typing"],
+            ),
+            self.grow_messages,
+        )
+
+    def test_chat_message(self):
+        self.assertConstantQueries(
+            lambda: self.run_socket(
+                "/chats/alice__bob/",
+                events=[{"type": "chat_message", "message": "hi bob"}],
+                expect=["last_50_messages", "chat_message_echo"],
+            ),
+            self.grow_messages,
+        )
+
+    def test_chat_read_messages(self):
+        def grow(size):
+            self.grow_messages(size)
+            self.conversation.messages.update(read=False)
+
+        self.assertConstantQueries(
+            lambda: self.run_socket(
+                "/chats/alice__bob/",
+                events=[{"type": "read_messages"}],
+                expect=["last_50_messages"],
+            ),
+            grow,
+        )
+
+    def test_chat_load_history(self):
+        newest = Message.objects.create(
+            from_user=self.alice, to_user=self.bob, content="newest", conversation=self.conversation
+        )
+        self.assertConstantQueries(
+            lambda: self.run_socket(
+                "/chats/alice__bob/",
+                events=[{"type": "load_history", "before": str(newest.pk), "page_size": 100}],
+                expect=["history_page"],
+            ),
+            self.grow_messages,
+        )
+
+    def test_notifications_connect(self):
+        self.assertConstantQueries(
+            lambda: self.run_socket("/notifications/", expect=["unread_count"]),
+            self.grow_messages,
+        )
+
+    # api routes
+
+    def get(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200, url)
+        if response.streaming:
+            b"".join(response.streaming_content)
+
+    def test_conversation_list(self):
+        self.assertConstantQueries(lambda: self.get("/api/conversations/"), self.grow_conversations)
+
+    def test_conversation_inbox(self):
+        self.assertConstantQueries(
+            lambda: self.get("/api/conversations/inbox/"), self.grow_conversations
+        )
+
+    def test_conversation_retrieve(self):
+        self.assertConstantQueries(
+            lambda: self.get("/api/conversations/alice__bob/"), self.grow_messages
+        )
+
+    def test_message_list(self):
+        self.assertConstantQueries(
+            lambda: self.get("/api/messages/?conversation=alice__bob&page_size=100"),
+            self.grow_messages,
+        )
+
+    def test_message_list_older_page(self):
+        self.assertConstantQueries(
+            lambda: self.get("/api/messages/?conversation=alice__bob&page_size=2&page=2"),
+            self.grow_messages,
+        )
+
+    def test_message_export(self):
+        self.assertConstantQueries(
+            lambda: self.get("/api/messages/export/?conversation=alice__bob"),
+            self.grow_messages,
+        )
+
+    def test_user_routes(self):
+        for url in ("/api/users/me/", "/api/users/all/", "/api/users/directory/?q=user"):
+            with self.subTest(url=url):
+                self.assertConstantQueries(lambda: self.get(url), self.grow_conversations)
+
+    def test_auth_token(self):
+        def run():
+            response = self.client.post("/auth-token/", {"username": "alice", "password": "pass"})
+            self.assertEqual(response.status_code, 200)
+
+        self.assertConstantQueries(run, self.grow_conversations)
+
+
+class ExportTests(ChatTestCase):
+    """
+    /api/messages/export/ over ASGI (how daphne serves it) and over WSGI.
+    """
+
+    URL = "/api/messages/export/?conversation=bob__alice"
+
+    def expected_rows(self):
+        return message_rows_data(
+            self.conversation.messages.order_by("id").values_list(*MESSAGE_FIELDS)
+        )
+
+    def asgi_get(self, path, accept_encoding=""):
+        """
+        The export view's response to an ASGI request, and its body read the way the ASGI
+        handler reads it. (The view is called directly: through root.asgi.application the
+        request would run in its own thread, outside this test's transaction.)
+        """
+        request = AsyncRequestFactory().get(
+            path,
+            headers={"authorization": f"Token {self.token.key}", "accept-encoding": accept_encoding},
+        )
+        response = MessageViewSet.as_view({"get": "export"})(request)
+        self.assertEqual(response.status_code, 200)
+        # a sync iterator would be read whole before the first byte is sent
+        self.assertTrue(response.is_async)
+
+        async def read():
+            return b"".join([part async for part in response])
+
+        return response, async_to_sync(read)()
+
+    def test_ndjson(self):
+        # 3 messages, read two per query
+        with mock.patch("chat.api.export.CHUNK_SIZE", 2):
+            response, body = self.asgi_get(self.URL)
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        rows = [json.loads(line) for line in body.decode().splitlines()]
+        self.assertEqual(rows, self.expected_rows())
+
+    def test_csv_gzip(self):
+        response, body = self.asgi_get(self.URL + "&output=csv", accept_encoding="gzip")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        lines = list(csv.reader(io.StringIO(gzip.decompress(body).decode())))
+        self.assertEqual(tuple(lines[0]), CSV_HEADER)
+        self.assertEqual(
+            [line[0] for line in lines[1:]], [row["id"] for row in self.expected_rows()]
+        )
+
+    def test_wsgi_gzip(self):
+        response = self.client.get(self.URL, HTTP_ACCEPT_ENCODING="gzip")
+        body = gzip.decompress(b"".join(response.streaming_content))
+        rows = [json.loads(line) for line in body.decode().splitlines()]
+        self.assertEqual(rows, self.expected_rows())
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class LoadHistoryTests(ChatTestCase):
+    """
+    load_history pages over the chat socket, newest first like /api/messages/.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        for i in range(7):
+            Message.objects.create(
+                from_user=cls.alice,
+                to_user=cls.bob,
+                content=f"reply {i}",
+                conversation=cls.conversation,
+                read=True,
+            )
+
+    def run_socket(self, requests):
+        """
+        Send each of `requests` on alice's chat socket and return the answer to each.
+        """
+
+        async def session():
+            communicator = WebsocketCommunicator(
+                application, f"/chats/alice__bob/?token={self.token.key}"
+            )
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            answers = []
+            for content in requests:
+                await communicator.send_json_to(content)
+                if content["type"] != "load_history":
+                    continue
+                frame = await communicator.receive_json_from()
+                while not frame["type"].startswith(("history_page", "load_history")):
+                    frame = await communicator.receive_json_from()
+                answers.append(frame)
+            await communicator.disconnect()
+            return answers
+
+        return async_to_sync(session)()
+
+    def test_pages(self):
+        expected = message_rows_data(
+            self.conversation.messages.order_by("-id").values_list(*MESSAGE_FIELDS)
+        )
+        (first,) = self.run_socket([{"type": "load_history", "page_size": 6}])
+        (second,) = self.run_socket(
+            [{"type": "load_history", "page_size": 6, "before": first["messages"][-1]["id"]}]
+        )
+        self.assertTrue(first["has_more"])
+        self.assertFalse(second["has_more"])
+        self.assertEqual(first["messages"] + second["messages"], expected)
+
+    def test_bad_cursor(self):
+        (answer,) = self.run_socket([{"type": "load_history", "before": "nope"}])
+        self.assertEqual(answer["type"], "load_history_error")
+
+    def test_cached_until_the_conversation_changes(self):
+        load = {"type": "load_history", "page_size": 10}
+        rendered = mock.patch("chat.consumers.message_rows_data", side_effect=message_rows_data)
+        # TestCase never commits, bump the conversation version right away
+        bump_now = mock.patch.object(transaction, "on_commit", lambda callback: callback())
+        with rendered as rendered, bump_now:
+            first, again, after_read = self.run_socket(
+                [load, load, {"type": "read_messages"}, load]
+            )
+        # the history sent on connect, the first load and the load after the read
+        self.assertEqual(rendered.call_count, 3)
+        self.assertEqual(first, again)
+        self.assertNotEqual(first, after_read)
+        self.assertTrue(all(message["read"] for message in after_read["messages"]))
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class ClientIdTests(ChatTestCase):
+    """
+    chat_message frames tagged with a client_id: acked, and stored once however often resent.
+    """
+
+    def send(self, *frames, forget_between=False):
+        """
+        Send each chat_message frame on alice's chat socket, return the acks and echoes it got.
+        forget_between clears the cache (the seen-set) between two frames.
+        """
+
+        async def session():
+            communicator = WebsocketCommunicator(
+                application, f"/chats/alice__bob/?token={self.token.key}"
+            )
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            received = []
+            for content in frames:
+                if forget_between:
+                    await sync_to_async(cache.clear)()
+                await communicator.send_json_to({"type": "chat_message", **content})
+                while not await communicator.receive_nothing():
+                    frame = await communicator.receive_json_from()
+                    if frame["type"] in ("chat_message_ack", "chat_message_echo"):
+                        received.append(frame)
+            await communicator.disconnect()
+            return received
+
+        return async_to_sync(session)()
+
+    def stored(self, client_id):
+        return list(Message.objects.filter(from_user=self.alice, client_id=client_id))
+
+    def test_ack(self):
+        ack, echo = self.send({"message": "hi", "client_id": "c1"})
+        (message,) = self.stored("c1")
+        self.assertEqual(
+            ack,
+            {
+                "type": "chat_message_ack",
+                "client_id": "c1",
+                "id": str(message.id),
+                "timestamp": echo["message"]["timestamp"],
+                "duplicate": False,
+            },
+        )
+        self.assertEqual(echo["message"]["id"], str(message.id))
+
+    def test_without_client_id(self):
+        (echo,) = self.send({"message": "hi"})
+        self.assertEqual(echo["type"], "chat_message_echo")
+
+    def test_resend(self):
+        frame = {"message": "hi", "client_id": "c1"}
+        ack, echo, again = self.send(frame, frame)
+        # answered from the seen-set: acked again, not stored or broadcast twice
+        self.assertEqual(again, {**ack, "duplicate": True})
+        self.assertEqual(len(self.stored("c1")), 1)
+
+    def test_resend_after_the_cache_forgot(self):
+        frame = {"message": "hi", "client_id": "c1"}
+        ack, echo, again = self.send(frame, frame, forget_between=True)
+        # not in the seen-set any more, the unique constraint catches it
+        self.assertEqual(again, {**ack, "duplicate": True})
+        self.assertEqual(len(self.stored("c1")), 1)
+
+    def test_client_ids_are_per_sender(self):
+        Message.objects.create(
+            from_user=self.bob,
+            to_user=self.alice,
+            content="same id, other sender",
+            conversation=self.conversation,
+            client_id="c1",
+        )
+        ack, echo = self.send({"message": "hi", "client_id": "c1"})
+        self.assertFalse(ack["duplicate"])
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+@mock.patch("chat.consumers.NOTIFICATION_WINDOW", 0.2)
+class NotificationDigestTests(ChatTestCase):
+    """
+    Messages alice sends bob while bob only has his notification socket open.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.bob_token = Token.objects.create(user=self.bob)
+
+    def run_sockets(self, session):
+        async def run():
+            chat = WebsocketCommunicator(application, f"/chats/alice__bob/?token={self.token.key}")
+            notifications = WebsocketCommunicator(
+                application, f"/notifications/?token={self.bob_token.key}"
+            )
+            for communicator in (chat, notifications):
+                connected, _ = await communicator.connect()
+                self.assertTrue(connected)
+            # unread_count and whatever the outbox still holds
+            while not await notifications.receive_nothing():
+                await notifications.receive_output()
+
+            async def send(text):
+                await chat.send_json_to({"type": "chat_message", "message": text})
+
+            async def frames():
+                received = []
+                while not await notifications.receive_nothing(0.5):
+                    received.append(await notifications.receive_json_from())
+                return received
+
+            await session(send, frames)
+            for communicator in (chat, notifications):
+                await communicator.disconnect()
+
+        async_to_sync(run)()
+
+    def test_coalesced(self):
+        async def session(send, frames):
+            for i in range(3):
+                await send(f"hi {i}")
+            (digest,) = await frames()
+            self.assertEqual(digest["type"], "new_message_digest")
+            self.assertEqual(digest["unread_count"], 3)
+            self.assertEqual(digest["conversations"][0]["name"], "alice__bob")
+            self.assertEqual(digest["conversations"][0]["last_message_preview"], "hi 2")
+
+        self.run_sockets(session)
+
+    def test_next_window(self):
+        async def session(send, frames):
+            await send("first")
+            self.assertEqual([digest["unread_count"] for digest in await frames()], [1])
+            # right after the flush, well before the gate's whole second would run out
+            await send("second")
+            self.assertEqual([digest["unread_count"] for digest in await frames()], [2])
+
+        self.run_sockets(session)
+
+    def test_receiver_in_the_chat(self):
+        async def session(send, frames):
+            # bob reads the echo in the open chat, no digest for it
+            bob_chat = WebsocketCommunicator(
+                application, f"/chats/alice__bob/?token={self.bob_token.key}"
+            )
+            connected, _ = await bob_chat.connect()
+            self.assertTrue(connected)
+            await send("seen")
+            self.assertEqual(await frames(), [])
+            await bob_chat.disconnect()
+
+        self.run_sockets(session)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class ConnectionRegistryTests(ChatTestCase):
+    """
+    The registry of this process, and /api/connections/ gathering the registries of every worker
+    over the channel layer.
+    """
+
+    def setUp(self):
+        super().setUp()
+        admin = User.objects.create_user(username="admin", is_staff=True)
+        self.admin = APIClient()
+        self.admin.force_authenticate(admin)
+
+    def run_socket(self, check):
+        """
+        `check(communicator)` with alice's chat socket open. Runs on the loop the registry
+        listener runs on, views are called through sync_to_async.
+        """
+
+        async def session():
+            communicator = WebsocketCommunicator(
+                application, f"/chats/alice__bob/?token={self.token.key}"
+            )
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            while not await communicator.receive_nothing():
+                await communicator.receive_output()
+            await check(communicator)
+            await communicator.disconnect()
+
+        async_to_sync(session)()
+
+    async def other_worker(self, connections_list):
+        """
+        Joins the registry group like a second worker's listener, answers one report request.
+        """
+        channel_layer = get_channel_layer()
+        channel_name = await channel_layer.new_channel("registry.")
+        await channel_layer.group_add(connections.REGISTRY_GROUP, channel_name)
+
+        async def answer():
+            message = await channel_layer.receive(channel_name)
+            await channel_layer.send(
+                message["reply_to"],
+                {
+                    "type": "registry.snapshot",
+                    "worker": "other:1",
+                    "connections": connections_list,
+                    "latency": {},
+                },
+            )
+            await channel_layer.group_discard(connections.REGISTRY_GROUP, channel_name)
+
+        return asyncio.ensure_future(answer())
+
+    def test_snapshot(self):
+        async def check(communicator):
+            await communicator.send_json_to({"type": "typing", "typing": True})
+            await communicator.receive_json_from()
+            report = connections.snapshot()
+            self.assertEqual(report["worker"], connections.WORKER)
+            (connection,) = report["connections"]
+            self.assertEqual(connection["consumer"], "chatConsumer")
+            self.assertEqual(connection["user"], "alice")
+            self.assertEqual(connection["path"], "/chats/alice__bob/")
+            self.assertEqual(connection["groups"], ["alice__bob"])
+            self.assertEqual(connection["messages_in"], 1)
+            self.assertGreater(connection["messages_out"], 1)
+            self.assertEqual(connection["backlog"], 0)
+
+        self.run_socket(check)
+        self.assertEqual(connections.snapshot()["connections"], [])
+
+    def test_every_worker(self):
+        elsewhere = [
+            {"channel_name": "specific.x!a", "user": "alice", "groups": ["alice__carol"]},
+            {"channel_name": "specific.x!b", "user": "bob", "groups": ["alice__bob"]},
+        ]
+
+        async def check(communicator):
+            answered = await self.other_worker(elsewhere)
+            response = await sync_to_async(self.admin.get)("/api/connections/?user=alice")
+            await answered
+            self.assertEqual(response.status_code, 200)
+            workers = {report["worker"]: report for report in response.json()["workers"]}
+            self.assertEqual(set(workers), {connections.WORKER, "other:1"})
+            self.assertEqual(
+                [connection["user"] for connection in workers[connections.WORKER]["connections"]],
+                ["alice"],
+            )
+            self.assertEqual(workers["other:1"]["connections"], elsewhere[:1])
+            self.assertEqual(response.json()["total"], 2)
+
+        self.run_socket(check)
+
+    def test_admins_only(self):
+        self.assertEqual(self.client.get("/api/connections/").status_code, 403)
+
+    def test_kick(self):
+        async def check(communicator):
+            (channel_name,) = connections.channel_names()
+            response = await sync_to_async(self.admin.post)(
+                "/api/connections/",
+                {"action": "kick", "channels": [channel_name]},
+                format="json",
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(await communicator.receive_json_from(), {"type": "kicked"})
+            self.assertEqual(
+                await communicator.receive_output(),
+                {"type": "websocket.close", "code": connections.KICK_CLOSE_CODE},
+            )
+
+        self.run_socket(check)
+
+    def test_bad_requests(self):
+        for data in (
+            {"action": "ban", "channels": ["specific.x!a"]},
+            {"action": "kick", "channels": []},
+            {"action": "kick", "channels": "specific.x!a"},
+            {"action": "drain", "channels": ["specific.x!a"], "window": "soon"},
+        ):
+            with self.subTest(data=data):
+                response = self.admin.post("/api/connections/", data, format="json")
+                self.assertEqual(response.status_code, 400)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class TracingTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        # a fresh histogram and trace log for every test
+        empty = mock.patch.multiple(
+            tracing,
+            _histogram={stage: [0] * (len(tracing.BUCKETS) + 1) for stage in tracing.STAGES[1:]},
+            _totals={stage: [0, 0.0] for stage in tracing.STAGES[1:]},
+            _recent=collections.deque(maxlen=tracing.RECENT_TRACES),
+        )
+        empty.start()
+        self.addCleanup(empty.stop)
+
+    def trace(self, **marks):
+        return {"id": "t1", "started_at": 1700000000.0, "marks": marks}
+
+    def test_finish(self):
+        trace = self.trace(receive=10.0, db_write=10.003, publish=10.004, dispatch=10.01, send=10.0105)
+        tracing.finish(trace, "specific.x!a")
+        (entry,) = tracing.recent()
+        self.assertEqual(entry["recipient"], "specific.x!a")
+        self.assertEqual(
+            entry["stages_ms"], {"db_write": 3.0, "publish": 1.0, "dispatch": 6.0, "send": 0.5}
+        )
+        self.assertEqual(entry["total_ms"], 10.5)
+
+        histogram = tracing.histogram()
+        for stage, bucket in (("db_write", "5"), ("publish", "1"), ("dispatch", "10"), ("send", "1")):
+            self.assertEqual(histogram[stage]["count"], 1)
+            self.assertEqual(
+                {label: count for label, count in histogram[stage]["buckets"].items() if count},
+                {bucket: 1},
+            )
+
+    def test_histogram(self):
+        for ms in (0.5, 30, 30, 5000):
+            tracing.finish(self.trace(receive=0.0, db_write=ms / 1000), "specific.x!a")
+        stage = tracing.histogram()["db_write"]
+        self.assertEqual(stage["count"], 4)
+        self.assertEqual(stage["mean_ms"], 1265.125)
+        self.assertEqual(stage["buckets"]["1"], 1)
+        self.assertEqual(stage["buckets"]["50"], 2)
+        self.assertEqual(stage["buckets"]["+Inf"], 1)
+        # stages without traces
+        self.assertEqual(tracing.histogram()["send"]["mean_ms"], None)
+
+    def test_missing_mark(self):
+        # no db_write mark: publish is measured from receive
+        tracing.finish(self.trace(receive=0.0, publish=0.002), "specific.x!a")
+        (entry,) = tracing.recent()
+        self.assertEqual(entry["stages_ms"], {"publish": 2.0})
+
+    def test_not_sampled(self):
+        with mock.patch.object(tracing, "SAMPLE_RATE", 0.0):
+            self.assertIsNone(tracing.start())
+        tracing.finish(None, "specific.x!a")
+        self.assertEqual(tracing.recent(), [])
+
+    @mock.patch.object(tracing, "SAMPLE_RATE", 1.0)
+    def test_chat_message(self):
+        admin = User.objects.create_user(username="admin", is_staff=True)
+        client = APIClient()
+        client.force_authenticate(admin)
+
+        async def session():
+            communicator = WebsocketCommunicator(
+                application, f"/chats/alice__bob/?token={self.token.key}"
+            )
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            await communicator.send_json_to({"type": "chat_message", "message": "traced"})
+            frame = await communicator.receive_json_from()
+            while frame["type"] != "chat_message_echo":
+                frame = await communicator.receive_json_from()
+            # the trace stays on the server
+            self.assertNotIn("trace", frame)
+            response = await sync_to_async(client.get)("/api/traces/")
+            self.assertFalse(response.streaming)
+            body = response.content
+            await communicator.disconnect()
+            return body
+
+        body = async_to_sync(session)()
+        (line,) = body.decode().splitlines()
+        trace = json.loads(line)
+        self.assertEqual(trace["worker"], connections.WORKER)
+        self.assertEqual(list(trace["stages_ms"]), list(tracing.STAGES[1:]))
+        self.assertEqual(tracing.histogram()["send"]["count"], 1)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class CaptureReplayTests(ChatTestCase):
+    """
+    A recorded chat session (chat.capture), and replay_traffic playing it back.
+    """
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = directory.name
+
+    def record(self):
+        async def session():
+            communicator = WebsocketCommunicator(
+                application, f"/chats/alice__bob/?token={self.token.key}"
+            )
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            await communicator.send_json_to({"type": "typing", "typing": True})
+            await communicator.send_json_to({"type": "chat_message", "message": "hello bob"})
+            frame = await communicator.receive_json_from()
+            while frame["type"] != "chat_message_echo":
+                frame = await communicator.receive_json_from()
+            await communicator.disconnect()
+
+        with mock.patch.object(capture, "CAPTURE_PATH", self.path):
+            async_to_sync(session)()
+        (name,) = os.listdir(self.path)
+        return os.path.join(self.path, name)
+
+    def test_anonymize_frame(self):
+        frame = {
+            "type": "chat_message",
+            "message": "hello",
+            "client_id": "0190a2b4-5c6d-7e8f-9a0b-1c2d3e4f5a6b",
+            "page_size": 10,
+            "nested": [{"type": "x", "name": "bob"}],
+        }
+        self.assertEqual(
+            capture.anonymize_frame(json.dumps(frame)),
+            {**frame, "message": "xxxxx", "nested": [{"type": "x", "name": "xxx"}]},
+        )
+        self.assertIsNone(capture.anonymize_frame("not json"))
+
+    def test_record(self):
+        path = self.record()
+        with gzip.open(path, "rt") as raw:
+            text = raw.read()
+        for secret in ("alice", "bob", self.token.key, "hello"):
+            self.assertNotIn(secret, text)
+
+        header, events = capture.read_session(path)
+        alice, bob = capture.pseudonym("alice"), capture.pseudonym("bob")
+        self.assertEqual(header["user"], alice)
+        self.assertEqual(header["path"], f"/chats/{alice}__{bob}/")
+        kinds = [event[1] for event in events]
+        self.assertEqual(kinds[:2], ["connect", "accept"])
+        self.assertEqual(kinds[-1], "disconnect")
+        self.assertEqual(
+            [event[2] for event in events if event[1] == "in"],
+            [
+                {"type": "typing", "typing": True},
+                {"type": "chat_message", "message": "xxxxxxxxx"},
+            ],
+        )
+        self.assertIn("chat_message_echo", [event[2] for event in events if event[1] == "out"])
+        offsets = [event[0] for event in events]
+        self.assertEqual(offsets, sorted(offsets))
+
+    @mock.patch.object(tracing, "SAMPLE_RATE", 0.0)
+    @mock.patch.object(capture, "CAPTURE_PATH", None)
+    def test_replay(self):
+        path = self.record()
+        out = io.StringIO()
+        call_command("replay_traffic", path, "--speed=50", "--in-memory-layer", stdout=out)
+        self.assertIn("Replaying 1 sessions at 50x", out.getvalue())
+        self.assertIn("connections   1 (0 rejected)", out.getvalue())
+
+        alice, bob = capture.pseudonym("alice"), capture.pseudonym("bob")
+        (message,) = Message.objects.filter(from_user__username=f"replay-{alice}")
+        self.assertEqual(message.to_user.username, f"replay-{bob}")
+        self.assertEqual(message.content, "xxxxxxxxx")
+        self.assertEqual(message.conversation.name, f"replay-{alice}__replay-{bob}")
+        # the replay itself was not recorded
+        self.assertEqual(os.listdir(self.path), [os.path.basename(path)])
+
+
+class OutboxTests:
+    """
+    The behaviour both outbox backends share, see LocalOutboxTests and RedisOutboxTests.
+    """
+
+    def make_outbox(self):
+        raise NotImplementedError
+
+    def setUp(self):
+        super().setUp()
+        self.outbox = self.make_outbox()
+        self.user = f"outbox-test-{uuid7().hex}"
+
+    def append(self, *numbers):
+        return [self.outbox.append(self.user, {"type": "new_message", "n": n}) for n in numbers]
+
+    def numbers(self, entries):
+        return [event["n"] for cursor, event in entries]
+
+    def test_append_and_read(self):
+        cursors = self.append(1, 2, 3)
+        self.assertTrue(all(outbox.valid_cursor(cursor) for cursor in cursors))
+        self.assertEqual(cursors, sorted(cursors, key=lambda cursor: outbox._parse(cursor)))
+        entries = self.outbox.read(self.user)
+        self.assertEqual([cursor for cursor, event in entries], cursors)
+        self.assertEqual(self.numbers(entries), [1, 2, 3])
+        self.assertEqual(self.outbox.last_cursor(self.user), cursors[-1])
+        # other users' outboxes are separate
+        self.assertEqual(self.outbox.read(self.user + "-other"), [])
+        self.assertIsNone(self.outbox.last_cursor(self.user + "-other"))
+
+    def test_read_after_cursor(self):
+        cursors = self.append(1, 2, 3)
+        self.assertEqual(self.numbers(self.outbox.read(self.user, cursors[0])), [2, 3])
+        self.assertEqual(self.outbox.read(self.user, cursors[-1]), [])
+
+    def test_trim(self):
+        cursors = self.append(1, 2, 3)
+        self.outbox.trim(self.user, cursors[1])
+        self.assertEqual(self.numbers(self.outbox.read(self.user)), [3])
+        self.outbox.trim(self.user, cursors[2])
+        self.assertEqual(self.outbox.read(self.user), [])
+
+
+class LocalOutboxTests(OutboxTests, TestCase):
+    def make_outbox(self):
+        return outbox.LocalOutbox()
+
+    def test_size(self):
+        with mock.patch.object(outbox, "SIZE", 2):
+            self.append(1, 2, 3)
+        self.assertEqual(self.numbers(self.outbox.read(self.user)), [2, 3])
+
+
+class FakeRedis:
+    """
+    The stream commands RedisOutbox uses, with redis' semantics, to run it without a server.
+    """
+
+    def __init__(self):
+        self.streams = {}
+        self.ttls = {}
+        self.last = (0, 0)
+
+    @classmethod
+    def from_url(cls, url, decode_responses=False):
+        # RedisOutbox reads str ids and fields back
+        assert decode_responses
+        return cls()
+
+    def pipeline(self):
+        fake = self
+
+        class Pipeline:
+            def __init__(self):
+                self.calls = []
+
+            def __getattr__(self, name):
+                return lambda *args, **kwargs: self.calls.append((name, args, kwargs))
+
+            def execute(self):
+                return [getattr(fake, name)(*args, **kwargs) for name, args, kwargs in self.calls]
+
+        return Pipeline()
+
+    def _in_range(self, entry_id, min, max):
+        """
+        XRANGE bounds: "-" / "+", "<ms>-<seq>" or, exclusive, "(<ms>-<seq>".
+        """
+        entry = outbox._parse(entry_id)
+        if min != "-":
+            low = outbox._parse(min.lstrip("("))
+            if entry < low or (min.startswith("(") and entry == low):
+                return False
+        if max != "+":
+            high = outbox._parse(max.lstrip("("))
+            if entry > high or (max.startswith("(") and entry == high):
+                return False
+        return True
+
+    def xadd(self, name, fields, maxlen=None, approximate=True):
+        ms = time.time_ns() // 1_000_000
+        self.last = (ms, 0) if ms > self.last[0] else (self.last[0], self.last[1] + 1)
+        entry_id = f"{self.last[0]}-{self.last[1]}"
+        stream = self.streams.setdefault(name, [])
+        stream.append((entry_id, dict(fields)))
+        if maxlen is not None:
+            del stream[: max(len(stream) - maxlen, 0)]
+        return entry_id
+
+    def expire(self, name, seconds):
+        if name not in self.streams:
+            return False
+        self.ttls[name] = seconds
+        return True
+
+    def ttl(self, name):
+        return self.ttls.get(name, -1) if name in self.streams else -2
+
+    def delete(self, *names):
+        return sum(self.streams.pop(name, None) is not None for name in names)
+
+    def xrange(self, name, min="-", max="+", count=None):
+        entries = [
+            (entry_id, fields)
+            for entry_id, fields in self.streams.get(name, [])
+            if self._in_range(entry_id, min, max)
+        ]
+        return entries[:count] if count else entries
+
+    def xrevrange(self, name, max="+", min="-", count=None):
+        entries = self.xrange(name, min, max)[::-1]
+        return entries[:count] if count else entries
+
+    def xtrim(self, name, maxlen=None, approximate=True, minid=None):
+        stream = self.streams.get(name, [])
+        keep = [entry for entry in stream if outbox._parse(entry[0]) >= outbox._parse(minid)]
+        self.streams[name] = keep
+        return len(stream) - len(keep)
+
+
+def fake_redis_module():
+    return mock.patch.dict(sys.modules, {"redis": types.SimpleNamespace(Redis=FakeRedis)})
+
+
+class RedisOutboxTests(OutboxTests, TestCase):
+    """
+    RedisOutbox against FakeRedis, LiveRedisOutboxTests runs the same against a real server.
+    """
+
+    def make_outbox(self):
+        with fake_redis_module():
+            return outbox.RedisOutbox("redis://fake")
+
+    def test_expiry(self):
+        self.append(1)
+        ttl = self.outbox.redis.ttl(self.outbox.key(self.user))
+        self.assertTrue(0 < ttl <= outbox.TTL)
+
+    def test_get_outbox(self):
+        with fake_redis_module(), mock.patch.object(outbox, "_outbox", None), mock.patch.object(
+            outbox, "REDIS_URL", "redis://fake"
+        ):
+            self.assertIsInstance(outbox.get_outbox(), outbox.RedisOutbox)
+
+
+@skipUnless(
+    os.environ.get("TEST_REDIS_URL"), "set TEST_REDIS_URL (a scratch redis) to test RedisOutbox"
+)
+class LiveRedisOutboxTests(RedisOutboxTests):
+    def make_outbox(self):
+        redis_outbox = outbox.RedisOutbox(os.environ["TEST_REDIS_URL"])
+        self.addCleanup(lambda: redis_outbox.redis.delete(redis_outbox.key(self.user)))
+        return redis_outbox
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class OutboxReplayTests(ChatTestCase):
+    """
+    The notification socket replaying alice's outbox on connect, and trimming it on ack.
+    """
+
+    def make_outbox(self):
+        return outbox.LocalOutbox()
+
+    def setUp(self):
+        super().setUp()
+        patched = mock.patch.object(outbox, "_outbox", self.make_outbox())
+        patched.start()
+        self.addCleanup(patched.stop)
+        self.cursors = [
+            outbox.append("alice", {"type": "new_message", "n": n}) for n in range(3)
+        ]
+
+    def connect(self, cursor="", ack=None):
+        """
+        The frames sent on connect by alice's notification socket opened with ?cursor=.
+        """
+
+        async def session():
+            communicator = WebsocketCommunicator(
+                application, f"/notifications/?token={self.token.key}&cursor={cursor}"
+            )
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            frames = []
+            while not await communicator.receive_nothing():
+                frames.append(await communicator.receive_json_from())
+            if ack:
+                await communicator.send_json_to({"type": "ack", "cursor": ack})
+                await communicator.receive_nothing()
+            await communicator.disconnect()
+            return {frame["type"]: frame for frame in frames}
+
+        return async_to_sync(session)()
+
+    def test_replay_everything(self):
+        missed = self.connect()["missed_notifications"]
+        self.assertEqual(missed["cursor"], self.cursors[-1])
+        self.assertEqual([event["n"] for event in missed["events"]], [0, 1, 2])
+        self.assertEqual([event["cursor"] for event in missed["events"]], self.cursors)
+
+    def test_replay_after_cursor(self):
+        missed = self.connect(self.cursors[0])["missed_notifications"]
+        self.assertEqual([event["n"] for event in missed["events"]], [1, 2])
+
+    def test_nothing_missed(self):
+        self.assertNotIn("missed_notifications", self.connect(self.cursors[-1]))
+
+    def test_bad_cursor(self):
+        # replays everything
+        missed = self.connect("yesterday")["missed_notifications"]
+        self.assertEqual(len(missed["events"]), 3)
+
+    def test_ack(self):
+        self.connect(ack=self.cursors[1])
+        self.assertEqual([event["n"] for cursor, event in outbox.read("alice")], [2])
+
+    def test_chat_message_appends(self):
+        bob_token = Token.objects.create(user=self.bob)
+
+        async def send():
+            communicator = WebsocketCommunicator(
+                application, f"/chats/alice__bob/?token={bob_token.key}"
+            )
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            await communicator.send_json_to({"type": "chat_message", "message": "while away"})
+            frame = await communicator.receive_json_from()
+            while frame["type"] != "chat_message_echo":
+                frame = await communicator.receive_json_from()
+            await communicator.disconnect()
+
+        async_to_sync(send)()
+        (cursor, event), = outbox.read("alice", self.cursors[-1])
+        self.assertEqual(event["type"], "new_message")
+        self.assertEqual(event["from_user"], "bob")
+        self.assertEqual(event["conversation"], "alice__bob")
+        self.assertEqual(event["preview"], "while away")
+
+
+class RedisOutboxReplayTests(OutboxReplayTests):
+    """
+    The same with the redis backend (FakeRedis), the one several workers run on.
+    """
+
+    def make_outbox(self):
+        with fake_redis_module():
+            return outbox.RedisOutbox("redis://fake")
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class DrainTests(ChatTestCase):
+    """
+    connections.drain, as run by a serve worker on SIGTERM (or by an admin for some sockets).
+    """
+
+    def run_sockets(self, drain):
+        """
+        Open a chat and a notification socket as alice, `drain(channels)`, and return what
+        each socket got afterwards, in order (None for nothing).
+        """
+
+        async def session():
+            communicators = [
+                WebsocketCommunicator(application, f"{path}?token={self.token.key}")
+                for path in ("/chats/alice__bob/", "/notifications/")
+            ]
+            for communicator in communicators:
+                connected, _ = await communicator.connect()
+                self.assertTrue(connected)
+                # the frames sent on connect
+                while not await communicator.receive_nothing():
+                    await communicator.receive_output()
+            await drain(connections.channel_names())
+            received = []
+            for communicator in communicators:
+                if await communicator.receive_nothing():
+                    received.append(None)
+                else:
+                    received.append(
+                        (await communicator.receive_json_from(), await communicator.receive_output())
+                    )
+                await communicator.disconnect()
+            self.assertEqual(connections.channel_names(), [])
+            return received
+
+        return async_to_sync(session)()
+
+    def assertDrained(self, received, window):
+        frame, close = received
+        self.assertEqual(frame["type"], "server_restart")
+        self.assertTrue(1 <= frame["retry_after"] <= max(window, 1))
+        self.assertEqual(close, {"type": "websocket.close", "code": 4012})
+
+    def test_drain_everything(self):
+        received = self.run_sockets(lambda channels: connections.drain(0.2))
+        for socket_received in received:
+            self.assertDrained(socket_received, 0.2)
+
+    def test_drain_some(self):
+        # the chat socket registered first
+        received = self.run_sockets(lambda channels: connections.drain(0, channels[:1]))
+        self.assertDrained(received[0], 0)
+        self.assertIsNone(received[1])
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class HeartbeatTests(ChatTestCase):
+    """
+    One reaper round (connections.reap) against sockets that look alive, silent, broken or idle.
+    """
+
+    def run_socket(self, path, check, **overrides):
+        """
+        Connect to `path` as alice, let the reaper run once with `overrides`
+        (module settings of chat.connections), then `check(communicator)`.
+        """
+
+        async def session():
+            communicator = WebsocketCommunicator(application, f"{path}?token={self.token.key}")
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            # the frames sent on connect
+            while not await communicator.receive_nothing():
+                await communicator.receive_output()
+            with mock.patch.multiple(connections, **overrides):
+                await connections.reap()
+            await check(communicator)
+            await communicator.disconnect()
+
+        async_to_sync(session)()
+
+    def test_ping_pong(self):
+        async def check(communicator):
+            self.assertEqual(await communicator.receive_json_from(), {"type": "ping"})
+            await communicator.send_json_to({"type": "pong"})
+            # swallowed before the consumer, and not counted as traffic
+            self.assertTrue(await communicator.receive_nothing())
+            (report,) = connections.snapshot()["connections"]
+            self.assertEqual(report["messages_in"], 0)
+            self.assertGreater(report["last_seen"], report["last_activity"])
+
+        self.run_socket("/chats/alice__bob/", check, IDLE_TIMEOUT=None)
+
+    def test_silent_socket_kept_open(self):
+        # a listen-only client that never answers the pings, dead peers are daphne's business
+        async def session():
+            communicator = WebsocketCommunicator(
+                application, f"/notifications/?token={self.token.key}"
+            )
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            while not await communicator.receive_nothing():
+                await communicator.receive_output()
+            (channel_name,) = connections.channel_names()
+            connections._channels[channel_name]["last_seen"] = 0
+            await connections.reap()
+            self.assertEqual(await communicator.receive_json_from(), {"type": "ping"})
+            self.assertTrue(await communicator.receive_nothing())
+            self.assertEqual(connections.channel_names(), [channel_name])
+            await communicator.disconnect()
+
+        async_to_sync(session)()
+
+    def test_failing_socket(self):
+        async def broken_send(message):
+            raise OSError("connection reset")
+
+        async def session():
+            now = time.time()
+            # registered ahead of alice's socket, so the round has to get past it
+            connections._sockets["broken"] = (broken_send, True)
+            connections._channels["broken"] = {"last_activity": now, "last_seen": now, "idle": False}
+            communicator = WebsocketCommunicator(
+                application, f"/chats/alice__bob/?token={self.token.key}"
+            )
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            while not await communicator.receive_nothing():
+                await communicator.receive_output()
+            with self.assertLogs("chat.connections", "ERROR") as logs:
+                await connections.reap()
+            self.assertIn("broken", logs.output[0])
+            self.assertEqual(await communicator.receive_json_from(), {"type": "ping"})
+            await communicator.disconnect()
+
+        with mock.patch.dict(connections._sockets), mock.patch.dict(connections._channels):
+            async_to_sync(session)()
+
+    def test_idle_chat_socket(self):
+        async def check(communicator):
+            self.assertEqual(
+                await communicator.receive_output(),
+                {"type": "websocket.close", "code": connections.IDLE_CLOSE_CODE},
+            )
+
+        self.run_socket("/chats/alice__bob/", check, IDLE_TIMEOUT=-1)
+
+    def test_idle_notification_socket(self):
+        async def check(communicator):
+            # kept open, pinged and flagged idle
+            self.assertEqual(await communicator.receive_json_from(), {"type": "ping"})
+            self.assertTrue(await communicator.receive_nothing())
+            (report,) = connections.snapshot()["connections"]
+            self.assertTrue(report["idle"])
+
+        self.run_socket("/notifications/", check, IDLE_TIMEOUT=-1, IDLE_MODE_AFTER=-1)
+
+
+LOCAL_CHANNEL_LAYERS = {"default": {"BACKEND": "chat.layers.LocalChannelLayer"}}
+
+
+class LocalChannelLayerTests(ChatTestCase):
+    def run_async(self, test, **config):
+        async_to_sync(test)(LocalChannelLayer(**config))
+
+    def test_handoff(self):
+        async def test(layer):
+            channel = await layer.new_channel()
+            receiving = asyncio.ensure_future(layer.receive(channel))
+            await asyncio.sleep(0)
+            await layer.send(channel, {"type": "hello"})
+            self.assertEqual(await receiving, {"type": "hello"})
+            # handed over, nothing left behind
+            self.assertEqual(layer.channels, {})
+
+        self.run_async(test)
+
+    def test_group_send_copies(self):
+        async def test(layer):
+            first, second = await layer.new_channel(), await layer.new_channel()
+            for channel in (first, second):
+                await layer.group_add("conversation", channel)
+            message = {"type": "echo", "trace": {"marks": {}}}
+            await layer.group_send("conversation", message)
+            received = [await layer.receive(first), await layer.receive(second)]
+            self.assertEqual(received, [message, message])
+            received[0]["trace"]["marks"]["dispatch"] = 1
+            self.assertEqual(received[1]["trace"], {"marks": {}})
+            self.assertEqual(message["trace"], {"marks": {}})
+
+        self.run_async(test)
+
+    def test_capacity(self):
+        async def test(layer):
+            full, free = await layer.new_channel(), await layer.new_channel()
+            await layer.send(full, {"type": "a"})
+            with self.assertRaises(ChannelFull):
+                await layer.send(full, {"type": "b"})
+            for channel in (full, free):
+                await layer.group_add("conversation", channel)
+            # a full member is skipped, the others still get it
+            await layer.group_send("conversation", {"type": "c"})
+            self.assertEqual(await layer.receive(full), {"type": "a"})
+            self.assertEqual(await layer.receive(free), {"type": "c"})
+
+        self.run_async(test, capacity=1)
+
+    def test_expiry(self):
+        async def test(layer):
+            channel = await layer.new_channel()
+            await layer.group_add("conversation", channel)
+            await layer.send(channel, {"type": "stale"})
+            # the expired message is dropped and the channel that never read it leaves its groups
+            await layer.group_send("conversation", {"type": "fresh"})
+            self.assertNotIn(channel, layer.groups.get("conversation", {}))
+            self.assertNotIn(channel, layer.channels)
+
+        self.run_async(test, expiry=-1)
+
+    @override_settings(CHANNEL_LAYERS=LOCAL_CHANNEL_LAYERS)
+    def test_chat_message(self):
+        bob_token = Token.objects.create(user=self.bob)
+
+        async def session():
+            alice = WebsocketCommunicator(application, f"/chats/alice__bob/?token={self.token.key}")
+            bob = WebsocketCommunicator(application, f"/chats/alice__bob/?token={bob_token.key}")
+            for communicator in (alice, bob):
+                connected, _ = await communicator.connect()
+                self.assertTrue(connected)
+            await alice.send_json_to({"type": "chat_message", "message": "over the local layer"})
+            frame = await bob.receive_json_from()
+            while frame["type"] != "chat_message_echo":
+                frame = await bob.receive_json_from()
+            self.assertEqual(frame["message"]["content"], "over the local layer")
+            for communicator in (alice, bob):
+                await communicator.disconnect()
+
+        async_to_sync(session)()
+
+
+class PurgeMessagesTests(ChatTestCase):
+    """
+    alice__bob: 3 messages from 40 days ago, then the 3 of ChatTestCase.
+    alice__carol: 2 messages from 40 days ago only.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        carol = User.objects.create_user(username="carol")
+        cls.old_conversation = Conversation.objects.create(name="alice__carol")
+        old_ms = int((time.time() - 40 * 86400) * 1000)
+        for i, (conversation, sender) in enumerate(
+            [(cls.conversation, cls.bob)] * 3 + [(cls.old_conversation, carol)] * 2
+        ):
+            Message.objects.create(
+                id=uuid7(timestamp_ms=old_ms + i),
+                from_user=sender,
+                to_user=cls.alice,
+                content=f"old {i}",
+                conversation=conversation,
+            )
+
+    def purge(self, *args):
+        out = io.StringIO()
+        call_command("purge_messages", "--chunk-size=2", *args, stdout=out)
+        return out.getvalue()
+
+    def assertRemaining(self, conversation, contents):
+        self.assertEqual(
+            list(conversation.messages.order_by("id").values_list("content", flat=True)), contents
+        )
+        conversation.refresh_from_db()
+        latest = conversation.messages.order_by("-id").first()
+        self.assertEqual(conversation.message_count, len(contents))
+        self.assertEqual(conversation.last_message, latest)
+        self.assertEqual(conversation.last_message_preview, latest.content if latest else "")
+
+    def test_days(self):
+        self.assertIn("Deleted 5 messages from 2 conversations", self.purge("--days=30"))
+        self.assertRemaining(self.conversation, ["message 0", "message 1", "message 2"])
+        self.assertRemaining(self.old_conversation, [])
+
+    def test_max_per_conversation(self):
+        self.assertIn("Deleted 4 messages", self.purge("--max-per-conversation=2"))
+        self.assertRemaining(self.conversation, ["message 1", "message 2"])
+        self.assertRemaining(self.old_conversation, ["old 3", "old 4"])
+
+    def test_both(self):
+        self.assertIn("Deleted 6 messages", self.purge("--days=30", "--max-per-conversation=2"))
+        self.assertRemaining(self.conversation, ["message 1", "message 2"])
+        self.assertRemaining(self.old_conversation, [])
+
+    def test_dry_run(self):
+        # the old messages of alice__bob match both policies, counted once
+        self.assertIn(
+            "Would delete 6 messages", self.purge("--dry-run", "--days=30", "--max-per-conversation=2")
+        )
+        self.assertEqual(Message.objects.count(), 8)
+
+    def test_no_policy(self):
+        with self.assertRaises(CommandError):
+            self.purge()
+
+
+class ServeTests(TestCase):
+    def test_workers_need_a_shared_cache(self):
+        with self.assertRaisesMessage(CommandError, "REDIS_CACHE_URL"):
+            call_command("serve", workers=2)
+
+    def test_workers_need_a_shared_channel_layer(self):
+        for backend in serve.PROCESS_LOCAL_LAYERS:
+            with self.subTest(backend=backend), self.settings(
+                CHANNEL_LAYERS={"default": {"BACKEND": backend}}
+            ):
+                with self.assertRaisesMessage(CommandError, backend):
+                    call_command("serve", workers=2)
+
+    @override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.dummy.DummyCache"}})
+    def test_workers_need_a_shared_outbox(self):
+        with self.assertRaisesMessage(CommandError, "REDIS_OUTBOX_URL"):
+            call_command("serve", workers=2)
+
+    def test_failed_drain_still_stops(self):
+        stderr = io.StringIO()
+        command = serve.Command(stderr=stderr)
+        stop = mock.Mock()
+        with mock.patch.object(connections, "drain", side_effect=OSError("no channel layer")):
+            async_to_sync(command.drain_and_stop)(stop, {"drain_window": 0, "grace": 0})
+        stop.assert_called_once_with()
+        self.assertIn("no channel layer", stderr.getvalue())
@@ -0,0 +1,121 @@
+import json
+import random
+import threading
+import time
+import uuid
+from collections import deque
+
+from django.conf import settings
+
+"""
+    Sampled latency tracing of the chat_message fan-out.
+
+    A sampled message carries a "trace" dict inside its channel layer event and every stage
+    adds a time.monotonic() mark to it:
+        receive   the frame reached receive_json
+        db_write  the message row is stored
+        publish   group_send is called
+        dispatch  the recipient's chat_message_echo handler starts
+        send      the frame is written to the recipient's socket
+    The layer hands every recipient its own copy, so each one finishes the trace for itself:
+    the time spent in each stage goes to this process' histogram and one line to the trace log.
+    (dispatch - publish) is the channel layer plus the recipient's scheduling.
+
+    The monotonic clock is shared by the processes of one host, a recipient served by another
+    host gets a meaningless dispatch stage.
+"""
+
+SAMPLE_RATE = getattr(settings, "CHAT_TRACE_SAMPLE_RATE", 0.0)
+# optional ndjson file every finished trace is appended to
+TRACE_LOG = getattr(settings, "CHAT_TRACE_LOG", None)
+# finished traces kept in memory for the /api/traces/ export
+RECENT_TRACES = 1000
+
+STAGES = ("receive", "db_write", "publish", "dispatch", "send")
+# upper bounds of the histogram buckets, in ms
+BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+_lock = threading.Lock()
+_histogram = {stage: [0] * (len(BUCKETS) + 1) for stage in STAGES[1:]}
+_totals = {stage: [0, 0.0] for stage in STAGES[1:]}
+_recent = deque(maxlen=RECENT_TRACES)
+
+
+def start():
+    """
+    A new trace for this message, or None if it is not sampled.
+    """
+    if not SAMPLE_RATE or random.random() >= SAMPLE_RATE:
+        return None
+    return {
+        "id": uuid.uuid4().hex[:16],
+        "started_at": time.time(),
+        "marks": {"receive": time.monotonic()},
+    }
+
+
+def mark(trace, stage):
+    if trace is not None:
+        trace["marks"][stage] = time.monotonic()
+
+
+def finish(trace, recipient):
+    """
+    Record the stage durations of one delivered copy of the trace.
+    """
+    if trace is None:
+        return
+    marks = trace["marks"]
+    durations = {}
+    previous = marks.get("receive")
+    for stage in STAGES[1:]:
+        if stage in marks and previous is not None:
+            durations[stage] = round((marks[stage] - previous) * 1000, 3)
+        previous = marks.get(stage, previous)
+
+    entry = {
+        "id": trace["id"],
+        "started_at": trace["started_at"],
+        "recipient": recipient,
+        "stages_ms": durations,
+        "total_ms": round(sum(durations.values()), 3),
+    }
+    with _lock:
+        for stage, ms in durations.items():
+            _histogram[stage][_bucket(ms)] += 1
+            _totals[stage][0] += 1
+            _totals[stage][1] += ms
+        _recent.append(entry)
+        if TRACE_LOG:
+            with open(TRACE_LOG, "a") as log:
+                log.write(json.dumps(entry) + "\n")
+
+
+def _bucket(ms):
+    for index, bound in enumerate(BUCKETS):
+        if ms <= bound:
+            return index
+    return len(BUCKETS)
+
+
+def histogram():
+    """
+    Per stage: how many traces fell in each bucket ("le" upper bound in ms) and the mean.
+    """
+    labels = [str(bound) for bound in BUCKETS] + ["+Inf"]
+    with _lock:
+        return {
+            stage: {
+                "count": _totals[stage][0],
+                "mean_ms": round(_totals[stage][1] / _totals[stage][0], 3)
+                if _totals[stage][0]
+                else None,
+                "buckets": dict(zip(labels, _histogram[stage])),
+            }
+            for stage in STAGES[1:]
+        }
+
+
+def recent():
+    with _lock:
+        return list(_recent)
@@ -8,12 +8,29 @@ from rest_framework.viewsets import GenericViewSet
 from chat.models import Conversation, Message
 from chat.api.serializers import ConversationSerializer
 from rest_framework.authtoken.views import ObtainAuthToken
-from django.db.models import Q
+from django.db.models import Count, F, Max
+from rest_framework.fields import DateTimeField
 from chat.api.serializers import UserSerializer, MessageSerializer
-from chat.api.pagination import MessagePagination
+from chat.api.pagination import UserDirectoryPagination
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.functions import Lower
 from django.shortcuts import get_object_or_404
 from rest_framework.authentication import TokenAuthentication
 from rest_framework.permissions import IsAuthenticated
+from django.http import HttpResponse, StreamingHttpResponse
+from rest_framework.exceptions import ValidationError
+import hashlib
+import json
+from chat.api.export import EXPORT_FORMATS, agzip_stream, gzip_stream
+from django.core.handlers.asgi import ASGIRequest
+from chat.api.conditional import make_etag, not_modified, set_validators
+from chat import response_cache
+from rest_framework.permissions import IsAdminUser
+from rest_framework.views import APIView
+from asgiref.sync import async_to_sync
+from chat import connections
+from chat.api import reads
 
 User = get_user_model()
 
@@ -39,6 +56,134 @@ class UserViewSet(RetrieveModelMixin, ListModelMixin, UpdateModelMixin, GenericV
         serializer = UserSerializer(users, many=True, context={"request": request})
         return Response(status=status.HTTP_200_OK, data=serializer.data)
 
+    @action(detail=False)
+    def directory(self, request):
+        """
+        Cursor paginated list of other users, ?q= filters by case-insensitive username prefix
+        (backed by the lower(username) index from migration 0006).
+        The first page of a search is cached for CHAT_USER_DIRECTORY_CACHE_TTL seconds.
+        """
+        query = request.GET.get("q", "").strip().lower()
+        paginator = UserDirectoryPagination()
+        is_first_page = paginator.cursor_query_param not in request.GET
+        cache_ttl = getattr(settings, "CHAT_USER_DIRECTORY_CACHE_TTL", 0)
+
+        cache_key = None
+        if is_first_page and cache_ttl:
+            page_size = paginator.get_page_size(request)
+            # the search text is user input, only its digest goes into the key
+            digest = hashlib.md5(query.encode()).hexdigest()
+            cache_key = f"chat:user-directory:{request.user.id}:{page_size}:{digest}"
+            data = cache.get(cache_key)
+            if data is not None:
+                return Response(data)
+
+        users = User.objects.exclude(id=request.user.id).only("id", "username")
+        if query:
+            users = users.annotate(username_lower=Lower("username")).filter(
+                username_lower__startswith=query
+            )
+        page = paginator.paginate_queryset(users, request, view=self)
+        serializer = UserSerializer(page, many=True, context={"request": request})
+        response = paginator.get_paginated_response(serializer.data)
+
+        if cache_key:
+            cache.set(cache_key, response.data, cache_ttl)
+        return response
+
+
+class ResponseCacheStatsView(APIView):
+    """
+    Hit rate of the REST response cache in the worker that answers the request.
+    """
+
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response(response_cache.stats())
+
+
+class ConnectionRegistryView(APIView):
+    """
+    Websocket connections of every worker (and its delivery latency histogram, see chat.tracing),
+    collected through the channel layer.
+    GET lists them (?user=<username>, ?group=<group> to filter),
+    POST {"action": "kick" | "drain", "channels": [...], "window": seconds} closes some of them.
+    A drain tells the client to come back later, a kick just closes.
+    """
+
+    permission_classes = [IsAdminUser]
+    MAX_DRAIN_WINDOW = 30
+
+    def get(self, request):
+        user = request.GET.get("user")
+        group = request.GET.get("group")
+        reports = async_to_sync(connections.collect_reports)()
+        for report in reports:
+            report["connections"] = [
+                connection
+                for connection in report["connections"]
+                if (not user or connection["user"] == user)
+                and (not group or group in connection["groups"])
+            ]
+        return Response(
+            {
+                "workers": reports,
+                "total": sum(len(report["connections"]) for report in reports),
+            }
+        )
+
+    def post(self, request):
+        action = request.data.get("action")
+        channels = request.data.get("channels")
+        if action not in ("kick", "drain"):
+            raise ValidationError({"action": 'Must be "kick" or "drain".'})
+        if (
+            not isinstance(channels, list)
+            or not channels
+            or not all(isinstance(name, str) for name in channels)
+        ):
+            raise ValidationError({"channels": "Must be a list of channel names."})
+        try:
+            window = min(float(request.data.get("window", 0)), self.MAX_DRAIN_WINDOW)
+        except (TypeError, ValueError):
+            raise ValidationError({"window": "Must be a number of seconds."})
+
+        try:
+            if action == "kick":
+                async_to_sync(connections.kick)(channels)
+            else:
+                async_to_sync(connections.drain)(max(window, 0), channels)
+        except TypeError as e:
+            # the channel layer rejects malformed channel names with a TypeError
+            raise ValidationError({"channels": str(e)})
+        return Response({"action": action, "channels": channels})
+
+
+class TraceLogView(APIView):
+    """
+    Recent delivery traces of every worker as ndjson, one line per delivered copy,
+    see chat.tracing. The per stage histograms are in /api/connections/.
+    """
+
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        reports = async_to_sync(connections.collect_reports)(traces=True)
+        traces = sorted(
+            (
+                {"worker": report["worker"], **trace}
+                for report in reports
+                for trace in report.get("traces", [])
+            ),
+            key=lambda trace: trace["started_at"],
+        )
+        # already all in memory, nothing to stream
+        return HttpResponse(
+            "".join(json.dumps(trace) + "\n" for trace in traces),
+            content_type="application/x-ndjson",
+        )
+
 
 class CustomObtainAuthTokenView(ObtainAuthToken):
     def post(self, request, *args, **kwargs):
@@ -62,32 +207,76 @@ class ConversationViewSet(ListModelMixin, RetrieveModelMixin, GenericViewSet):
         name = self.kwargs.get("name")
         participants = name.split("__")
         normalized = "__".join(sorted(participants))
-        return get_object_or_404(Conversation, name=normalized)
+        queryset = Conversation.objects.select_related(
+            "last_message__from_user", "last_message__to_user"
+        )
+        return get_object_or_404(queryset, name=normalized)
 
     def get_queryset(self):
-        username = self.request.user.username
-        # Filter conversations to include only those involving the current user
-        # and exclude self-conversations (e.g., "root__root").
-        queryset = Conversation.objects.filter(
-            Q(name__startswith=f"{username}__")
-            | Q(name__endswith=f"__{username}")
-            # name__contains=self.request.user.username
-        )
-        queryset = queryset.exclude(
-            name=f"{username}__{username}"
-            # name__iexact=f"{self.request.user.username}__{self.request.user.username}"
-        )
-        return queryset
+        # only the conversations of the current user, see ConversationQuerySet.involving
+        return Conversation.objects.involving(self.request.user.username)
 
     def list(self, request, *args, **kwargs):
-        """Override list to filter out conversations with null other_user"""
+        """
+        The same response as the async route, see chat.api.reads.conversation_list.
+        Not reached in production, root.urls sends GET /api/conversations/ to the async route
+        first. It keeps the router's route (other methods, OPTIONS) and serves the "threaded"
+        mode of benchmark_mixed_load and the parity tests.
+        """
+        return async_to_sync(reads.conversation_list)(request._request)
+
+    def _list_validators(self, queryset, kind):
+        validators = queryset.aggregate(count=Count("id"), latest=Max("updated_at"))
+        etag = make_etag(kind, self.request.user.pk, validators["count"], validators["latest"])
+        return etag, validators["latest"]
+
+    @action(detail=False)
+    def inbox(self, request):
+        """
+        Inbox rendered from the conversation summary columns only, no join with Message.
+        Most recently active first.
+        """
+        username = request.user.username
         queryset = self.get_queryset()
-        serializer = self.get_serializer(queryset, many=True)
+        etag, last_modified = self._list_validators(queryset, "inbox")
+        response = not_modified(request, etag, last_modified)
+        if response is not None:
+            return response
 
-        # ✅ Filter out conversations where other_user is None
-        data = [conv for conv in serializer.data if conv.get("other_user") is not None]
+        def build():
+            rows = queryset.order_by(F("last_message_at").desc(nulls_last=True)).values(
+                "id",
+                "name",
+                "last_message_id",
+                "last_message_preview",
+                "last_message_at",
+                "message_count",
+            )
+            timestamp_field = DateTimeField()
+            data = []
+            for row in rows:
+                participants = row["name"].split("__")
+                other_username = next((name for name in participants if name != username), None)
+                data.append(
+                    {
+                        "id": str(row["id"]),
+                        "name": row["name"],
+                        "other_user": {"username": other_username},
+                        "last_message_id": (
+                            str(row["last_message_id"]) if row["last_message_id"] else None
+                        ),
+                        "last_message_preview": row["last_message_preview"],
+                        "last_message_at": timestamp_field.to_representation(
+                            row["last_message_at"]
+                        ),
+                        "message_count": row["message_count"],
+                    }
+                )
+            return data
 
-        return Response(data)
+        key = response_cache.response_key("inbox", request.user, etag)
+        data = response_cache.get_or_build(key, build)
+        return set_validators(Response(data), etag, last_modified)
 
     def get_serializer_context(self):
         """
@@ -107,7 +296,23 @@ class ConversationViewSet(ListModelMixin, RetrieveModelMixin, GenericViewSet):
                 status=status.HTTP_403_FORBIDDEN,
             )
 
-        return super().retrieve(request, *args, **kwargs)
+        normalized = "__".join(sorted(participants))
+        validators = (
+            Conversation.objects.filter(name=normalized).values("id", "updated_at").first()
+        )
+        if validators is None:
+            return super().retrieve(request, *args, **kwargs)
+
+        etag = make_etag("conversation", request.user.pk, validators["id"], validators["updated_at"])
+        response = not_modified(request, etag, validators["updated_at"])
+        if response is not None:
+            return response
+
+        key = response_cache.response_key("conversation", request.user, etag)
+        data = response_cache.get_or_build(
+            key, lambda: self.get_serializer(self.get_object()).data
+        )
+        return set_validators(Response(data), etag, validators["updated_at"])
 
     # def get_queryset(self):
     #     current_user = self.request.user.username
@@ -138,15 +343,51 @@ class MessageViewSet(ListModelMixin, GenericViewSet):
 
     serializer_class = MessageSerializer
     queryset = Message.objects.none()
-    pagination_class = MessagePagination
 
-    def get_queryset(self):
-        conversation_name = self.request.GET.get("conversation")
-        queryset = (
-            Message.objects.filter(
-                conversation__name__contains=self.request.user.username,
+    def list(self, request, *args, **kwargs):
+        """
+        The same response as the async route, see chat.api.reads.message_list.
+        Not reached in production either, see ConversationViewSet.list.
+        """
+        return async_to_sync(reads.message_list)(request._request)
+
+    @action(detail=False)
+    def export(self, request):
+        """
+        Streams the whole history of a conversation as ndjson (default) or csv.
+        ?conversation=<name>&output=ndjson|csv , gzipped when the client accepts it.
+        """
+        conversation_name = request.GET.get("conversation", "")
+        participants = conversation_name.split("__")
+        if request.user.username not in participants:
+            return Response(
+                {"error": "You are not part of this conversation"},
+                status=status.HTTP_403_FORBIDDEN,
             )
-            .filter(conversation__name=conversation_name)
-            .order_by("-timestamp")
-        )
-        return queryset
+        normalized = "__".join(sorted(participants))
+        conversation = get_object_or_404(Conversation, name=normalized)
+
+        output = request.GET.get("output", "ndjson")
+        if output not in EXPORT_FORMATS:
+            return Response(
+                {"error": f"Unknown output '{output}'"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        lines, alines, content_type = EXPORT_FORMATS[output]
+        use_gzip = "gzip" in request.META.get("HTTP_ACCEPT_ENCODING", "")
+        # under ASGI only an async iterator is streamed, a plain one is read whole first
+        if isinstance(request._request, ASGIRequest):
+            stream = alines(conversation)
+            if use_gzip:
+                stream = agzip_stream(stream)
+        else:
+            stream = lines(conversation)
+            if use_gzip:
+                stream = gzip_stream(stream)
+
+        response = StreamingHttpResponse(stream, content_type=content_type)
+        response["Content-Disposition"] = f'attachment; filename="{normalized}.{output}"'
+        response["Vary"] = "Accept-Encoding"
+        if use_gzip:
+            response["Content-Encoding"] = "gzip"
+        return response
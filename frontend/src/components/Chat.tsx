@@ -9,6 +9,9 @@ import { ChatLoader } from "./ChatLoader";
 import InfiniteScroll from "react-infinite-scroll-component";
 import { ConversationModel } from "../models/Conversation";
 
+// an unacked message is sent again (same client_id) after this long
+const RESEND_AFTER_MS = 5000;
+
 function Chat() {
   const [welcomeMessage, setWelcomeMessage] = useState("");
   const [message, setMessage] = useState("");
@@ -21,7 +24,6 @@ function Chat() {
   const [conversation, setConversation] = useState<ConversationModel | null>(
     null
   );
-  const [page, setPage] = useState(2);
   const [hasMoreMessages, setHasMoreMessages] = useState(false);
   const [messageHistory, setMessageHistory] = useState<MessageModel[]>([]);
 
@@ -29,41 +31,20 @@ function Chat() {
     return null;
   }
 
+  // sent but not acked yet, by client_id: resent with the same id until the server acks it
+  // (it stores a client_id only once however often it arrives)
+  const unacked = useRef(new Map<string, { message: string; sentAt: number }>());
+
   useEffect(() => {
     setMessageHistory([]);
-    setPage(2);
     setHasMoreMessages(false);
+    unacked.current.clear();
   }, [conversationName]);
 
-  async function fetchMessages() {
-    const apiRes = await fetch(
-      `http://127.0.0.1:8000/api/messages/?conversation=${conversationName}&page=${page}`,
-      {
-        method: "GET",
-        headers: {
-          Accept: "application/json",
-          "Content-Type": "application/json",
-          Authorization: `Bearer ${user?.token}`,
-        },
-      }
-    );
-    if (apiRes.status === 200) {
-      const data: {
-        count: number;
-        next: string | null;
-        previous: string | null;
-        results: MessageModel[];
-      } = await apiRes.json();
-      setHasMoreMessages(data.next !== null);
-      setPage(page + 1);
-      setMessageHistory((prev: MessageModel[]) => {
-        const existingIds = new Set(prev.map((msg) => msg.id));
-        const newMessages = data.results.filter(
-          (msg) => !existingIds.has(msg.id)
-        );
-        return prev.concat(newMessages);
-      });
-    }
+  function fetchMessages() {
+    // older pages come over the chat socket, answered with a "history_page" frame
+    const oldest = messageHistory[messageHistory.length - 1];
+    sendJsonMessage({ type: "load_history", before: oldest?.id, page_size: 50 });
   }
 
   const timeout = useRef<any>(null);
@@ -113,6 +94,20 @@ function Chat() {
 
   useEffect(() => () => clearTimeout(timeout.current), []);
 
+  function sendChatMessage(clientId: string, text: string) {
+    unacked.current.set(clientId, { message: text, sentAt: Date.now() });
+    sendJsonMessage({ type: "chat_message", message: text, client_id: clientId });
+  }
+
+  function resendUnacked(olderThanMs: number) {
+    const now = Date.now();
+    unacked.current.forEach((pending, clientId) => {
+      if (now - pending.sentAt >= olderThanMs) {
+        sendChatMessage(clientId, pending.message);
+      }
+    });
+  }
+
   const { readyState, sendJsonMessage } = useWebSocket(
     user ? `ws://127.0.0.1:8000/chats/${conversationName}/` : null,
     {
@@ -121,7 +116,11 @@ function Chat() {
       },
       onOpen: () => {
         console.log("Connected!");
+        // whatever the last socket didn't ack
+        resendUnacked(0);
       },
+      shouldReconnect: () => true,
+      reconnectInterval: 3000,
       onClose: () => {
         console.log("Disconnected!");
       },
@@ -160,10 +159,24 @@ function Chat() {
               );
             }
             break;
+          case "chat_message_ack":
+            // stored; the message itself arrives with the echo
+            unacked.current.delete(data.client_id);
+            break;
           case "last_50_messages":
             setMessageHistory(data.messages);
             setHasMoreMessages(data.has_more);
             break;
+          case "history_page":
+            setHasMoreMessages(data.has_more);
+            setMessageHistory((prev: MessageModel[]) => {
+              const existingIds = new Set(prev.map((msg) => msg.id));
+              const newMessages = data.messages.filter(
+                (msg: MessageModel) => !existingIds.has(msg.id)
+              );
+              return prev.concat(newMessages);
+            });
+            break;
           case "user_join":
             setParticipants((pcpts: string[]) => {
               if (!pcpts.includes(data.user)) {
@@ -184,6 +197,10 @@ function Chat() {
           case "typing":
             updateTyping(data);
             break;
+          case "ping":
+            // advisory server heartbeat, answering only tells the server we are still here
+            sendJsonMessage({ type: "pong" });
+            break;
           default:
             console.error("Unknown Message type", data.type);
             break;
@@ -201,10 +218,7 @@ function Chat() {
     if (message.length === 0) return;
     if (message.length > 512) return;
     if (message.trim()) {
-      sendJsonMessage({
-        type: "chat_message",
-        message: message,
-      });
+      sendChatMessage(crypto.randomUUID(), message);
       setMessage("");
       clearTimeout(timeout.current);
       timeoutFunction();
@@ -245,6 +259,12 @@ function Chat() {
   }
 
   const isConnected = readyState === ReadyState.OPEN;
+
+  useEffect(() => {
+    if (!isConnected) return;
+    const interval = setInterval(() => resendUnacked(RESEND_AFTER_MS), RESEND_AFTER_MS);
+    return () => clearInterval(interval);
+  }, [isConnected]);
   const isConnecting = readyState === ReadyState.CONNECTING;
 
   return (
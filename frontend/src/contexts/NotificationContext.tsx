@@ -18,11 +18,21 @@ export const NotificationContextProvider: React.FC<{ children: ReactNode }> = ({
   const { user } = useContext(AuthContext);
   const [unreadMessageCount, setUnreadMessageCount] = useState(0);
 
-  const { readyState } = useWebSocket(
+  // last outbox cursor we acked, the server replays what came after it on connect.
+  // Per user: cursors of one user's outbox mean nothing in another's.
+  const cursorKey = `notificationCursor:${user?.username}`;
+  const ack = (cursor: string | null) => {
+    if (!cursor) return;
+    localStorage.setItem(cursorKey, cursor);
+    sendJsonMessage({ type: "ack", cursor });
+  };
+
+  const { readyState, sendJsonMessage } = useWebSocket(
     user ? `ws://127.0.0.1:8000/notifications/` : null,
     {
       queryParams: {
-        token: user ? user.token : ""
+        token: user ? user.token : "",
+        cursor: (user && localStorage.getItem(cursorKey)) || ""
       },
       onOpen: () => {
         console.log("Connected to Notifications!");
@@ -36,8 +46,16 @@ export const NotificationContextProvider: React.FC<{ children: ReactNode }> = ({
           case "unread_count":
             setUnreadMessageCount(data.unread_count);
             break;
-          case "new_message_notification":
-            setUnreadMessageCount((count) => count + 1);
+          case "new_message_digest":
+            setUnreadMessageCount(data.unread_count);
+            ack(data.cursor);
+            break;
+          case "missed_notifications":
+            // the unread_count frame before it already has the totals
+            ack(data.cursor);
+            break;
+          case "ping":
+            sendJsonMessage({ type: "pong" });
             break;
           default:
             console.error("Unknown notification message type!");
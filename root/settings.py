@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -147,6 +148,67 @@ CHANNEL_LAYERS = {
         },
     },
 }
+# Single node installs with one worker process can keep the channel layer in process
+# (LOCAL_CHANNEL_LAYER=1, see chat/layers.py) and skip redis altogether, `manage.py serve`
+# refuses more than one worker with it.
+if os.environ.get("LOCAL_CHANNEL_LAYER"):
+    CHANNEL_LAYERS = {"default": {"BACKEND": "chat.layers.LocalChannelLayer"}}
+
+# Local memory cache by default (per process). Set REDIS_CACHE_URL (e.g. redis://127.0.0.1:6379/1)
+# to share it between workers, `manage.py serve` refuses more than one worker without it.
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "chat",
+    }
+}
+if os.environ.get("REDIS_CACHE_URL"):
+    CACHES["default"] = {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": os.environ["REDIS_CACHE_URL"],
+    }
+
+# Seconds a cached REST response (conversation list, first page of messages ...) lives
+CHAT_RESPONSE_CACHE_TTL = 300
+
+# Seconds new-message notifications to one user are batched into a single digest frame
+CHAT_NOTIFICATION_WINDOW = 1.0
+
+# Seconds the first page of /api/users/directory/ is cached for, 0 disables it
+CHAT_USER_DIRECTORY_CACHE_TTL = 30
+
+# Seconds a client message id is remembered so a resent chat_message is acked without a write
+CHAT_CLIENT_ID_TTL = 300
+
+# Retention policy applied by `manage.py purge_messages`, None keeps everything
+CHAT_RETENTION_DAYS = None
+CHAT_RETENTION_MAX_PER_CONVERSATION = None
+
+# Share of chat messages whose delivery is traced stage by stage (0 - 1), see chat/tracing.py
+CHAT_TRACE_SAMPLE_RATE = 0.01
+# Optional ndjson file every finished trace is appended to
+CHAT_TRACE_LOG = None
+
+# Directory websocket sessions are recorded to (anonymized) for `manage.py replay_traffic`,
+# None disables the recorder
+CHAT_CAPTURE_PATH = None
+
+# Per user outbox of notifications, replayed to the client on connect (see chat/outbox.py).
+# Set REDIS_OUTBOX_URL to keep it in redis streams shared by all workers, else it is per process
+# (`manage.py serve` refuses more than one worker without it).
+CHAT_OUTBOX_REDIS_URL = os.environ.get("REDIS_OUTBOX_URL")
+CHAT_OUTBOX_SIZE = 500
+CHAT_OUTBOX_TTL = 7 * 24 * 3600
+
+# Seconds between two heartbeat rounds, None turns the reaper off. `manage.py serve` also has
+# daphne send a websocket protocol ping that often and drop a socket that doesn't answer within
+# CHAT_HEARTBEAT_TIMEOUT seconds (dead peers). The reaper's {"type": "ping"} frames are advisory,
+# a chat socket without traffic for CHAT_IDLE_TIMEOUT seconds (None: never) is closed as idle.
+# Notification sockets quiet for CHAT_IDLE_MODE_AFTER seconds drop to a low-memory idle mode.
+CHAT_HEARTBEAT_INTERVAL = 25
+CHAT_HEARTBEAT_TIMEOUT = 30
+CHAT_IDLE_TIMEOUT = 3600
+CHAT_IDLE_MODE_AFTER = 120
 
 # Add this REST_FRAMEWORK configuration
 REST_FRAMEWORK = {
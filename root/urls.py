@@ -17,7 +17,13 @@ Including another URLconf
 
 from django.contrib import admin
 from django.urls import path, include
-from chat.views import CustomObtainAuthTokenView
+from chat.api import async_views
+from chat.views import (
+    ConnectionRegistryView,
+    CustomObtainAuthTokenView,
+    ResponseCacheStatsView,
+    TraceLogView,
+)
 
 urlpatterns = [
     path("admin/", admin.site.urls),
@@ -26,8 +32,14 @@ urlpatterns = [
 
 # API URLs
 urlpatterns += [
+    # async reads, ahead of the router's sync routes for the same urls
+    path("api/conversations/", async_views.conversation_list),
+    path("api/messages/", async_views.message_list),
     path(
         "api/", include("root.api_router")
     ),  # this is for api routes defined in api_router.py eg. /api/users/
     path("auth-token/", CustomObtainAuthTokenView.as_view()),
+    path("api/cache-stats/", ResponseCacheStatsView.as_view()),
+    path("api/connections/", ConnectionRegistryView.as_view()),
+    path("api/traces/", TraceLogView.as_view()),
 ]